@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import logging
+from multiprocessing.pool import ThreadPool
+from omero import model
+from omero import rtypes
+from omero import constants
+
+BATCH_LOG = logging.getLogger(__name__)
+
+# link class, parent class and HQL link type for each annotated object type
+ANNOTATION_LINK_TYPES = {'Project': (model.ProjectAnnotationLinkI, model.ProjectI, 'ProjectAnnotationLink'),
+                         'Dataset': (model.DatasetAnnotationLinkI, model.DatasetI, 'DatasetAnnotationLink'),
+                         'Image': (model.ImageAnnotationLinkI, model.ImageI, 'ImageAnnotationLink')}
+
+
+def new_annotation_link(object_type, object_id, annotation):
+    """
+    Returns a new, unsaved link from the Project, Dataset or Image
+    'object_id' to 'annotation', which may be an unloaded proxy of a saved
+    annotation or a new annotation to be saved along with the link.
+    """
+    link_class, parent_class = ANNOTATION_LINK_TYPES[object_type][:2]
+
+    link = link_class()
+    link.setParent(parent_class(int(object_id), False))
+    link.setChild(annotation)
+    return link
+
+
+class AnnotationBatch(object):
+    """
+    Collects the description, tags, key:value pairs and tables to add to a
+    single Project, Dataset or Image, and saves them all at once on commit():
+    the tables are written in parallel through the broker's shared resources
+    handle, and then the description, the new annotations and all the links
+    are saved with a single saveArray call. If the save fails, the tables
+    written for it are deleted again. Tags are resolved through the broker's
+    TagResolver, so existing tags are reused and tags already linked to the
+    object are skipped. Create a batch with OMERODataBroker.annotation_batch.
+    """
+
+    def __init__(self, broker, object_type, object_id, table_workers=4):
+        self.broker = broker
+        self.object_type = object_type
+        self.object_id = int(object_id)
+        self.table_workers = table_workers
+
+        self.description = None
+        self.tag_values = []
+        self.kvps = []
+        self.tables = []
+
+    def set_description(self, description):
+        self.description = description
+
+    def add_tags(self, tag_values):
+        # tags shouldn't contain commas?
+        split_tag_values = [x.strip() for tag_value in tag_values for x in tag_value.split(',')]
+
+        # ignore empty tag strings
+        self.tag_values.extend(x for x in split_tag_values if len(x) > 0)
+
+    def add_kvps(self, key_value_data):
+        """
+        Adds key:value pairs, given as lists of a key followed by its values,
+        to the map annotation of the batch.
+        """
+        self.kvps.extend(key_value_data)
+
+    def add_table(self, dataframe, table_name):
+        self.tables.append((dataframe, table_name))
+
+    def write_tables(self):
+        """
+        Writes the tables of the batch in parallel, all through the cached
+        SharedResources proxy of the broker's session, and returns the ids of
+        their OriginalFiles. If a table fails, the others are deleted and the
+        error is raised.
+        """
+        if len(self.tables) == 0:
+            return []
+
+        omero_session = self.broker.SESSION
+
+        def write_table(table):
+            try:
+                return self.broker.write_table(table[0], table[1], omero_session), None
+            except Exception as e:
+                return None, e
+
+        if self.table_workers > 1 and len(self.tables) > 1:
+            pool = ThreadPool(processes=min(self.table_workers, len(self.tables)))
+            try:
+                results = pool.map(write_table, self.tables)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [write_table(table) for table in self.tables]
+
+        errors = [error for file_id, error in results if error is not None]
+        if len(errors) > 0:
+            self.delete_tables(omero_session, [file_id for file_id, error in results if error is None])
+            raise errors[0]
+
+        return [file_id for file_id, error in results]
+
+    def delete_tables(self, omero_session, table_file_ids):
+        # tables that won't be linked to the object; failures are only
+        # logged, so the error that made them orphans is the one raised
+        for table_file_id in table_file_ids:
+            try:
+                self.broker.delete_table(table_file_id, omero_session)
+            except Exception:
+                BATCH_LOG.exception("Failed to delete table file %s" % table_file_id)
+
+    def build(self, omero_session, table_file_ids):
+        """
+        Returns the objects to save for the batch: the object itself with
+        its new description, and the links to the new and existing
+        annotations.
+        """
+        to_save = []
+
+        if self.description is not None:
+            om_object = self.broker.load_object(self.object_type, self.object_id)
+            if om_object is not None:
+                om_object.setDescription(rtypes.rstring(self.description))
+                to_save.append(om_object)
+
+        if len(self.tag_values) > 0:
+            resolver = self.broker.TAG_RESOLVER
+            tag_ids = resolver.resolve(omero_session, self.tag_values)
+            to_save.extend(resolver.new_tag_links(omero_session, self.object_type, self.object_id,
+                                                  tag_ids.values()))
+
+        if len(self.kvps) > 0:
+            map_anno = model.MapAnnotationI()
+
+            # Use 'client' namespace to allow editing in Insight & web
+            map_anno.setNs(rtypes.rstring(constants.metadata.NSCLIENTMAPANNOTATION))
+            map_anno.setMapValue([model.NamedValue(i[0], str(i[1:])) for i in self.kvps])
+            to_save.append(new_annotation_link(self.object_type, self.object_id, map_anno))
+
+        for orig_file_id in table_file_ids:
+            file_ann = model.FileAnnotationI()
+            # use unloaded OriginalFileI
+            file_ann.setFile(model.OriginalFileI(orig_file_id, False))
+            to_save.append(new_annotation_link(self.object_type, self.object_id, file_ann))
+
+        return to_save
+
+    def commit(self):
+        """
+        Saves everything added to the batch, using the broker's open session,
+        and returns the ids of the OriginalFiles of the tables.
+        """
+        omero_session = self.broker.SESSION
+        table_file_ids = self.write_tables()
+
+        try:
+            try:
+                self.save(omero_session, table_file_ids)
+            except Exception:
+                if len(self.tag_values) == 0 and self.description is None:
+                    raise
+
+                # cached tags may have been deleted on the server since, and
+                # the object is reloaded in case the cached one was a stale
+                # version
+                BATCH_LOG.exception("Failed to save annotation batch, retrying with fresh lookups")
+                self.broker.TAG_RESOLVER.clear()
+
+                self.save(omero_session, table_file_ids)
+        except Exception:
+            # the tables are written before the save that links them to the
+            # object, so would otherwise be left behind unlinked
+            self.delete_tables(omero_session, table_file_ids)
+            raise
+
+        return table_file_ids
+
+    def save(self, omero_session, table_file_ids):
+        try:
+            to_save = self.build(omero_session, table_file_ids)
+            if len(to_save) > 0:
+                omero_session.getUpdateService().saveArray(to_save)
+        finally:
+            if self.description is not None:
+                # saveArray doesn't return the new version of the object
+                self.broker.invalidate_object(self.object_type, self.object_id)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+ASYNC_LOG = logging.getLogger(__name__)
+
+
+async def upload_images_async(broker, files_to_upload, dataset_id=None, max_in_flight=None, on_uploaded=None):
+    """
+    Uploads the image files in 'files_to_upload' (which may be a generator)
+    to the dataset 'dataset_id' as individual images, like
+    OMERODataBroker.upload_images without hypercubes or imports. Most of the
+    time of each upload is spent waiting on Ice round-trips, so up to
+    'max_in_flight' images are decoded and created at once; by default, one
+    for each session of the broker's session pool apart from the caller's.
+    The blocking calls run on a dedicated thread pool, each thread on its
+    own pooled session, while the event loop stays free. Only the next files
+    are read from 'files_to_upload' as uploads complete, also on the thread
+    pool, so a lazily scanned directory doesn't block the loop.
+
+    Returns the image ids in the order of the files (None for files that
+    were not uploaded). 'on_uploaded', if given, is called on the event
+    loop with the path and image id of each uploaded file.
+
+    If the coroutine is cancelled, no further uploads are started and the
+    uploads in progress stop before creating their image where possible;
+    images already being written are completed in the background. If an
+    upload fails, the remaining uploads are stopped in the same way and the
+    error is raised.
+
+    The broker's session must be open, as for upload_images.
+    """
+    if max_in_flight is None:
+        # the caller holds one of the pooled sessions already
+        max_in_flight = max(1, broker.SESSION_POOL.max_size - 1)
+
+    # the running loop; get_running_loop() is not available before Python 3.7
+    loop = asyncio.get_event_loop()
+    files = iter(files_to_upload)
+    no_more_files = object()
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    semaphore = asyncio.Semaphore(max_in_flight)
+    # checked by the upload threads, which cannot be cancelled from the loop
+    stopped = threading.Event()
+
+    def upload_file(file_to_upload, dataset):
+        if stopped.is_set():
+            return None
+
+        return broker.upload_image(file_to_upload, dataset, import_original=False)
+
+    async def upload_one(file_to_upload, dataset):
+        try:
+            image_id = await loop.run_in_executor(executor, upload_file, file_to_upload, dataset)
+        except BaseException:
+            stopped.set()
+            raise
+        finally:
+            semaphore.release()
+
+        if image_id is not None and on_uploaded is not None:
+            on_uploaded(file_to_upload, image_id)
+
+        return image_id
+
+    tasks = []
+    try:
+        dataset = await loop.run_in_executor(executor, broker.get_dataset, dataset_id)
+
+        while True:
+            await semaphore.acquire()
+            if stopped.is_set():
+                # an upload failed; gather raises its error
+                break
+
+            # a slot is free, so is a thread to read the next file on
+            file_to_upload = await loop.run_in_executor(executor, next, files, no_more_files)
+            if file_to_upload is no_more_files:
+                semaphore.release()
+                break
+
+            tasks.append(asyncio.ensure_future(upload_one(file_to_upload, dataset)))
+
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        # cancellation or a failed upload: let the running uploads finish
+        # quietly and start no new ones
+        stopped.set()
+        for task in tasks:
+            task.cancel()
+
+        ASYNC_LOG.info("Asynchronous upload stopped after %d files" % len(tasks))
+        raise
+    finally:
+        executor.shutdown(wait=False)
@@ -8,7 +8,10 @@ __copyright__ = "BioRDM"
 __license__ = "mit"
 
 import os
+import sqlite3
+from functools import partial
 from omero_data_transfer.omero_data_broker import OMERODataBroker
+from omero_data_transfer.upload_journal import UploadJournal, file_fingerprint, position_fingerprint
 import subprocess
 import yaml
 from omero_data_transfer.default_image_processor import DefaultImageProcessor as image_processor_impl
@@ -16,6 +19,26 @@ from omero_metadata_parser.aggregate_metadata import MetadataAggregator as metad
 from omero_metadata_parser.metadata_parser import MetadataParser
 
 
+def scan_data_dir(dir_path):
+    """
+    Generator yielding an os.DirEntry for every file in the sub-directories
+    of 'dir_path', at any depth, as the directories are read. Files directly
+    in 'dir_path' (e.g. the acquisition metadata logs) are not included.
+    Entries cache the file type and stat information from the scan.
+    """
+    pending_dirs = [(dir_path, True)]
+
+    while len(pending_dirs) > 0:
+        cur_dir, is_top_dir = pending_dirs.pop()
+
+        with os.scandir(cur_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    pending_dirs.append((entry.path, False))
+                elif not is_top_dir:
+                    yield entry
+
+
 class DataTransferManager:
     metadata_parser = metadata_parser_impl()
 
@@ -51,14 +74,18 @@ class DataTransferManager:
         data_broker.open_omero_session()
 
         print(metadata.description)
-        data_broker.add_description(metadata.description, 'Dataset', dataset_id)
+
+        # the description, tags, tables and key:value pairs are all saved
+        # together, with the tables created in parallel
+        batch = data_broker.annotation_batch('Dataset', dataset_id)
+        batch.set_description(metadata.description)
 
         # add tags to dataset
-        data_broker.add_tags(metadata.tags, 'Dataset', dataset_id)
+        batch.add_tags(metadata.tags)
 
         # create tables as file annotation attachments
         for key in metadata.table_dict:
-            table = data_broker.create_table(dataset_id, metadata.table_dict[key], key)
+            batch.add_table(metadata.table_dict[key], key)
 
         # do key:value pairs
         kvp_list = metadata.kvp_list
@@ -67,7 +94,8 @@ class DataTransferManager:
             kvp_list.append(['Uploaded With', 'pyOmeroUpload 2.2.0'])
             kvp_list.append(['PyOmeroUpload', 'https://github.com/SynthSys/pyOmeroUpload'])
 
-        data_broker.add_kvps(kvp_list, 'Dataset', dataset_id)
+        batch.add_kvps(kvp_list)
+        batch.commit()
 
         data_broker.close_omero_session()
 
@@ -81,49 +109,119 @@ class DataTransferManager:
     (https://docs.openmicroscopy.org/omero/5.4.10/users/cli/import.html).
     '''
     def upload_data_dir(self, data_broker, dataset_name, dir_path, hypercube=False, include_provenance_kvps=True,
-                        ignore_metadata=False):
+                        ignore_metadata=False, resume=False, deduplicate=False):
+        '''
+        Progress is recorded in an upload journal in 'dir_path'. With
+        'resume', the dataset previously created for 'dataset_name' on the
+        same server is reused, and its metadata and the files (or, for
+        hypercubes, position directories) uploaded since they last changed
+        are skipped. With 'deduplicate', files whose content was uploaded
+        before are skipped or linked to the dataset instead of being sent.
+        '''
         if ignore_metadata == False:
             metadata = self.metadata_parser.extract_metadata(dir_path)
 
         dataset_id, image_id_list = None, None
 
         try:
-            data_broker.open_omero_session()
-            dataset_obj = data_broker.create_dataset(dataset_name)
-            data_broker.close_omero_session()
-
-            dirs_to_upload = []
-            files_to_upload = []
+            journal = UploadJournal.for_data_dir(dir_path)
+        except (sqlite3.Error, OSError) as error:
+            print(': '.join(["Upload journal unavailable, uploads cannot be resumed", str(error)]))
+            journal = None
 
-            # upload data (image) files
-            for root, sub_dirs, files in os.walk(dir_path):
-                dirs_to_upload.append(root)
-
-                for sub_dir in sub_dirs:
-
-                    dirs_to_upload.append(os.path.join(root, sub_dir))
-
-                    for data_file in os.listdir((os.path.join(dir_path, sub_dir))):
-                        files_to_upload.append(os.path.join(root, sub_dir, data_file))
-
-            dataset_id = str(dataset_obj.getId().getValue())
+        try:
+            if resume == True and journal is not None:
+                dataset_id = journal.find_dataset(data_broker.HOST, dataset_name)
+
+            if dataset_id is not None:
+                # the dataset may have been deleted on the server since
+                data_broker.open_omero_session()
+                dataset_obj = data_broker.get_dataset(dataset_id)
+                data_broker.close_omero_session()
+
+                if dataset_obj is None:
+                    print(': '.join(['Dataset no longer exists, starting a new upload', str(dataset_id)]))
+                    journal.forget_dataset(dataset_id)
+                    dataset_id = None
+
+            if dataset_id is None:
+                data_broker.open_omero_session()
+                dataset_obj = data_broker.create_dataset(dataset_name)
+                data_broker.close_omero_session()
+
+                dataset_id = str(dataset_obj.getId().getValue())
+
+                if journal is not None:
+                    journal.start_dataset(data_broker.HOST, dataset_name, dataset_id)
+            else:
+                dataset_id = str(dataset_id)
+                print(': '.join(['Resuming upload to Dataset ID', dataset_id]))
+
+            # upload data (image) files; the directory is scanned lazily, so
+            # uploads start while the scan is still running
+            entries = scan_data_dir(dir_path)
+
+            if resume == True and journal is not None and hypercube == False:
+                uploaded_files = journal.completed(dataset_id, UploadJournal.FILE)
+                entries = (entry for entry in entries
+                           if uploaded_files.get(entry.path) != file_fingerprint(entry.stat()))
+
+            files_to_upload = (entry.path for entry in entries)
+
+            if hypercube == True:
+                # hypercubes are built per position directory from the full listing
+                files_to_upload = list(files_to_upload)
+
+                if resume == True and journal is not None:
+                    uploaded_positions = journal.completed(dataset_id, UploadJournal.POSITION)
+                    done_dirs = set(os.path.normpath(path) for path, fingerprint in uploaded_positions.items()
+                                    if os.path.isdir(path) and position_fingerprint(path) == fingerprint)
+                    files_to_upload = [f for f in files_to_upload
+                                       if os.path.normpath(os.path.dirname(f)) not in done_dirs]
 
             print(ignore_metadata)
             if ignore_metadata == False and metadata is not None:
-                self.upload_metadata(dataset_id, data_broker, dir_path, metadata, include_provenance_kvps)
+                if journal is not None and journal.is_metadata_done(dataset_id):
+                    print('Dataset metadata already uploaded')
+                else:
+                    self.upload_metadata(dataset_id, data_broker, dir_path, metadata, include_provenance_kvps)
+
+                    if journal is not None:
+                        journal.mark_metadata_done(dataset_id)
+
+            on_uploaded = None
+            if journal is not None:
+                on_uploaded = partial(self.record_upload, journal, dataset_id, hypercube)
 
             data_broker.open_omero_session()
 
-            image_id_list = data_broker.upload_images(files_to_upload, dataset_id, hypercube)
+            image_id_list = data_broker.upload_images(files_to_upload, dataset_id, hypercube,
+                                                      on_uploaded=on_uploaded, deduplicate=deduplicate)
 
             data_broker.close_omero_session()
         except Exception as error:
             print(error)
+            if journal is not None:
+                print('Re-run the upload with resume to continue from where it stopped')
         finally:
             data_broker.close_omero_session()
 
+            if journal is not None:
+                journal.close()
+
         return {'dataset_id': dataset_id, 'image_id_list': image_id_list}
 
+    def record_upload(self, journal, dataset_id, hypercube, path, image_id):
+        try:
+            if hypercube == True:
+                journal.record(dataset_id, os.path.normpath(path), UploadJournal.POSITION, image_id,
+                               position_fingerprint(path))
+            else:
+                journal.record(dataset_id, path, UploadJournal.FILE, image_id, file_fingerprint(os.stat(path)))
+        except (sqlite3.Error, OSError) as error:
+            # the image is uploaded; it is just uploaded again on resume
+            print(': '.join(["Failed to record upload in journal", path, str(error)]))
+
 
 def main():
     PROJECT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
@@ -8,6 +8,13 @@ __copyright__ = "BioRDM"
 __license__ = "mit"
 
 from omero_data_transfer.image_processor import ImageProcessor
+from omero_data_transfer.filename_parser import FilenameParser, position_files
+from omero_data_transfer.image_probe import ImageProbeCache
+from omero_data_transfer.plane_source import MmapTiffPlaneSource
+from omero_data_transfer.pixels_type_cache import PixelsTypeCache
+from omero_data_transfer.plane_pipeline import PlanePipeline, PlaneConverter, PlaneStatistics, \
+    ChannelStatistics, plane_statistics, iter_row_chunks
+from multiprocessing.pool import ThreadPool
 import glob
 import abc
 import os
@@ -18,7 +25,9 @@ import numpy as np
 import omero.util.script_utils as script_utils
 import logging
 import re
+import threading
 from operator import itemgetter
+from functools import partial
 
 # logging config
 logging.basicConfig(filename='image_processing.log', level=logging.DEBUG)
@@ -37,29 +46,111 @@ ACCEPTED_MIME_TYPES = ['image/jpeg', 'image/jpx', 'image/png', 'image/gif', 'ima
 
 class DefaultImageProcessor(ImageProcessor):
 
-    def process_images(self, omero_session, file_path, dataset=None, convert_to_uint16=True):
-        common_path = os.path.commonprefix(file_path)
+    def __init__(self, decode_workers=4, queue_depth=8, position_workers=4,
+                 rendering_percentiles=None, plane_source=None, chunk_rows=None,
+                 defer_rendering=False, sparse_planes=False):
+        # planes are decoded by 'decode_workers' threads while the previous
+        # planes are written to the RawPixelsStore; 'queue_depth' bounds the
+        # number of decoded planes held in memory at once
+        self.decode_workers = decode_workers
+        self.queue_depth = queue_depth
+        # number of position directories uploaded as hypercubes concurrently
+        self.position_workers = position_workers
+        # (lower, upper) percentiles of each channel's histogram used as the
+        # default rendering window; None uses the channel min and max
+        self.rendering_percentiles = rendering_percentiles
+        self.filename_parser = FilenameParser()
+        self.image_probes = ImageProbeCache()
+        # reads planes from image files; by default uncompressed TIFFs are
+        # memory-mapped and anything else is decoded with PIL
+        if plane_source is None:
+            plane_source = MmapTiffPlaneSource()
+        self.plane_source = plane_source
+        # planes taller than 'chunk_rows' are sent as row tiles instead of a
+        # single setPlane message; None always sends whole planes
+        self.chunk_rows = chunk_rows
+        # if set, rendering settings are applied for all images in one batch
+        # at the end of process_images rather than after each image
+        self.defer_rendering = defer_rendering
+        self.pending_rendering = []
+        self.pending_rendering_lock = threading.Lock()
+        # if set, planes missing from a position are not uploaded but left to
+        # the server's zero-initialised pixel buffer; the skipped (Z,C,T)
+        # coordinates of each pixels set are recorded in 'skipped_planes'
+        self.sparse_planes = sparse_planes
+        self.skipped_planes = {}
+        # replaced by the broker with the cache shared by its server
+        self.pixels_type_cache = PixelsTypeCache()
+        # set by the broker to its session pool, so each position is uploaded
+        # on its own session; None uploads every position on the caller's
+        self.session_pool = None
+
+    def process_images(self, omero_session, file_path, dataset=None, convert_to_uint16=True, on_uploaded=None):
+        if len(file_path) == 0:
+            return []
+
+        # only the positions with files to upload, e.g. those left to do when
+        # an interrupted upload is resumed; position directories may be
+        # listed rather than their files
+        cube_paths = list(position_files(file_path))
+
+        upload_position = partial(self.upload_position, omero_session, dataset=dataset,
+                                  convert_to_uint16=convert_to_uint16, on_uploaded=on_uploaded)
+
+        if self.position_workers > 1 and len(cube_paths) > 1:
+            pool = ThreadPool(processes=min(self.position_workers, len(cube_paths)))
+            try:
+                # map returns the results in the order of the position directories
+                image_ids = pool.map(upload_position, cube_paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            image_ids = [upload_position(path) for path in cube_paths]
 
-        common_path = re.sub(r'(.*)pos[0-9]+[^$]', '\\1', common_path)
+        hypercube_ids = [image_id for image_id in image_ids if image_id is not None]
 
-        cube_dirs = [f for f in os.listdir(common_path) if re.search(r'pos[0-9]+$', f)]
+        if self.defer_rendering:
+            try:
+                self.flush_rendering_settings(omero_session)
+            except Exception:
+                PROCESSING_LOG.exception("Failed to apply deferred rendering settings")
 
-        query_service = omero_session.getQueryService()
-        update_service = omero_session.getUpdateService()
-        pixels_service = omero_session.getPixelsService()
+        return hypercube_ids
+
+    def upload_position(self, omero_session, path, dataset=None, convert_to_uint16=True, on_uploaded=None):
+        """
+        Uploads a single position directory as a hypercube. Each call uses its
+        own service proxies, and its own session when a session pool is set,
+        so positions can be uploaded from several threads. Failures are
+        logged and None is returned, so a bad position does not abort the
+        remaining ones. 'on_uploaded', if given, is called with the path and
+        image id once the upload succeeds.
+        """
+        try:
+            if self.session_pool is not None:
+                with self.session_pool.client() as client:
+                    image_id = self.upload_position_on_session(client.getSession(), path, dataset,
+                                                               convert_to_uint16)
+            else:
+                image_id = self.upload_position_on_session(omero_session, path, dataset, convert_to_uint16)
+        except Exception as error:
+            PROCESSING_LOG.exception("Failed to upload hypercube from %s" % path)
+            print(': '.join(["Hypercube upload failed", path, str(error)]))
+            return None
 
-        hypercube_ids = []
+        if image_id is not None and on_uploaded is not None:
+            on_uploaded(path, rtypes.unwrap(image_id))
 
-        for path in cube_dirs:
-            path = os.path.join(common_path, path)
-            if os.path.isdir(path) == True:
-                image_id = self.upload_dir_as_images(omero_session, query_service, update_service, pixels_service,
-                                        path, dataset, convert_to_uint16)
+        return image_id
 
-                if image_id is not None:
-                    hypercube_ids.append(image_id)
+    def upload_position_on_session(self, omero_session, path, dataset=None, convert_to_uint16=True):
+        query_service = omero_session.getQueryService()
+        update_service = omero_session.getUpdateService()
+        pixels_service = omero_session.getPixelsService()
 
-        return hypercube_ids
+        return self.upload_dir_as_images(omero_session, query_service, update_service, pixels_service,
+                                         path, dataset, convert_to_uint16)
 
 
     # adapted from script_utils
@@ -92,54 +183,45 @@ class DefaultImageProcessor(ImageProcessor):
         fullpath = None
 
         rgb = False
-        # process the names and populate our imagemap
+        # the position is the same for every file in the directory
+        pos = self.filename_parser.parse_position(path)
+        if pos is None:
+            pos = os.path.basename(os.path.normpath(path))
+
+        files = []
         for f in os.listdir(path):
             fullpath = os.path.join(path, f)
 
             if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff')):
-                import filetype
-                ftype = filetype.guess(fullpath)
-                if ftype is None:
+                # the type is probed once per directory and file extension
+                mime, header = self.image_probes.probe(fullpath)
+                if mime is None:
                     PROCESSING_LOG.error('Cannot guess file type!')
                     continue
 
-                PROCESSING_LOG.debug('File extension: %s' % ftype.extension)
-                PROCESSING_LOG.debug('File MIME type: %s' % ftype.mime)
+                PROCESSING_LOG.debug('File MIME type: %s' % mime)
 
-                if ftype.mime not in ACCEPTED_MIME_TYPES:
+                if mime not in ACCEPTED_MIME_TYPES:
                     continue
 
-            search_res = self.run_regex_search(fullpath, f)
-            tSearch, cSearch, zSearch, tokSearch, posSearch = \
-                itemgetter('tSearch', 'cSearch', 'zSearch', 'tokSearch', 'posSearch')(search_res)
+            files.append(f)
 
-            pos = posSearch.group('pos')
+        # process the names and populate our imagemap
+        for f, planeName in self.filename_parser.parse_listing(files):
+            fullpath = os.path.join(path, f)
 
             if f.endswith(".jpg"):
                 rgb = True
 
-            if tSearch is None:
-                theT = 0
-            else:
-                theT = int(tSearch.group('T'))
-
-            if cSearch is None:
-                cName = "0"
-            else:
-                cName = cSearch.group('C')
-
-            if zSearch is None:
-                theZ = 0
-            else:
-                theZ = int(zSearch.group('Z'))
+            theZ, cName, theT, token = planeName
 
             channelSet.add(cName)
             sizeZ = max(sizeZ, theZ)
             zStart = min(zStart, theZ)
             sizeT = max(sizeT, theT)
             tStart = min(tStart, theT)
-            if tokSearch is not None:
-                tokens.append(tokSearch.group('Token'))
+            if token is not None:
+                tokens.append(token)
             imageMap[(theZ, cName, theT)] = fullpath
 
         chans_map = self.find_channel_map(rgb, channelSet)
@@ -154,15 +236,22 @@ class DefaultImageProcessor(ImageProcessor):
         description = "Imported from images in %s" % path
         PROCESSING_LOG.info("Creating image: %s" % imageName)
 
-        # use the last image to get X, Y sizes and pixel type
-        if rgb:
-            plane = script_utils.getPlaneFromImage(fullpath, 0)
+        # use the header of the last image to get X, Y sizes and pixel type,
+        # falling back to decoding it for formats that can't be probed
+        header = self.image_probes.probe(fullpath)[1]
+
+        if header is not None and header.samples == 1:
+            sizeX, sizeY, dtype = header.width, header.height, header.dtype
         else:
-            plane = script_utils.getPlaneFromImage(fullpath)
+            if rgb:
+                plane = self.plane_source.read_plane(fullpath, 0)
+            else:
+                plane = self.plane_source.read_plane(fullpath)
 
-        pixelsType = self.get_pixels_type(plane, query_service, convert_to_uint16)
+            sizeY, sizeX = plane.shape
+            dtype = plane.dtype
 
-        sizeY, sizeX = plane.shape
+        pixelsType = self.get_pixels_type(dtype, query_service, convert_to_uint16)
 
         PROCESSING_LOG.debug("sizeX: %s  sizeY: %s sizeZ: %s  sizeC: %s  sizeT: %s"
                      % (sizeX, sizeY, sizeZ, sizeC, sizeT))
@@ -176,9 +265,11 @@ class DefaultImageProcessor(ImageProcessor):
 
         pixelsId = self.upload_image_pixels(imageId, query_service, omero_session,
             pixels_service, rgb, imageMap, sizeC, sizeZ, sizeT, sizeX, sizeY,
-            channels, colourMap, convert_to_uint16)
+            channels, colourMap, convert_to_uint16, dtype)
 
-        # add channel names
+        # add channel names and put the image in dataset, if specified,
+        # saving all of them in a single call
+        to_save = []
         pixels = pixels_service.retrievePixDescription(pixelsId)
         i = 0
         # c is an instance of omero.model.ChannelI
@@ -186,50 +277,27 @@ class DefaultImageProcessor(ImageProcessor):
             # returns omero.model.LogicalChannelI
             lc = c.getLogicalChannel()
             lc.setName(rtypes.rstring(channels[i]))
-            update_service.saveObject(lc)
+            to_save.append(lc)
             i += 1
 
-        # put the image in dataset, if specified.
         if dataset:
             link = model.DatasetImageLinkI()
             link.parent = model.DatasetI(dataset.id.val, False)
             link.child = model.ImageI(imageId, False)
-            update_service.saveAndReturnObject(link)
+            to_save.append(link)
+
+        if len(to_save) > 0:
+            update_service.saveArray(to_save)
+
+        if pixelsId in self.skipped_planes:
+            print(': '.join(["Blank planes skipped", str(len(self.skipped_planes[pixelsId]))]))
 
         print(': '.join(["Hypercube successfully uploaded", str(imageId.getValue())]))
 
         return imageId
 
     def run_regex_search(self, full_path, file):
-        regex_token = re.compile(r'(?P<Token>.+)\.')
-        # regex_time = re.compile(r'T(?P<T>\d+)')
-        regex_time = re.compile(r'.*_(?P<T>\d+)_\w+\d*_\d+\.')
-        # regex_channel = re.compile(r'_C(?P<C>.+?)(_|$)')
-        regex_channel = re.compile(r'.*_\d+_(?P<C>\w+\d*)_\d+\.')
-        # regex_zslice = re.compile(r'_Z(?P<Z>\d+)')
-        regex_zslice = re.compile(r'.*_\d+_\w+\d*_(?P<Z>\d+)\.')
-
-        path_sep = os.path.sep
-
-        if os.name == 'nt':
-            # need to add an additional backslash to escape the previous backslash otherwise regex parses it as escaping the opening bracket...
-            pos_search_string = path_sep.join([r'.*', r'\(?P<pos>pos\d+)', r'.*'])
-            regex_pos = re.compile(r''.join(pos_search_string))
-        else:
-            pos_search_string = path_sep.join([r'.*', r'(?P<pos>pos\d+)', r'.*'])
-            regex_pos = re.compile(r''.join(pos_search_string))
-
-        tSearch = regex_time.search(file)
-        cSearch = regex_channel.search(file)
-        zSearch = regex_zslice.search(file)
-        tokSearch = regex_token.search(file)
-        posSearch = regex_pos.search(full_path)
-
-        return {'tSearch': tSearch,
-                'cSearch': cSearch,
-                'zSearch': zSearch,
-                'tokSearch': tokSearch,
-                'posSearch': posSearch}
+        return self.filename_parser.search(full_path, file)
 
     def find_channel_map(self, rgb, channelSet):
         channels = []
@@ -254,28 +322,26 @@ class DefaultImageProcessor(ImageProcessor):
                 'colourMap': colourMap}
 
     def get_pixels_type(self, plane, query_service, convert_to_uint16=False):
-        pType = plane.dtype.name
-        # look up the PixelsType object from DB
+        # 'plane' may be a numpy array or just its dtype
+        pType = np.dtype(getattr(plane, 'dtype', plane)).name
+        # look up the PixelsType object from the cached enumeration
         # omero::model::PixelsType
-        pixelsType = query_service.findByQuery(
-            "from PixelsType as p where p.value='%s'" % pType, None)
+        pixelsType = self.pixels_type_cache.get(query_service, pType)
         if pixelsType is None and pType.startswith("float"):  # e.g. float32
             # omero::model::PixelsType
-            pixelsType = query_service.findByQuery(
-                "from PixelsType as p where p.value='%s'" % script_utils.PixelsTypefloat, None)
+            pixelsType = self.pixels_type_cache.get(query_service, script_utils.PixelsTypefloat)
         if pixelsType is None:
             PROCESSING_LOG.warn("Unknown pixels type for: %s" % pType)
             return
 
         if convert_to_uint16 == True:
-            query = "from PixelsType as p where p.value='uint16'"
-            pixelsType = query_service.findByQuery(query, None)
+            pixelsType = self.pixels_type_cache.get(query_service, 'uint16')
 
         return pixelsType
     
     def upload_image_pixels(self, imageId, query_service, omero_session,
         pixels_service, rgb, imageMap, sizeC, sizeZ, sizeT, sizeX, sizeY,
-        channels, colourMap, convert_to_uint16=False):
+        channels, colourMap, convert_to_uint16=False, dtype=None):
         params = sys.ParametersI()
         params.addId(imageId)
         pixelsId = query_service.projection(
@@ -288,10 +354,8 @@ class DefaultImageProcessor(ImageProcessor):
         zStart = 1  # could be 0 or 1 ?
         tStart = 1
 
-        try:
+        def plane_tasks():
             for theC in range(sizeC):
-                minValue = 0
-                maxValue = 0
                 for theZ in range(sizeZ):
                     zIndex = theZ + zStart
                     for theT in range(sizeT):
@@ -300,42 +364,164 @@ class DefaultImageProcessor(ImageProcessor):
                             c = "0"
                         else:
                             c = channels[theC]
-                        if (zIndex, c, tIndex) in imageMap:
-                            imagePath = imageMap[(zIndex, c, tIndex)]
-                            if rgb:
-                                PROCESSING_LOG.debug(
-                                    "Getting rgb plane from: %s" % imagePath)
-                                plane2D = script_utils.getPlaneFromImage(imagePath, theC)
-                            else:
-                                PROCESSING_LOG.debug("Getting plane from: %s" % imagePath)
-                                plane2D = script_utils.getPlaneFromImage(imagePath)
-                        else:
-                            PROCESSING_LOG.debug(
-                                "Creating blank plane for .",
-                                theZ, channels[theC], theT)
-                            plane2D = np.zeros((sizeY, sizeX))
-                        PROCESSING_LOG.debug(
-                            "Uploading plane: theZ: %s, theC: %s, theT: %s"
-                            % (theZ, theC, theT))
-
-                        if convert_to_uint16 == True:
-                            plane2D = np.array(plane2D, dtype=np.uint16)
-
-                        script_utils.upload_plane(rawPixelStore, plane2D, theZ, theC, theT)
-                        minValue = min(minValue, plane2D.min())
-                        maxValue = max(maxValue, plane2D.max())
+                        imagePath = imageMap.get((zIndex, c, tIndex))
+                        yield theZ, theC, theT, imagePath, rgb
+
+        channelStats = ChannelStatistics(sizeC)
+        if convert_to_uint16 == True:
+            dtype = np.uint16
+
+        # planes are converted to the pixels type of the image if it is known,
+        # e.g. when the decoder widens 16-bit PNGs to 32-bit integers
+        converter = PlaneConverter(np.float64 if dtype is None else dtype, (sizeY, sizeX))
+
+        skippedPlanes = []
+        lastPlane = (sizeZ - 1, sizeC - 1, sizeT - 1)
+
+        pipeline = PlanePipeline(self.decode_workers, self.queue_depth)
+        histogram = self.rendering_percentiles is not None
+        read_plane = partial(self.read_plane, channels=channels, histogram=histogram, dtype=dtype)
+
+        try:
+            for theZ, theC, theT, plane2D, planeStats in pipeline.iterate(read_plane, plane_tasks()):
+                PROCESSING_LOG.debug(
+                    "Uploading plane: theZ: %s, theC: %s, theT: %s"
+                    % (theZ, theC, theT))
+
+                if plane2D is None:
+                    # the last plane is always written, so the pixels file
+                    # is extended to its full size
+                    if self.sparse_planes and (theZ, theC, theT) != lastPlane:
+                        skippedPlanes.append((theZ, theC, theT))
+                        continue
+                    plane2D = converter.blank()
+                elif dtype is not None:
+                    plane2D = converter.convert(plane2D)
+
+                if planeStats is None:
+                    # the plane was converted, possibly wrapping values as
+                    # the original upload loop did, so its statistics are
+                    # those of the converted plane
+                    planeStats = plane_statistics(plane2D, histogram)
+
+                self.upload_plane(rawPixelStore, plane2D, theZ, theC, theT)
+                channelStats.add(theC, planeStats)
+
+            windows = []
+            for theC in range(sizeC):
+                minValue, maxValue = channelStats.min_values[theC], channelStats.max_values[theC]
                 pixels_service.setChannelGlobalMinMax(
                     pixelsId, theC, float(minValue), float(maxValue))
-                rgba = None
-                if theC in colourMap:
-                    rgba = colourMap[theC]
-                try:
-                    renderingEngine = omero_session.createRenderingEngine()
-                    script_utils.resetRenderingSettings(
-                        renderingEngine, pixelsId, theC, minValue, maxValue, rgba)
-                finally:
-                    renderingEngine.close()
+                windows.append(channelStats.window(theC, self.rendering_percentiles))
+
+            if len(skippedPlanes) > 0:
+                self.skipped_planes[pixelsId] = skippedPlanes
+                PROCESSING_LOG.info("Skipped %s blank planes of pixels %s: %s"
+                                    % (len(skippedPlanes), pixelsId, skippedPlanes))
+
+            if self.defer_rendering:
+                with self.pending_rendering_lock:
+                    self.pending_rendering.append((pixelsId, windows, colourMap))
+            else:
+                self.apply_rendering_settings(omero_session, [(pixelsId, windows, colourMap)])
         finally:
             rawPixelStore.close()
-        
+
         return pixelsId
+
+    def apply_rendering_settings(self, omero_session, rendering_settings):
+        """
+        Applies the channel windows and colours of one or more pixels sets,
+        given as (pixelsId, windows, colourMap) tuples, using a single
+        RenderingEngine and saving each rendering def once. For each pixels
+        set this does what script_utils.resetRenderingSettings does for a
+        single channel, including creating the rendering def if needed.
+        """
+        renderingEngine = omero_session.createRenderingEngine()
+        try:
+            for pixelsId, windows, colourMap in rendering_settings:
+                renderingEngine.lookupPixels(pixelsId)
+                created = False
+                if not renderingEngine.lookupRenderingDef(pixelsId):
+                    renderingEngine.resetDefaults()
+                    created = True
+                if not renderingEngine.lookupRenderingDef(pixelsId):
+                    raise Exception("Still No Rendering Def")
+
+                renderingEngine.load()
+                for theC, (windowStart, windowEnd) in enumerate(windows):
+                    renderingEngine.setChannelWindow(theC, float(windowStart), float(windowEnd))
+                    rgba = colourMap.get(theC)
+                    if rgba is None and created and theC == 0:
+                        # as resetRenderingSettings, don't default the first channel to blue
+                        rgba = script_utils.COLOURS["White"]
+                    if rgba:
+                        red, green, blue, alpha = rgba
+                        renderingEngine.setRGBA(theC, red, green, blue, alpha)
+                renderingEngine.saveCurrentSettings()
+        finally:
+            renderingEngine.close()
+
+    def flush_rendering_settings(self, omero_session):
+        """
+        Applies the rendering settings deferred by 'defer_rendering' in one
+        batch, and returns the number of pixels sets processed.
+        """
+        with self.pending_rendering_lock:
+            rendering_settings, self.pending_rendering = self.pending_rendering, []
+
+        if len(rendering_settings) > 0:
+            PROCESSING_LOG.info("Applying rendering settings for %s images" % len(rendering_settings))
+            self.apply_rendering_settings(omero_session, rendering_settings)
+
+        return len(rendering_settings)
+
+    def upload_plane(self, rawPixelStore, plane2D, theZ, theC, theT):
+        """
+        Writes a plane to the RawPixelsStore, in chunks of 'chunk_rows' rows
+        with setTile if the plane is taller than that, so large planes are
+        never serialised into a single Ice message.
+        """
+        if self.chunk_rows is None or plane2D.shape[0] <= self.chunk_rows:
+            script_utils.upload_plane(rawPixelStore, plane2D, theZ, theC, theT)
+            return
+
+        sizeX = plane2D.shape[1]
+        # OMERO expects big-endian pixel data, as sent by script_utils.upload_plane
+        bigEndian = plane2D.dtype.newbyteorder('>')
+
+        for y, rows in iter_row_chunks(plane2D, self.chunk_rows):
+            rawPixelStore.setTile(rows.astype(bigEndian).tobytes(), theZ, theC, theT,
+                                  0, y, sizeX, rows.shape[0])
+
+    def read_plane(self, task, channels, histogram=False, dtype=None):
+        """
+        Decodes the plane described by a (theZ, theC, theT, imagePath, rgb)
+        task and computes the plane statistics while the plane is still hot.
+        If no image exists for the task the plane is None, and the writer
+        uploads a blank plane instead. If the plane is to be converted to
+        'dtype', the statistics are None and left to the writer, which
+        computes them on the converted plane. Runs on the decoder threads of
+        the plane pipeline.
+        """
+        theZ, theC, theT, imagePath, rgb = task
+
+        if imagePath is not None:
+            if rgb:
+                PROCESSING_LOG.debug(
+                    "Getting rgb plane from: %s" % imagePath)
+                plane2D = self.plane_source.read_plane(imagePath, theC)
+            else:
+                PROCESSING_LOG.debug("Getting plane from: %s" % imagePath)
+                plane2D = self.plane_source.read_plane(imagePath)
+        else:
+            PROCESSING_LOG.debug(
+                "No image for theZ: %s, theC: %s, theT: %s; using blank plane"
+                % (theZ, channels[theC], theT))
+
+            return theZ, theC, theT, None, PlaneStatistics(0, 0, None)
+
+        if dtype is not None and plane2D.dtype != dtype:
+            return theZ, theC, theT, plane2D, None
+
+        return theZ, theC, theT, plane2D, plane_statistics(plane2D, histogram)
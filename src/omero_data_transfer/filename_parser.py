@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import os
+import re
+from collections import namedtuple, OrderedDict
+
+
+# parsed (Z, C, T) coordinates and name token of a single plane image file
+PlaneName = namedtuple('PlaneName', 'z c t token')
+
+# name of a position directory, e.g. 'pos001', with its number
+POSITION_DIR_PATTERN = re.compile(r'^pos(\d+)$')
+
+
+def position_of(path):
+    """
+    Returns the normalised position directory of an entry of a hypercube
+    upload list: the entry itself if it is a directory, or else the
+    directory of the file.
+    """
+    path = os.path.normpath(path)
+    return path if os.path.isdir(path) else os.path.dirname(path)
+
+
+def position_files(paths):
+    """
+    Groups the entries of a hypercube upload list, which may be image files,
+    position directories (standing for all their files) or both, by
+    position. Returns an OrderedDict mapping each normalised position
+    directory named like 'pos001' to the sorted normalised paths of its
+    listed files, in order of position number. Entries outside position
+    directories are left out.
+    """
+    positions = {}
+
+    for path in paths:
+        position = position_of(path)
+        if POSITION_DIR_PATTERN.search(os.path.basename(position)) is None:
+            continue
+
+        files = positions.setdefault(position, set())
+        if position == os.path.normpath(path):
+            files.update(entry.path for entry in os.scandir(position) if entry.is_file())
+        else:
+            files.add(os.path.normpath(path))
+
+    def position_number(position):
+        return int(POSITION_DIR_PATTERN.search(os.path.basename(position)).group(1)), position
+
+    return OrderedDict((position, sorted(positions[position]))
+                       for position in sorted(positions, key=position_number))
+
+
+class FilenameParser(object):
+    """
+    Parses the Z, C, T coordinates of plane image files named like
+    'Experiment_000001_GFP_001.png', and the position of the directory they
+    are in (e.g. 'pos001'). Patterns are compiled once per parser and the
+    position of each directory is parsed once and cached.
+    """
+    TOKEN_PATTERN = r'(?P<Token>.+)\.'
+    TIME_PATTERN = r'.*_(?P<T>\d+)_\w+\d*_\d+\.'
+    CHANNEL_PATTERN = r'.*_\d+_(?P<C>\w+\d*)_\d+\.'
+    ZSLICE_PATTERN = r'.*_\d+_\w+\d*_(?P<Z>\d+)\.'
+    POSITION_PATTERN = r'.*{sep}(?P<pos>pos\d+){sep}.*'
+
+    # values used when a coordinate is missing from the file name
+    DEFAULT_Z = 0
+    DEFAULT_C = "0"
+    DEFAULT_T = 0
+
+    def __init__(self):
+        self.regex_token = re.compile(self.TOKEN_PATTERN)
+        self.regex_time = re.compile(self.TIME_PATTERN)
+        self.regex_channel = re.compile(self.CHANNEL_PATTERN)
+        self.regex_zslice = re.compile(self.ZSLICE_PATTERN)
+        self.regex_pos = re.compile(self.POSITION_PATTERN.format(sep=re.escape(os.path.sep)))
+
+        self._positions = {}
+
+    def search(self, full_path, file):
+        """
+        Returns the raw match objects for each pattern, keyed as in
+        DefaultImageProcessor.run_regex_search.
+        """
+        return {'tSearch': self.regex_time.search(file),
+                'cSearch': self.regex_channel.search(file),
+                'zSearch': self.regex_zslice.search(file),
+                'tokSearch': self.regex_token.search(file),
+                'posSearch': self.regex_pos.search(full_path)}
+
+    def parse(self, file):
+        """
+        Parses a single file name (without its directory) into a PlaneName.
+        """
+        tSearch = self.regex_time.search(file)
+        cSearch = self.regex_channel.search(file)
+        zSearch = self.regex_zslice.search(file)
+        tokSearch = self.regex_token.search(file)
+
+        return PlaneName(self.DEFAULT_Z if zSearch is None else int(zSearch.group('Z')),
+                         self.DEFAULT_C if cSearch is None else cSearch.group('C'),
+                         self.DEFAULT_T if tSearch is None else int(tSearch.group('T')),
+                         None if tokSearch is None else tokSearch.group('Token'))
+
+    def parse_listing(self, files):
+        """
+        Parses every file name of a directory listing (e.g. the result of
+        os.listdir), returning a list of (file, PlaneName) pairs.
+        """
+        parse = self.parse
+        return [(f, parse(f)) for f in files]
+
+    def parse_position(self, dir_path):
+        """
+        Returns the position (e.g. 'pos001') of a directory, or None if the
+        path does not contain one. Results are cached per directory.
+        """
+        try:
+            return self._positions[dir_path]
+        except KeyError:
+            pass
+
+        posSearch = self.regex_pos.search(os.path.join(dir_path, ''))
+        pos = None if posSearch is None else posSearch.group('pos')
+        self._positions[dir_path] = pos
+
+        return pos
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import os
+import struct
+from collections import namedtuple
+import numpy as np
+
+
+# dimensions, dtype and number of samples per pixel of an image file, read
+# from its header without decoding the pixel data
+ImageHeader = namedtuple('ImageHeader', 'mime width height dtype samples')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_SAMPLES = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+TIFF_LITTLE_ENDIAN = b'II*\x00'
+TIFF_BIG_ENDIAN = b'MM\x00*'
+
+# baseline TIFF tags
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_ROWS_PER_STRIP = 278
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIGURATION = 284
+TIFF_TILE_WIDTH = 322
+TIFF_SAMPLE_FORMAT = 339
+
+# struct formats of the TIFF field types we read, keyed by type id
+TIFF_FIELD_TYPES = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 11: 'f', 12: 'd'}
+TIFF_SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def read_tiff_tags(image_file):
+    """
+    Reads the numeric tags of the first IFD of a classic (non-Big) TIFF file.
+    Returns a (byte_order, tags) pair, where byte_order is '<' or '>' and
+    tags maps tag ids to lists of values, or None if the file is not a TIFF.
+    """
+    image_file.seek(0)
+    header = image_file.read(8)
+
+    if header[:4] == TIFF_LITTLE_ENDIAN:
+        byte_order = '<'
+    elif header[:4] == TIFF_BIG_ENDIAN:
+        byte_order = '>'
+    else:
+        return None
+
+    ifd_offset = struct.unpack(byte_order + 'I', header[4:8])[0]
+    image_file.seek(ifd_offset)
+    entry_count = struct.unpack(byte_order + 'H', image_file.read(2))[0]
+    entries = image_file.read(12 * entry_count)
+
+    tags = {}
+    for i in range(entry_count):
+        tag, field_type, count, value = struct.unpack(byte_order + 'HHI4s', entries[12 * i:12 * (i + 1)])
+
+        if field_type not in TIFF_FIELD_TYPES:
+            continue
+
+        value_format = byte_order + TIFF_FIELD_TYPES[field_type] * count
+        size = struct.calcsize(value_format)
+
+        if size <= 4:
+            data = value[:size]
+        else:
+            # values that don't fit in the entry are stored at an offset
+            image_file.seek(struct.unpack(byte_order + 'I', value)[0])
+            data = image_file.read(size)
+
+        tags[tag] = list(struct.unpack(value_format, data))
+
+    return byte_order, tags
+
+
+def tiff_header(tags):
+    bits = tags.get(TIFF_BITS_PER_SAMPLE, [1])[0]
+    kind = TIFF_SAMPLE_KINDS.get(tags.get(TIFF_SAMPLE_FORMAT, [1])[0])
+
+    if kind is None or bits not in (8, 16, 32, 64):
+        return None
+
+    return ImageHeader('image/tiff', tags[TIFF_IMAGE_WIDTH][0], tags[TIFF_IMAGE_LENGTH][0],
+                       np.dtype('%s%d' % (kind, bits // 8)), tags.get(TIFF_SAMPLES_PER_PIXEL, [1])[0])
+
+
+def png_header(image_file):
+    image_file.seek(0)
+    header = image_file.read(33)
+
+    if header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+
+    width, height, bit_depth, colour_type = struct.unpack('>IIBB', header[16:26])
+    dtype = np.dtype(np.uint16) if bit_depth == 16 else np.dtype(np.uint8)
+
+    return ImageHeader('image/png', width, height, dtype, PNG_SAMPLES.get(colour_type, 1))
+
+
+def probe_image(path):
+    """
+    Returns the ImageHeader of a TIFF or PNG file, reading only its header,
+    or None if the file is in any other (or an unsupported) format.
+    """
+    with open(path, 'rb') as image_file:
+        header = png_header(image_file)
+        if header is not None:
+            return header
+
+        try:
+            tiff = read_tiff_tags(image_file)
+            if tiff is not None:
+                return tiff_header(tiff[1])
+        except (struct.error, KeyError):
+            # truncated or incomplete header; let the caller fall back
+            pass
+
+    return None
+
+
+class ImageProbeCache(object):
+    """
+    Caches the MIME type and ImageHeader of image files per directory and
+    file extension, on the assumption that the images of one acquisition
+    directory share a format. Only the first file of each kind is opened;
+    files that are not TIFF or PNG are sniffed with filetype instead.
+    """
+
+    def __init__(self):
+        self._probes = {}
+
+    def probe(self, path):
+        """
+        Returns a (mime, header) pair for 'path'; header is None for formats
+        other than TIFF and PNG, and mime is None if the type is unknown.
+        """
+        key = (os.path.dirname(path), os.path.splitext(path)[1].lower())
+
+        try:
+            return self._probes[key]
+        except KeyError:
+            pass
+
+        header = probe_image(path)
+        if header is not None:
+            result = (header.mime, header)
+        else:
+            import filetype
+            ftype = filetype.guess(path)
+            result = (None if ftype is None else ftype.mime, None)
+
+        self._probes[key] = result
+
+        return result
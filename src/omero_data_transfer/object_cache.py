@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import threading
+from collections import OrderedDict
+
+
+class ObjectCache(object):
+    """
+    Least recently used cache of shallow-loaded OMERO objects (Projects,
+    Datasets and Images without their links or children), keyed by object
+    type and id. Objects are only valid for the session they were loaded
+    in, so the broker clears its cache when it gives its session up. Cached
+    objects must be replaced with the objects returned by a save, or
+    invalidated, since the server rejects updates of stale versions.
+    """
+    DEFAULT_MAX_SIZE = 256
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = self.DEFAULT_MAX_SIZE
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+
+        self.max_size = max_size
+        self._objects = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, object_type, object_id):
+        with self._lock:
+            key = (object_type, int(object_id))
+            om_object = self._objects.get(key)
+            if om_object is not None:
+                self._objects.move_to_end(key)
+
+            return om_object
+
+    def put(self, object_type, object_id, om_object):
+        with self._lock:
+            key = (object_type, int(object_id))
+            self._objects[key] = om_object
+            self._objects.move_to_end(key)
+
+            while len(self._objects) > self.max_size:
+                self._objects.popitem(last=False)
+
+    def invalidate(self, object_type, object_id):
+        with self._lock:
+            self._objects.pop((object_type, int(object_id)), None)
+
+    def clear(self):
+        with self._lock:
+            self._objects = OrderedDict()
+
+    def __len__(self):
+        return len(self._objects)
@@ -7,13 +7,14 @@ __copyright__ = "BioRDM"
 __license__ = "mit"
 
 import os
+import inspect
+import sqlite3
 from enum import Enum
 from omero.gateway import BlitzGateway, TagAnnotationWrapper, \
     MapAnnotationWrapper
 from omero import client as om_client
-from omero import model, grid
+from omero import model
 from omero import rtypes
-from omero import ClientError
 from omero import sys
 from omero import constants
 from omero import gateway
@@ -24,10 +25,21 @@ import logging
 from PIL import Image
 import numpy as np
 from threading import Thread, BoundedSemaphore
-from multiprocessing.pool import ThreadPool
 from functools import partial
 from .image_processor import ImageProcessor
 from omero_data_transfer.default_image_processor import DefaultImageProcessor
+from omero_data_transfer.pixels_type_cache import PixelsTypeCache
+from omero_data_transfer.filename_parser import position_of
+from omero_data_transfer.upload_dedup import UploadDeduplicator, DedupReport
+from omero_data_transfer.session_pool import SessionPool
+from omero_data_transfer.tag_resolver import TagResolver
+from omero_data_transfer.annotation_batch import AnnotationBatch, new_annotation_link
+from omero_data_transfer.table_writer import TableWriter
+from omero_data_transfer.shared_resources import SharedResourcesCache
+from omero_data_transfer.object_cache import ObjectCache
+from omero_data_transfer.paged_query import iter_pages, paged_parameters, DEFAULT_PAGE_SIZE
+from omero_data_transfer.upload_executor import UploadExecutor, decode_image_file
+from omero_data_transfer.async_upload import upload_images_async
 import subprocess
 
 # logging config
@@ -41,6 +53,18 @@ f_handler.setFormatter(f_format)
 BROKER_LOG.addHandler(f_handler)
 
 
+def create_client(host, port, username, password, keep_alive_interval):
+    """
+    Returns a new omero.client logged in as 'username', which pings its
+    session every 'keep_alive_interval' seconds. Used as the client factory
+    of session pools, so the pools don't keep brokers alive.
+    """
+    client = om_client(host, port)
+    client.createSession(username, password)
+    client.enableKeepAlive(keep_alive_interval)
+    return client
+
+
 class OMERODataType(Enum):
     project = 1
     dataset = 2
@@ -65,14 +89,25 @@ class OMERODataBroker:
     LINKED_ANNOS_BY_DS_QUERY = "select d from Dataset d left outer join " \
                                "fetch d.annotationLinks as links left outer join fetch " \
                                "links.child as annotation where d.id=:did"
+    DATASET_IMAGE_IDS_QUERY = "select l.child.id from DatasetImageLink l where l.parent.id=:did"
+    DATASET_FILE_HASHES_QUERY = "select distinct f.hash from Image i join i.fileset fs join fs.usedFiles u " \
+                                "join u.originalFile f join i.datasetLinks l where l.parent.id=:did " \
+                                "and f.hasher.value='SHA1-160'"
+    IMAGE_IDS_QUERY = "select i.id from Image i where i.id in (:ids)"
 
     ACCEPTED_MIME_TYPES = ['image/jpeg', 'image/jpx', 'image/png', 'image/gif', 'image/webp', 'image/x-canon-cr2',
                            'image/tiff', 'image/bmp', 'image/vnd.ms-photo', 'image/vnd.adobe.photoshop', 'image/x-icon',
                            'image/heic']
 
+    # seconds between the keep-alive pings of pooled sessions
+    KEEP_ALIVE_INTERVAL = 300
+
     def __init__(self, username, password, server, port=4064,
-                 image_processor=DefaultImageProcessor(), ice_config=None,
-                 java_bin_path=None, java_class_path=None):
+                 image_processor=None, ice_config=None,
+                 java_bin_path=None, java_class_path=None, deduplicator=None,
+                 session_pool=None, session_pool_size=None,
+                 upload_workers=10, upload_queue_depth=None, decode_processes=0,
+                 object_cache_size=ObjectCache.DEFAULT_MAX_SIZE, query_page_size=DEFAULT_PAGE_SIZE):
 
         self.USERNAME = username
         self.PASSWORD = password
@@ -81,10 +116,57 @@ class OMERODataBroker:
 
         self.ICE_CONFIG = ice_config
 
-        self.CLIENT = om_client(self.HOST, self.PORT)
+        # logged-in clients are shared by every broker for the same server
+        # and user, so sessions are reused across uploads rather than
+        # created for each phase
+        if session_pool is None:
+            if session_pool_size is None:
+                # a session for each upload thread and the driving thread
+                session_pool_size = max(SessionPool.DEFAULT_MAX_SIZE, upload_workers + 1)
+            client_factory = partial(create_client, self.HOST, self.PORT, self.USERNAME, self.PASSWORD,
+                                     self.KEEP_ALIVE_INTERVAL)
+            session_pool = SessionPool.for_server(self.HOST, self.PORT, self.USERNAME, self.PASSWORD,
+                                                  client_factory, session_pool_size)
+        self.SESSION_POOL = session_pool
+        self.CLIENT = None
         self.SESSION = None
+
+        # shallow-loaded objects of the current session, for annotating the
+        # same objects repeatedly; disabled if the size is 0
+        self.OBJECT_CACHE = ObjectCache(object_cache_size) if object_cache_size else None
+
+        # default number of results fetched at a time by the iter_ queries
+        self.QUERY_PAGE_SIZE = query_page_size
+
+        # uploads individual images with bounded concurrency; the worker
+        # threads (and decoder processes) are reused across uploads
+        self.UPLOAD_EXECUTOR = UploadExecutor(upload_workers, upload_queue_depth, decode_processes)
+
+        if image_processor is None:
+            image_processor = DefaultImageProcessor()
         self.IMAGE_PROCESSOR = image_processor
 
+        # the PixelsType enumeration is shared by all brokers for the server
+        self.PIXELS_TYPE_CACHE = PixelsTypeCache.for_server(self.HOST, self.PORT)
+        if hasattr(self.IMAGE_PROCESSOR, 'pixels_type_cache'):
+            self.IMAGE_PROCESSOR.pixels_type_cache = self.PIXELS_TYPE_CACHE
+        if hasattr(self.IMAGE_PROCESSOR, 'session_pool'):
+            self.IMAGE_PROCESSOR.session_pool = self.SESSION_POOL
+
+        # writes metadata tables with typed columns, in chunks of rows
+        self.TABLE_WRITER = TableWriter()
+        # SharedResources proxies and table repository id, shared by every
+        # broker for the server
+        self.SHARED_RESOURCES = SharedResourcesCache.for_server(self.HOST, self.PORT)
+
+        # tag text to id cache shared by every broker for the server and user
+        self.TAG_RESOLVER = TagResolver.for_user(self.HOST, self.PORT, self.USERNAME)
+
+        # content hash index used when uploading with deduplication; the
+        # default one in the user's home directory is opened on first use
+        self.DEDUPLICATOR = deduplicator
+        self.LAST_DEDUP_REPORT = None
+
         # Need to override the default OMERO java.py function since it cannot find the java binary
         def popen(args,
                   java=java_bin_path,
@@ -111,20 +193,46 @@ class OMERODataBroker:
         om_java.popen = popen
 
     def open_omero_session(self):
-        try:
-            self.SESSION = self.CLIENT.getSession()
-            return
-        except ClientError:
-            BROKER_LOG.info("No live session")
-
-        self.SESSION = self.CLIENT.createSession(self.USERNAME, self.PASSWORD)
+        """
+        Checks out a logged-in client from the session pool for the calling
+        thread, unless the broker holds one already.
+        """
+        if self.CLIENT is None:
+            self.CLIENT = self.SESSION_POOL.checkout()
+
+        self.SESSION = self.CLIENT.getSession()
         return
 
     def close_omero_session(self):
-        self.CLIENT.closeSession()
+        """
+        Returns the broker's client to the session pool, keeping its session
+        open for the next phase or upload. Must be called from the thread
+        that opened the session.
+        """
+        if self.CLIENT is not None:
+            self.SESSION_POOL.checkin()
+
+        self.CLIENT = None
+        self.SESSION = None
+        self.clear_object_cache()
 
     def destroy_omero_session(self):
-        self.CLIENT.destroySession(self.CLIENT.getSessionId())
+        """
+        Logs the broker's session out and drops its client from the session
+        pool. The client is dropped even if logging out fails, e.g. because
+        the session has already expired.
+        """
+        try:
+            if self.CLIENT is not None:
+                self.SHARED_RESOURCES.forget(self.SESSION)
+                try:
+                    self.CLIENT.destroySession(self.CLIENT.getSessionId())
+                finally:
+                    self.SESSION_POOL.invalidate()
+        finally:
+            self.CLIENT = None
+            self.SESSION = None
+            self.clear_object_cache()
 
     def get_connection(self):
         ice_config = "/dev/null"
@@ -167,6 +275,44 @@ class OMERODataBroker:
 
         return objects
 
+    def iter_retrieve_objects(self, data_type, ids=None, opts=None, page_size=None, prefetch=False):
+        """
+        Generates the objects of retrieve_objects a page at a time, with
+        'page_size' objects (QUERY_PAGE_SIZE by default) per call to the
+        container service. With 'prefetch', the next page is fetched while
+        the current one is consumed.
+        """
+        def fetch_page(offset, limit):
+            return self.retrieve_objects(data_type, ids, paged_parameters(opts, offset, limit))
+
+        return iter_pages(fetch_page, page_size or self.QUERY_PAGE_SIZE, prefetch)
+
+    def load_object(self, object_type, object_id):
+        """
+        Returns the Project, Dataset or Image 'object_id' without its links
+        or children, from the object cache if it holds it, or None if there
+        is no such object. Use retrieve_objects for the container hierarchy.
+        """
+        if self.OBJECT_CACHE is not None:
+            om_object = self.OBJECT_CACHE.get(object_type, object_id)
+            if om_object is not None:
+                return om_object
+
+        om_object = self.SESSION.getQueryService().find(object_type, int(object_id))
+
+        if om_object is not None and self.OBJECT_CACHE is not None:
+            self.OBJECT_CACHE.put(object_type, object_id, om_object)
+
+        return om_object
+
+    def invalidate_object(self, object_type, object_id):
+        if self.OBJECT_CACHE is not None:
+            self.OBJECT_CACHE.invalidate(object_type, object_id)
+
+    def clear_object_cache(self):
+        if self.OBJECT_CACHE is not None:
+            self.OBJECT_CACHE.clear()
+
     def load_object_annotations(self, data_type, object_id):
         annos = list()
         if data_type == OMERODataType.project:
@@ -190,6 +336,22 @@ class OMERODataBroker:
 
         return objects
 
+    def iter_objects_by_query(self, query, params, page_size=None, prefetch=False):
+        """
+        Generates the results of the HQL 'query' a page at a time, with
+        'page_size' results (QUERY_PAGE_SIZE by default) per call to the
+        query service, so large result sets are never held in memory at
+        once. The query should have an 'order by' clause so that pages
+        don't overlap. With 'prefetch', the next page is fetched while the
+        current one is consumed.
+        """
+        query_service = self.SESSION.getQueryService()
+
+        def fetch_page(offset, limit):
+            return query_service.findAllByQuery(query, paged_parameters(params, offset, limit))
+
+        return iter_pages(fetch_page, page_size or self.QUERY_PAGE_SIZE, prefetch)
+
     """
         Searches a given field matching against a String. Method
         allows for case sensitive or insensitive searching using
@@ -208,6 +370,22 @@ class OMERODataBroker:
 
         return objects
 
+    def iter_objects_by_type_field_value(self, type, field, value, case_sensitive=False, page_size=None,
+                                         prefetch=False):
+        """
+        Generates the results of find_objects_by_type_field_value a page at
+        a time, with 'page_size' results (QUERY_PAGE_SIZE by default) per
+        call to the query service. With 'prefetch', the next page is fetched
+        while the current one is consumed.
+        """
+        query_service = self.SESSION.getQueryService()
+
+        def fetch_page(offset, limit):
+            page_filter = paged_parameters(None, offset, limit).theFilter
+            return query_service.findAllByString(type, field, value, case_sensitive, page_filter)
+
+        return iter_pages(fetch_page, page_size or self.QUERY_PAGE_SIZE, prefetch)
+
     def query_projects(self, params):
         queryService = self.SESSION.getQueryService()
         # query = "select p from Project p left outer join fetch p.datasetLinks as links left outer join fetch links.child as dataset where p.id =:pid"
@@ -218,51 +396,88 @@ class OMERODataBroker:
         return project
 
     def create_table(self, dataset_id, dataframe, table_name):
-        columns = dataframe.columns
-        resources = self.SESSION.sharedResources()
-        # resources = conn.c.sf.sharedResources()
+        orig_file_id = self.write_table(dataframe, table_name)
 
-        repository_id = resources.repositories().descriptions[0].getId().getValue()
+        # ...so you can attach this data to an object e.g. Dataset
+        file_ann = model.FileAnnotationI()
+        # use unloaded OriginalFileI
+        file_ann.setFile(model.OriginalFileI(orig_file_id, False))
 
-        # create columns and data types, and populate with data
-        data_types = dataframe.dtypes
-        table_data = []
-        init_cols = []
+        # the new file annotation is saved along with the link
+        link = new_annotation_link(str(OMERODataType.dataset), dataset_id, file_ann)
+        table = self.SESSION.getUpdateService().saveAndReturnObject(link)
 
-        for index, col in enumerate(dataframe.columns):
-            if dataframe[col].dtype == object:
-                max_len = dataframe[col].str.len().max()
-                init_col = grid.StringColumn(col, '', max_len, [])
-                init_cols.append(init_col)
+        return table
 
-                data_col = grid.StringColumn(col, '', max_len, list(dataframe.iloc[:, index].values))
-                table_data.append(data_col)
+    def write_table(self, dataframe, table_name, omero_session=None):
+        """
+        Writes 'dataframe' to a new OMERO.tables file named after
+        'table_name', with typed columns, and returns the id of its
+        OriginalFile. Uses the broker's session unless another
+        'omero_session' is given.
+        """
+        if omero_session is None:
+            omero_session = self.SESSION
 
-        table = resources.newTable(repository_id, ''.join(["/", table_name, ".h5"]))
-        # table = resources.newTable(dataset_id, table_name)
-        table.initialize(init_cols)
-        table.addData(table_data)
+        table_path = ''.join(["/", table_name, ".h5"])
+        resources, repository_id = self.SHARED_RESOURCES.get(omero_session)
 
-        # note that this worked after the table.close() statement was invoked in 5.4.10
-        orig_file = table.getOriginalFile()
-        table.close()  # when we are done, close.
+        try:
+            table = resources.newTable(repository_id, table_path)
+        except Exception:
+            # the cached proxy may belong to a session that has since expired
+            BROKER_LOG.exception("Failed to create table with cached shared resources, retrying")
+            self.SHARED_RESOURCES.forget(omero_session)
+            resources, repository_id = self.SHARED_RESOURCES.get(omero_session)
+            table = resources.newTable(repository_id, table_path)
 
-        orig_file_id = orig_file.id.val
+        # table = resources.newTable(dataset_id, table_name)
+        try:
+            self.TABLE_WRITER.initialize(table, dataframe)
 
-        # ...so you can attach this data to an object e.g. Dataset
-        file_ann = model.FileAnnotationI()
-        # use unloaded OriginalFileI
-        file_ann.setFile(model.OriginalFileI(orig_file_id, False))
-        file_ann = self.SESSION.getUpdateService().saveAndReturnObject(file_ann)
+            # note that this worked after the table.close() statement was invoked in 5.4.10
+            orig_file = table.getOriginalFile()
+        finally:
+            table.close()  # when we are done, close.
 
-        link = model.DatasetAnnotationLinkI()
-        link.setParent(model.DatasetI(dataset_id, False))
-        link.setChild(model.FileAnnotationI(file_ann.getId().getValue(), False))
-        table = self.SESSION.getUpdateService().saveAndReturnObject(link)
+        return orig_file.id.val
 
-        return table
+    def append_table(self, table_file_id, dataframe, omero_session=None):
+        """
+        Appends the rows of 'dataframe' to the existing table stored in the
+        OriginalFile 'table_file_id'.
+        """
+        if omero_session is None:
+            omero_session = self.SESSION
+
+        resources = self.SHARED_RESOURCES.get(omero_session)[0]
+        table = resources.openTable(model.OriginalFileI(table_file_id, False))
+        if table is None:
+            raise ValueError("No table in original file %s" % table_file_id)
 
-    def upload_image(self, file_to_upload, dataset, import_original=True, cli=None):
+        try:
+            self.TABLE_WRITER.append(table, dataframe)
+        finally:
+            table.close()
+
+    def delete_table(self, table_file_id, omero_session=None):
+        """
+        Deletes the OriginalFile 'table_file_id' of a table, e.g. one written
+        for annotations that failed to save.
+        """
+        if omero_session is None:
+            omero_session = self.SESSION
+
+        omero_session.getUpdateService().deleteObject(model.OriginalFileI(int(table_file_id), False))
+
+    def annotation_batch(self, object_type, object_id):
+        """
+        Returns an AnnotationBatch collecting annotations for the object, to
+        be saved together with its commit().
+        """
+        return AnnotationBatch(self, object_type, object_id)
+
+    def upload_image(self, file_to_upload, dataset, import_original=True, cli=None, plane=None):
         valid_image = False
         file_mime_type = None
         image = None
@@ -306,10 +521,15 @@ class OMERODataBroker:
                     cli.onecmd(["import", "--clientdir", "/home/jovyan/work/OMERO.server-5.4.10-ice36-b105/lib/client",
                                 '--description', "an image", '--no-upgrade-check', "--quiet", file_to_upload])
             else:
-                planes = script_utils.getPlaneFromImage(imagePath=file_to_upload, rgbIndex=None)
+                # the plane may have been decoded already by a decoder process
+                planes = plane
+                if planes is None:
+                    planes = script_utils.getPlaneFromImage(imagePath=file_to_upload, rgbIndex=None)
 
                 # Use below function if uploading images in RawPixelsStore format (i.e. not the original file import)
-                image = script_utils.createNewImage(self.SESSION, [planes], filename, "An image", dataset)
+                # each upload thread uses its own pooled session, so images are created in parallel
+                with self.SESSION_POOL.client() as client:
+                    image = script_utils.createNewImage(client.getSession(), [planes], filename, "An image", dataset)
 
         if image is not None:
             print(': '.join(["Image file successfully uploaded", str(image.getId().getValue())]))
@@ -317,23 +537,159 @@ class OMERODataBroker:
         else:
             return
 
-    def upload_images(self, files_to_upload, dataset_id=None, hypercube=True, import_original=False):
-        dataset = None
+    def upload_decoded_image(self, upload_image, decoded):
+        file_to_upload, plane = decoded
+        return upload_image(file_to_upload, plane=plane)
+
+    def upload_image_and_notify(self, upload_image, on_uploaded, file_to_upload, **kwargs):
+        image_id = upload_image(file_to_upload, **kwargs)
+
+        if image_id is not None:
+            on_uploaded(file_to_upload, image_id)
+
+        return image_id
+
+    def get_dataset(self, dataset_id):
+        if dataset_id is None:
+            return None
+
         query_service = self.SESSION.getQueryService()
-        image_ids = []
+        query = 'select d from Dataset d where d.id = :did'
+
+        params = sys.Parameters()
+        params.map = {"did": rtypes.rlong(dataset_id)}
+        return query_service.findByQuery(query, params)
 
-        if dataset_id != None:
-            params = dict()
-            params["Data_Type"] = "Dataset"
-            params["IDs"] = str(dataset_id)
-            query = 'select d from Dataset d where d.id = :did'
+    def get_deduplicator(self):
+        if self.DEDUPLICATOR is None:
+            self.DEDUPLICATOR = UploadDeduplicator()
+
+        return self.DEDUPLICATOR
+
+    def project_ids(self, query, params):
+        query_service = self.SESSION.getQueryService()
+        return set(row[0].getValue() for row in query_service.projection(query, params) if row[0] is not None)
+
+    def deduplicate_uploads(self, files_to_upload, dataset_id, hypercube=False):
+        '''
+        Hashes the files to upload (as whole position directories, for
+        hypercubes) and drops those whose content is already in the dataset,
+        either as original files imported to it or as images uploaded before
+        according to the local content index. Content uploaded before to
+        another dataset is linked to this one instead of being sent again.
+        Returns the remaining files, the ids of the linked images and the
+        content hashes of the files, keyed by normalised path.
+        '''
+        deduplicator = self.get_deduplicator()
+        files_to_upload = list(files_to_upload)
 
+        if hypercube == True:
+            content_hashes = deduplicator.hash_positions(files_to_upload)
+        else:
+            content_hashes = deduplicator.hash_files(files_to_upload)
+
+        params = sys.Parameters()
+        params.map = {"did": rtypes.rlong(dataset_id)}
+        dataset_image_ids = self.project_ids(self.DATASET_IMAGE_IDS_QUERY, params)
+
+        server_hashes = set()
+        if hypercube == False:
+            # hypercubes are built from planes, so have no original files
+            server_hashes = self.project_ids(self.DATASET_FILE_HASHES_QUERY, params)
+
+        indexed = deduplicator.lookup(self.HOST, [h.digest for h in content_hashes.values()])
+
+        # indexed images may have been deleted from the server since
+        existing_ids = set()
+        if len(indexed) > 0:
             params = sys.Parameters()
-            params.map = {"did": rtypes.rlong(dataset_id)}
-            dataset = query_service.findByQuery(query, params)
+            params.map = {"ids": rtypes.rlist([rtypes.rlong(image_id) for image_id in set(indexed.values())])}
+            existing_ids = self.project_ids(self.IMAGE_IDS_QUERY, params)
+
+        duplicates, linked_ids, seen = set(), set(), set()
+        skipped, linked, bytes_avoided = 0, 0, 0
+
+        for path in sorted(content_hashes):
+            content_hash = content_hashes[path]
+            image_id = indexed.get(content_hash.digest)
+
+            if content_hash.digest in server_hashes or content_hash.digest in seen or \
+                    image_id in dataset_image_ids:
+                skipped += 1
+            elif image_id in existing_ids:
+                linked += 1
+                linked_ids.add(image_id)
+            else:
+                seen.add(content_hash.digest)
+                continue
+
+            duplicates.add(path)
+            bytes_avoided += content_hash.size
+
+        if len(linked_ids) > 0:
+            links = []
+            for image_id in linked_ids:
+                link = model.DatasetImageLinkI()
+                link.setParent(model.DatasetI(int(dataset_id), False))
+                link.setChild(model.ImageI(image_id, False))
+                links.append(link)
+
+            self.SESSION.getUpdateService().saveArray(links)
 
         if hypercube == True:
-            image_ids = self.IMAGE_PROCESSOR.process_images(self.SESSION, files_to_upload, dataset)
+            # entries may be position directories as well as their files
+            files_to_upload = [f for f in files_to_upload if position_of(f) not in duplicates]
+        else:
+            files_to_upload = [f for f in files_to_upload if os.path.normpath(f) not in duplicates]
+
+        self.LAST_DEDUP_REPORT = DedupReport(len(content_hashes) - len(duplicates), skipped, linked,
+                                             bytes_avoided)
+        BROKER_LOG.info("Deduplication: %s" % str(self.LAST_DEDUP_REPORT))
+        print(': '.join(["Duplicate uploads avoided", "%d skipped, %d linked, %d bytes"
+                         % (skipped, linked, bytes_avoided)]))
+
+        return files_to_upload, sorted(linked_ids), content_hashes
+
+    def index_upload(self, content_hashes, on_uploaded, path, image_id):
+        content_hash = content_hashes.get(os.path.normpath(path))
+
+        if content_hash is not None:
+            try:
+                self.get_deduplicator().record(self.HOST, content_hash, image_id)
+            except sqlite3.Error:
+                BROKER_LOG.exception("Failed to index upload of %s" % path)
+
+        if on_uploaded is not None:
+            on_uploaded(path, image_id)
+
+    def upload_images(self, files_to_upload, dataset_id=None, hypercube=True, import_original=False,
+                      on_uploaded=None, deduplicate=False):
+        '''
+        'on_uploaded', if given, is called with the path and image id of each
+        file (or position directory, for hypercubes) as soon as its upload
+        completes, e.g. to record the progress in an upload journal.
+        With 'deduplicate', content already in the dataset is skipped and
+        content uploaded before elsewhere is linked; the ids of the linked
+        images are included in the result.
+        '''
+        image_ids = []
+        linked_ids = []
+
+        dataset = self.get_dataset(dataset_id)
+
+        if deduplicate == True and dataset is not None:
+            files_to_upload, linked_ids, content_hashes = self.deduplicate_uploads(files_to_upload, dataset_id,
+                                                                                    hypercube)
+            on_uploaded = partial(self.index_upload, content_hashes, on_uploaded)
+
+        if hypercube == True:
+            # custom image processors may not take the progress callback
+            if on_uploaded is not None and \
+                    'on_uploaded' in inspect.signature(self.IMAGE_PROCESSOR.process_images).parameters:
+                image_ids = self.IMAGE_PROCESSOR.process_images(self.SESSION, files_to_upload, dataset,
+                                                                on_uploaded=on_uploaded)
+            else:
+                image_ids = self.IMAGE_PROCESSOR.process_images(self.SESSION, files_to_upload, dataset)
         else:
             if import_original == True:
                 # initialise the upload_image function with the current dataset
@@ -349,11 +705,9 @@ class OMERODataBroker:
                 cli.set_client(conn.c)
 
                 cur_upload_image = partial(self.upload_image, dataset=dataset, import_original=True, cli=cli)
-                pool = ThreadPool(processes=10)
 
-                results = pool.map(cur_upload_image, files_to_upload)
-                pool.terminate()
-                pool.close()
+                # 'files_to_upload' is consumed lazily, so it may be a generator
+                results = list(self.UPLOAD_EXECUTOR.imap_unordered(cur_upload_image, files_to_upload))
 
                 cli.onecmd(["logout"])
 
@@ -366,66 +720,72 @@ class OMERODataBroker:
                 cli.exit()
             else:
                 cur_upload_image = partial(self.upload_image, dataset=dataset, import_original=False)
-                pool = ThreadPool(processes=10)
+                if on_uploaded is not None:
+                    cur_upload_image = partial(self.upload_image_and_notify, cur_upload_image, on_uploaded)
+
+                if self.UPLOAD_EXECUTOR.decode_processes > 0:
+                    # planes are decoded in the decoder processes and uploaded
+                    # by the threads; the results arrive in completion order
+                    cur_upload_image = partial(self.upload_decoded_image, cur_upload_image)
+                    image_ids = list(self.UPLOAD_EXECUTOR.imap_unordered(cur_upload_image, files_to_upload,
+                                                                         decode=decode_image_file))
+                else:
+                    image_ids = list(self.UPLOAD_EXECUTOR.imap_unordered(cur_upload_image, files_to_upload))
 
-                image_ids = pool.map(cur_upload_image, files_to_upload)
-                pool.terminate()
-                pool.close()
+        return linked_ids + image_ids
 
-        return image_ids
+    def upload_images_async(self, files_to_upload, dataset_id=None, max_in_flight=None, on_uploaded=None):
+        '''
+        Returns a coroutine uploading the image files in 'files_to_upload' to
+        the dataset, with up to 'max_in_flight' images (by default, one per
+        spare session of the session pool) being decoded and created at
+        once. Await it from a running event loop (e.g. in a
+        notebook), or run it with asyncio's run_until_complete otherwise.
+        See async_upload.upload_images_async.
+        '''
+        return upload_images_async(self, files_to_upload, dataset_id, max_in_flight, on_uploaded)
 
     def add_description(self, description, object_type, object_id):
         update_service = self.SESSION.getUpdateService()
 
-        om_objects = self.retrieve_objects(object_type, [int(object_id)])
+        om_object = self.load_object(object_type, object_id)
+        if om_object is None:
+            return
+
+        om_object.setDescription(rtypes.rstring(description))
 
-        if len(om_objects) > 0:
-            om_object = om_objects[0]
+        try:
+            om_object = update_service.saveAndReturnObject(om_object)
+        except Exception:
+            if self.OBJECT_CACHE is None:
+                raise
+
+            # the cached version may be stale, so retry with a fresh copy
+            BROKER_LOG.exception("Failed to save cached %s %s, retrying" % (object_type, object_id))
+            self.invalidate_object(object_type, object_id)
+
+            om_object = self.load_object(object_type, object_id)
+            if om_object is None:
+                return
             om_object.setDescription(rtypes.rstring(description))
+            om_object = update_service.saveAndReturnObject(om_object)
 
-            update_service.saveAndReturnObject(om_object)
+        # keep the saved version, so later updates aren't rejected
+        if self.OBJECT_CACHE is not None:
+            self.OBJECT_CACHE.put(object_type, object_id, om_object)
 
     def add_tags(self, tag_values, object_type, object_id):
-        update_service = self.SESSION.getUpdateService()
-
-        for tag_value in tag_values:
-            # tags shouldn't contain commas?
-            split_tag_values = [x.strip() for x in tag_value.split(',')]
-
-            # ignore empty tag strings
-            for split_tag_value in split_tag_values:
-                if len(split_tag_value.strip()) < 1:
-                    continue
+        """
+        Links tags with the given values to the object, reusing the user's
+        existing tags and creating only the missing ones. Returns the tag ids.
+        """
+        # tags shouldn't contain commas?
+        split_tag_values = [x.strip() for tag_value in tag_values for x in tag_value.split(',')]
 
-                # TODO: add check here to see if tag with specific value already exists and link it if so
+        # ignore empty tag strings
+        split_tag_values = [x for x in split_tag_values if len(x) > 0]
 
-                # use stateless update service instead of blitz
-                new_tag_anno = model.TagAnnotationI()
-
-                # TODO: determine what description the tag annotation should have; e.g. date, strain
-
-                # Use 'client' namespace to allow editing in Insight & web
-                new_tag_anno.setTextValue(rtypes.rstring(split_tag_value))
-
-                tag_anno = update_service.saveAndReturnObject(new_tag_anno)
-
-                # do link with parent object
-                om_object = self.retrieve_objects(object_type, [int(object_id)])
-
-                link = None
-
-                if object_type == str(OMERODataType.project):
-                    link = model.ProjectAnnotationLinkI()
-                    link.parent = model.ProjectI(object_id, False)
-                elif object_type == str(OMERODataType.dataset):
-                    link = model.DatasetAnnotationLinkI()
-                    link.parent = model.DatasetI(object_id, False)
-                elif object_type == str(OMERODataType.image):
-                    link = model.ImageAnnotationLinkI()
-                    link.parent = model.ImageI(object_id, False)
-
-                link.child = model.TagAnnotationI(tag_anno.id, False)
-                update_service.saveAndReturnObject(link)
+        return self.TAG_RESOLVER.link_tags(self.SESSION, object_type, object_id, split_tag_values)
 
     # Add key:value pairs: kvps param is array of pairs arrays
     def add_kvps(self, key_value_data, object_type, object_id):
@@ -442,26 +802,10 @@ class OMERODataBroker:
         # key_value_data = [model.NamedValue(i[0], i[1:]) for i in key_value_data]
         new_map_anno.setMapValue(key_value_data)
 
-        update_service = self.SESSION.getUpdateService()
-        map_anno = update_service.saveAndReturnObject(new_map_anno)
-
-        # do link with parent object
-        om_object = self.retrieve_objects(object_type, [int(object_id)])
-
-        link = None
-
-        if object_type == str(OMERODataType.project):
-            link = model.ProjectAnnotationLinkI()
-            link.parent = model.ProjectI(object_id, False)
-        elif object_type == str(OMERODataType.dataset):
-            link = model.DatasetAnnotationLinkI()
-            link.parent = model.DatasetI(object_id, False)
-        elif object_type == str(OMERODataType.image):
-            link = model.ImageAnnotationLinkI()
-            link.parent = model.ImageI(object_id, False)
-
-        link.child = model.MapAnnotationI(map_anno.id, False)
-        update_service.saveAndReturnObject(link)
+        # the new map annotation is saved along with the link to the
+        # unloaded parent object
+        link = new_annotation_link(object_type, object_id, new_map_anno)
+        self.SESSION.getUpdateService().saveAndReturnObject(link)
 
 
 def main():
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import copy
+import logging
+from multiprocessing.pool import ThreadPool
+from omero import sys
+
+PAGED_QUERY_LOG = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 500
+
+
+def result_id(result):
+    # the id of an OMERO object, or the result itself, e.g. a projection row
+    get_id = getattr(result, 'getId', None)
+    if get_id is None:
+        return result
+
+    value = get_id()
+    return getattr(value, 'val', value)
+
+
+def paged_parameters(params, offset, limit):
+    """
+    Returns a copy of the query parameters 'params' (which may be None)
+    limited to the 'limit' results from 'offset'. The rest of the caller's
+    filter (owner, group, times...) is kept, and the caller's parameters are
+    left unchanged.
+    """
+    paged = sys.ParametersI()
+    if params is not None:
+        if getattr(params, 'map', None):
+            paged.map = dict(params.map)
+
+        the_filter = getattr(params, 'theFilter', None)
+        if the_filter is not None:
+            paged.theFilter = copy.copy(the_filter)
+
+        options = getattr(params, 'theOptions', None)
+        if options is not None:
+            paged.theOptions = options
+
+    return paged.page(offset, limit)
+
+
+def iter_pages(fetch_page, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    """
+    Generates the results of a query one page at a time, so only a page of
+    results is held in memory. 'fetch_page(offset, limit)' returns the list
+    of results of a page; the query should be ordered, so pages don't
+    overlap. A page shorter than 'page_size' is the last. A page with the
+    same ids as the one before is taken as a call that ignores the offset
+    and limit, and ends the results rather than repeating them forever.
+    With 'prefetch', the next page is fetched in a background thread while
+    the results of the current one are consumed.
+    """
+    if page_size < 1:
+        raise ValueError('page_size must be at least 1')
+
+    pool = ThreadPool(processes=1) if prefetch else None
+    try:
+        offset = 0
+        page = fetch_page(offset, page_size)
+        previous_ids = None
+
+        while True:
+            page = list(page)
+            page_ids = [result_id(result) for result in page]
+            if len(page) > 0 and page_ids == previous_ids:
+                PAGED_QUERY_LOG.warning("Page at offset %d repeats the previous page, the query is not paged"
+                                        % offset)
+                return
+
+            previous_ids = page_ids
+            offset += len(page)
+            more = len(page) >= page_size
+
+            next_page = None
+            if more and pool is not None:
+                next_page = pool.apply_async(fetch_page, (offset, page_size))
+
+            for result in page:
+                yield result
+
+            if not more:
+                return
+
+            page = next_page.get() if next_page is not None else fetch_page(offset, page_size)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
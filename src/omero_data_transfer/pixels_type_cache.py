@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import threading
+from omero_data_transfer.registry import Registry
+
+
+class PixelsTypeCache(object):
+    """
+    Cache of the PixelsType enumeration of an OMERO server, keyed by value
+    (e.g. 'uint16'). The whole enumeration is loaded with a single query on
+    first use. The enumeration is the same for every user of a server, so
+    for_server() returns a single cache per server, loaded by whichever
+    broker or image processor needs a pixels type first.
+    """
+    PIXELS_TYPES_QUERY = "from PixelsType as p"
+
+    _server_caches = Registry()
+
+    @classmethod
+    def for_server(cls, host, port):
+        return cls._server_caches.get((host, port), cls)
+
+    def __init__(self):
+        self._pixels_types = None
+        self._lock = threading.Lock()
+
+    def get(self, query_service, value):
+        """
+        Returns the omero.model.PixelsType for 'value', or None if the server
+        has no such pixels type.
+        """
+        if self._pixels_types is None:
+            with self._lock:
+                if self._pixels_types is None:
+                    pixels_types = query_service.findAllByQuery(self.PIXELS_TYPES_QUERY, None)
+                    self._pixels_types = dict((p.getValue().getValue(), p) for p in pixels_types)
+
+        return self._pixels_types.get(value)
+
+    def clear(self):
+        with self._lock:
+            self._pixels_types = None
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+
+PlaneStatistics = namedtuple('PlaneStatistics', 'min max histogram')
+
+# bytes of a plane reduced at a time for its min and max, small enough for
+# the block to stay in cache between the two reductions
+STATISTICS_BLOCK_BYTES = 256 * 1024
+
+
+class PlanePipeline(object):
+    """
+    Bounded producer/consumer pipeline for image planes. A pool of
+    'decode_workers' threads decodes planes ahead of the consumer, while at
+    most 'queue_depth' planes are in flight (decoding or ready) at any time.
+    Results are always yielded in the same order as the submitted tasks, so
+    the consumer can write them to the RawPixelsStore in (Z,C,T) order while
+    the next planes are still being decoded.
+
+    @param decode_workers   number of decoder threads; 0 decodes inline
+    @param queue_depth      maximum number of planes held by the pipeline
+    """
+
+    def __init__(self, decode_workers=4, queue_depth=8):
+        if decode_workers < 0:
+            raise ValueError('decode_workers must not be negative')
+        if queue_depth < 1:
+            raise ValueError('queue_depth must be at least 1')
+
+        self.decode_workers = decode_workers
+        self.queue_depth = queue_depth
+
+    def iterate(self, decode, tasks):
+        """
+        Applies 'decode' to every item of 'tasks' and yields the results in
+        task order. Exceptions raised by 'decode' are re-raised in the
+        consumer when the corresponding result is reached.
+        """
+        if self.decode_workers == 0:
+            for task in tasks:
+                yield decode(task)
+            return
+
+        pool = ThreadPool(processes=self.decode_workers)
+        pending = deque()
+
+        try:
+            for task in tasks:
+                # block on the oldest plane once the queue is full, so the
+                # decoders never run more than 'queue_depth' planes ahead
+                if len(pending) >= self.queue_depth:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(decode, (task,)))
+
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            # also reached when the consumer abandons the generator early
+            pool.terminate()
+            pool.join()
+
+
+def iter_row_chunks(plane, chunk_rows):
+    """
+    Yields (y, rows) blocks of at most 'chunk_rows' rows of a plane. The
+    blocks are views, so for memory-mapped planes only the rows of the
+    block being sent are read from the file.
+    """
+    for y in range(0, plane.shape[0], chunk_rows):
+        yield y, plane[y:y + chunk_rows]
+
+
+class PlaneConverter(object):
+    """
+    Converts planes to the dtype of the image being uploaded. Planes that
+    already have the target dtype are passed through without a copy, others
+    are written into a buffer that is allocated once per image and reused
+    for every plane. Blank planes come from a cached, read-only zero plane.
+    Converted planes are only valid until the next call to convert(), so
+    they must be uploaded before the next plane is converted.
+    """
+
+    def __init__(self, dtype, shape):
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self._buffer = None
+        self._blank = None
+
+    def convert(self, plane):
+        if plane.dtype == self.dtype:
+            return plane
+
+        if plane.shape != self.shape:
+            return plane.astype(self.dtype)
+
+        if self._buffer is None:
+            self._buffer = np.empty(self.shape, dtype=self.dtype)
+        np.copyto(self._buffer, plane, casting='unsafe')
+
+        return self._buffer
+
+    def blank(self):
+        if self._blank is None:
+            self._blank = np.zeros(self.shape, dtype=self.dtype)
+            self._blank.flags.writeable = False
+
+        return self._blank
+
+
+def plane_statistics(plane, histogram=False):
+    """
+    Computes the min and max of a plane and, if 'histogram' is set, a
+    histogram of its values. For unsigned integer planes of up to 16 bits the
+    histogram is built in a single bincount pass and the min and max are
+    read off its first and last occupied bins. Otherwise the min and max are
+    reduced a block of rows at a time, so each block is read from memory
+    once for both, and there is no histogram. Either way the plane is only
+    scanned once.
+    """
+    dtype = plane.dtype
+
+    if histogram and dtype.kind == 'u' and dtype.itemsize <= 2 and plane.size > 0:
+        counts = np.bincount(plane.ravel(), minlength=2 ** (8 * dtype.itemsize))
+        occupied = np.flatnonzero(counts)
+
+        return PlaneStatistics(int(occupied[0]), int(occupied[-1]), counts)
+
+    if plane.ndim < 2 or plane.size == 0:
+        return PlaneStatistics(plane.min(), plane.max(), None)
+
+    chunk_rows = max(1, STATISTICS_BLOCK_BYTES // (plane.nbytes // plane.shape[0]))
+    min_values, max_values = [], []
+    for y, rows in iter_row_chunks(plane, chunk_rows):
+        min_values.append(rows.min())
+        max_values.append(rows.max())
+
+    return PlaneStatistics(np.min(min_values), np.max(max_values), None)
+
+
+class ChannelStatistics(object):
+    """
+    Accumulates plane statistics per channel. As in the original upload loop,
+    the global min and max of each channel start at zero, since blank planes
+    are uploaded as zeros. The statistics must be those of the planes as
+    uploaded, i.e. after any conversion to the pixels type.
+    """
+
+    def __init__(self, size_c):
+        self.min_values = [0] * size_c
+        self.max_values = [0] * size_c
+        self.histograms = [None] * size_c
+
+    def add(self, theC, stats):
+        """
+        Adds the statistics of an uploaded plane to channel 'theC'.
+        """
+        self.min_values[theC] = min(self.min_values[theC], stats.min)
+        self.max_values[theC] = max(self.max_values[theC], stats.max)
+
+        if stats.histogram is not None:
+            histogram = self.histograms[theC]
+            if histogram is None:
+                histogram = stats.histogram.copy()
+            elif len(histogram) >= len(stats.histogram):
+                histogram[:len(stats.histogram)] += stats.histogram
+            else:
+                # e.g. 8 and 16 bit planes in the same channel
+                histogram = stats.histogram + np.pad(
+                    histogram, (0, len(stats.histogram) - len(histogram)), 'constant')
+            self.histograms[theC] = histogram
+
+    def window(self, theC, percentiles=None):
+        """
+        Returns the (start, end) rendering window of channel 'theC'. If
+        percentiles are given and a histogram was collected, the window spans
+        those lower and upper percentiles of the channel's values; otherwise
+        it is the channel's global min and max.
+        """
+        histogram = self.histograms[theC]
+
+        if percentiles is None or histogram is None:
+            return self.min_values[theC], self.max_values[theC]
+
+        cumulative = np.cumsum(histogram)
+        lower, upper = percentiles
+        start = np.searchsorted(cumulative, cumulative[-1] * lower / 100.0, side='right')
+        end = np.searchsorted(cumulative, cumulative[-1] * upper / 100.0)
+
+        return int(start), int(end)
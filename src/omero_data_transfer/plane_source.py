@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import six
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import abc
+import struct
+import numpy as np
+from omero_data_transfer.image_probe import read_tiff_tags, tiff_header, TIFF_COMPRESSION, \
+    TIFF_PLANAR_CONFIGURATION, TIFF_STRIP_BYTE_COUNTS, TIFF_STRIP_OFFSETS, TIFF_TILE_WIDTH
+
+
+class PlaneSource(six.with_metaclass(abc.ABCMeta, object)):
+    @abc.abstractmethod
+    def read_plane(self, image_path, rgb_index=None):
+        """
+        Returns the pixels of the image file 'image_path' as a 2D numpy
+        array, or the plane of the RGB channel 'rgb_index' for colour images.
+        """
+        raise NotImplementedError('users must define read_plane to use this base class')
+
+
+class PILPlaneSource(PlaneSource):
+    """
+    Decodes planes with PIL, as omero.util.script_utils.getPlaneFromImage.
+    """
+
+    def read_plane(self, image_path, rgb_index=None):
+        from PIL import Image
+        plane = np.asarray(Image.open(image_path))
+
+        if rgb_index is None:
+            return plane
+        else:
+            return plane[:, :, rgb_index]
+
+
+class MmapTiffPlaneSource(PlaneSource):
+    """
+    Maps the pixel data of uncompressed, strip-organised TIFF files straight
+    into memory and returns a numpy view onto the file, so planes are read
+    by the upload itself without intermediate copies, and the resident
+    memory does not grow with the size of the stack. Any other file (e.g.
+    compressed or tiled TIFFs, PNGs) is read by the 'fallback' source.
+    """
+
+    def __init__(self, fallback=None):
+        if fallback is None:
+            fallback = PILPlaneSource()
+
+        self.fallback = fallback
+
+    def read_plane(self, image_path, rgb_index=None):
+        plane = None
+
+        if image_path.lower().endswith(('.tif', '.tiff')):
+            try:
+                plane = self.map_plane(image_path, rgb_index)
+            except (IOError, ValueError, KeyError, struct.error):
+                plane = None
+
+        if plane is None:
+            return self.fallback.read_plane(image_path, rgb_index)
+
+        return plane
+
+    def map_plane(self, image_path, rgb_index=None):
+        """
+        Returns a memory-mapped view of the plane in 'image_path', or None if
+        its pixel data is not stored as contiguous, uncompressed strips.
+        """
+        with open(image_path, 'rb') as image_file:
+            tiff = read_tiff_tags(image_file)
+
+        if tiff is None:
+            return None
+
+        byte_order, tags = tiff
+        header = tiff_header(tags)
+
+        if header is None or TIFF_TILE_WIDTH in tags or \
+                tags.get(TIFF_COMPRESSION, [1])[0] != 1 or \
+                (header.samples > 1 and tags.get(TIFF_PLANAR_CONFIGURATION, [1])[0] != 1):
+            return None
+
+        offsets = tags[TIFF_STRIP_OFFSETS]
+        byte_counts = tags[TIFF_STRIP_BYTE_COUNTS]
+
+        # the strips must follow each other in the file to form one array
+        for i in range(1, len(offsets)):
+            if offsets[i] != offsets[i - 1] + byte_counts[i - 1]:
+                return None
+
+        shape = (header.height, header.width)
+        if header.samples > 1:
+            shape = shape + (header.samples,)
+
+        dtype = header.dtype.newbyteorder(byte_order)
+        if sum(byte_counts) < int(np.prod(shape)) * dtype.itemsize:
+            return None
+
+        plane = np.memmap(image_path, dtype=dtype, mode='r', offset=offsets[0], shape=shape)
+
+        if rgb_index is not None and header.samples > 1:
+            plane = plane[:, :, rgb_index]
+
+        if not plane.dtype.isnative:
+            # big-endian files have to be swapped into a native copy
+            plane = plane.astype(header.dtype)
+
+        return plane
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+import Ice
+from omero import SessionException
+
+QUERY_LOG = logging.getLogger(__name__)
+
+# errors of a broken session or connection, after which a search is retried
+# on a new session; any other error is raised straight away
+SESSION_ERRORS = (SessionException, Ice.ConnectionLostException, Ice.ConnectionRefusedException,
+                  Ice.TimeoutException, Ice.ObjectNotExistException, Ice.CommunicatorDestroyedException)
+
+
+def unwrap_value(value):
+    # rtypes hold their value in 'val'; lists are made hashable
+    value = getattr(value, 'val', value)
+    if isinstance(value, (list, tuple)):
+        return tuple(unwrap_value(v) for v in value)
+    elif isinstance(value, dict):
+        return tuple(sorted((k, unwrap_value(v)) for k, v in value.items()))
+
+    return value
+
+
+def fields_key(struct):
+    """
+    Returns a hashable key for every field of a sys.Filter or sys.Options.
+    """
+    if struct is None:
+        return None
+
+    try:
+        fields = vars(struct)
+    except TypeError:
+        return repr(struct)
+
+    return tuple(sorted((name, unwrap_value(value)) for name, value in fields.items()))
+
+
+def parameters_key(params):
+    """
+    Returns a hashable key for the query parameters 'params': the values of
+    its map and every field of its filter (paging, owner, group, times...)
+    and options, so only identical queries share a key.
+    """
+    if params is None:
+        return None
+
+    param_map = getattr(params, 'map', None) or {}
+
+    return (tuple(sorted((name, unwrap_value(value)) for name, value in param_map.items())),
+            fields_key(getattr(params, 'theFilter', None)), fields_key(getattr(params, 'theOptions', None)))
+
+
+class QueryContext(object):
+    """
+    Keeps the session of a broker open across searches, so interactive use
+    doesn't log in and out for every query, and memoises the results of
+    identical searches for 'ttl' seconds (0 disables memoisation). At most
+    'max_entries' results are kept, least recently used first out. Results
+    that may have changed on the server are dropped with invalidate(). If a
+    search fails because the session has expired or the connection was
+    lost, the session is replaced and the search retried once.
+    Use as a context manager, or call close() to release the session.
+    """
+    DEFAULT_TTL = 60
+    DEFAULT_MAX_ENTRIES = 256
+
+    def __init__(self, broker, ttl=None, max_entries=None):
+        if ttl is None:
+            ttl = self.DEFAULT_TTL
+        if max_entries is None:
+            max_entries = self.DEFAULT_MAX_ENTRIES
+
+        self.broker = broker
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        with self._lock:
+            if self.broker.SESSION is None:
+                self.broker.open_omero_session()
+
+    def search_by_query(self, query, params):
+        return self.memoised(('query', query, parameters_key(params)),
+                             lambda: self.broker.find_objects_by_query(query, params))
+
+    def search_by_type_field(self, type, field, value, case_sensitive=False):
+        return self.memoised(('type_field', type, field, value, case_sensitive),
+                             lambda: self.broker.find_objects_by_type_field_value(type, field, value, case_sensitive))
+
+    def iter_by_query(self, query, params, page_size=None, prefetch=False):
+        """
+        Generates the results of the query a page at a time on the open
+        session. Paged results are not memoised.
+        """
+        self.open()
+        return self.broker.iter_objects_by_query(query, params, page_size, prefetch)
+
+    def iter_by_type_field(self, type, field, value, case_sensitive=False, page_size=None, prefetch=False):
+        self.open()
+        return self.broker.iter_objects_by_type_field_value(type, field, value, case_sensitive, page_size,
+                                                            prefetch)
+
+    def memoised(self, key, search):
+        with self._lock:
+            now = time.time()
+            if key in self._results:
+                expires, results = self._results[key]
+                if now < expires:
+                    self._results.move_to_end(key)
+                    return list(results)
+
+                del self._results[key]
+
+            results = list(self.run(search))
+
+            if self.ttl > 0:
+                self._results[key] = (now + self.ttl, results)
+                while len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+
+            return list(results)
+
+    def run(self, search):
+        self.open()
+        try:
+            return search()
+        except SESSION_ERRORS:
+            # the session may have expired on the server, e.g. overnight
+            QUERY_LOG.exception("Search failed, retrying on a new session")
+            self.reset()
+            return search()
+
+    def reset(self):
+        with self._lock:
+            try:
+                self.broker.destroy_omero_session()
+            except Exception:
+                # an expired session can't be logged out, but the broker has
+                # dropped it all the same
+                QUERY_LOG.exception("Failed to destroy session")
+
+            self.broker.open_omero_session()
+
+    def invalidate(self, query=None):
+        """
+        Drops the memoised results of the HQL 'query' (or of searches of the
+        type 'query' by field), or all memoised results if 'query' is None.
+        """
+        with self._lock:
+            if query is None:
+                self._results = OrderedDict()
+            else:
+                for key in [k for k in self._results if k[1] == query]:
+                    del self._results[key]
+
+    def close(self):
+        with self._lock:
+            self.invalidate()
+            if self.broker.SESSION is not None:
+                self.broker.close_omero_session()
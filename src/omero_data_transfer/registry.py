@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import threading
+
+
+class Registry(object):
+    """
+    Thread-safe map of keys, e.g. a server address and user name, to the
+    objects shared by every broker with that key, each created on first
+    request.
+    """
+
+    def __init__(self):
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, create, update=None):
+        """
+        Returns the object for 'key', creating it with 'create()' if there is
+        none yet. If there is, 'update(instance)' is called on it first, if
+        given, while the registry is still locked.
+        """
+        with self._lock:
+            instance = self._instances.get(key)
+            if instance is None:
+                instance = create()
+                self._instances[key] = instance
+            elif update is not None:
+                update(instance)
+
+            return instance
+
+    def pop_all(self):
+        """
+        Empties the registry and returns the objects it held.
+        """
+        with self._lock:
+            instances = list(self._instances.values())
+            self._instances.clear()
+
+        return instances
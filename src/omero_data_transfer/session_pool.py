@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import atexit
+import hashlib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from omero_data_transfer.registry import Registry
+
+POOL_LOG = logging.getLogger(__name__)
+
+
+class SessionPool(object):
+    """
+    Bounded pool of logged-in OMERO clients, created on demand by
+    'client_factory' (a callable returning an omero.client with a session)
+    up to 'max_size' clients. Clients are checked out per thread: repeated
+    checkouts from the same thread return the same client until it is
+    checked in as many times, so nested code shares one session while
+    different threads get their own and can make RPCs in parallel.
+
+    A client idle for longer than 'health_check_interval' seconds is pinged
+    before it is handed out again, and replaced if its session has expired.
+    Brokers get their pool from for_server(), so the sessions of a server
+    and login outlive a single upload and are reused by the next one.
+    """
+    DEFAULT_MAX_SIZE = 8
+    DEFAULT_HEALTH_CHECK_INTERVAL = 60
+
+    _server_pools = Registry()
+
+    @classmethod
+    def for_server(cls, host, port, username, password, client_factory, max_size=None):
+        """
+        Returns the pool for the server and credentials, creating it with
+        'client_factory' if there is none yet. Brokers that log in with a
+        different password get a different pool, and a pool grows to the
+        largest 'max_size' requested for it. 'client_factory' is kept for
+        the life of the process, so it shouldn't hold on to a broker.
+        """
+        # only a digest of the password is kept in the key
+        password_digest = hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+        grow = None
+        if max_size is not None:
+            def grow(pool):
+                pool.grow(max_size)
+
+        return cls._server_pools.get((host, port, username, password_digest),
+                                     lambda: cls(client_factory, max_size), grow)
+
+    @classmethod
+    def close_all(cls):
+        for pool in cls._server_pools.pop_all():
+            pool.close()
+
+    def __init__(self, client_factory, max_size=None, health_check_interval=None):
+        if max_size is None:
+            max_size = self.DEFAULT_MAX_SIZE
+        if max_size < 2:
+            # one session is held by the thread driving an upload, so its
+            # workers need at least one more
+            raise ValueError("A session pool needs at least 2 sessions, not %d" % max_size)
+
+        if health_check_interval is None:
+            health_check_interval = self.DEFAULT_HEALTH_CHECK_INTERVAL
+
+        self.client_factory = client_factory
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+
+        self._condition = threading.Condition()
+        # idle clients with the time they were checked in, most recent last
+        self._idle = []
+        self._size = 0
+        # thread id -> [client, checkout count, invalidated]
+        self._checked_out = {}
+        self._closed = False
+
+    def grow(self, max_size):
+        """
+        Raises the number of clients the pool may hold to 'max_size'; a pool
+        never shrinks.
+        """
+        with self._condition:
+            if max_size > self.max_size:
+                self.max_size = max_size
+                self._condition.notify_all()
+
+    def checkout(self):
+        """
+        Returns a logged-in client for the current thread, blocking while
+        all 'max_size' clients are in use by other threads.
+        """
+        thread_id = threading.current_thread().ident
+
+        with self._condition:
+            held = self._checked_out.get(thread_id)
+            if held is not None and not held[2]:
+                held[1] += 1
+                return held[0]
+
+            if held is None:
+                while not self._closed and len(self._idle) == 0 and self._size >= self.max_size:
+                    self._condition.wait()
+
+                if self._closed:
+                    raise ValueError("Session pool is closed")
+
+                if len(self._idle) > 0:
+                    client, idle_since = self._idle.pop()
+                else:
+                    client, idle_since = None, None
+                    # reserve the slot while the client logs in outside the lock
+                    self._size += 1
+
+        if held is not None:
+            # the thread's client was invalidated while other code on the
+            # thread still holds it, so the thread gets a new client in the
+            # same slot
+            client = self.client_factory()
+            with self._condition:
+                dead_client = held[0]
+                held[0] = client
+                held[1] += 1
+                held[2] = False
+
+            self.discard_client(dead_client)
+            return client
+
+        try:
+            if client is not None and time.time() - idle_since > self.health_check_interval \
+                    and not self.is_alive(client):
+                POOL_LOG.info("Replacing expired session")
+                self.discard_client(client)
+                client = None
+
+            if client is None:
+                client = self.client_factory()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._checked_out[thread_id] = [client, 1, False]
+
+        return client
+
+    def checkin(self):
+        """
+        Returns the client checked out by the current thread to the pool,
+        once every checkout from the thread is matched by a checkin. Raises
+        ValueError if the thread has no client checked out.
+        """
+        self.release(invalid=False)
+
+    def invalidate(self):
+        """
+        Checks in the client checked out by the current thread after its
+        session was found to be broken. The client is marked dead rather
+        than returned to the pool: it is closed once every checkout from the
+        thread is matched, and a new checkout from the thread meanwhile gets
+        a new client.
+        """
+        self.release(invalid=True)
+
+    def release(self, invalid):
+        thread_id = threading.current_thread().ident
+
+        with self._condition:
+            held = self._checked_out.get(thread_id)
+            if held is None:
+                raise ValueError("No session is checked out by thread %s" % threading.current_thread().name)
+
+            held[1] -= 1
+            held[2] = held[2] or invalid
+            if held[1] > 0:
+                return
+
+            del self._checked_out[thread_id]
+
+            if self._closed or held[2]:
+                self._size -= 1
+                self._condition.notify()
+                client = held[0]
+            else:
+                self._idle.append((held[0], time.time()))
+                self._condition.notify()
+                return
+
+        self.discard_client(client)
+
+    @contextmanager
+    def client(self):
+        client = self.checkout()
+        try:
+            yield client
+        finally:
+            self.checkin()
+
+    def is_alive(self, client):
+        try:
+            client.getSession().ice_ping()
+            return True
+        except Exception:
+            return False
+
+    def discard_client(self, client):
+        try:
+            client.closeSession()
+        except Exception:
+            POOL_LOG.exception("Failed to close session")
+
+    def close(self):
+        """
+        Closes the sessions of the idle clients; clients still checked out
+        are closed when they are checked in.
+        """
+        with self._condition:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            self._condition.notify_all()
+
+        for client, idle_since in idle:
+            self.discard_client(client)
+
+
+# log the pooled sessions out rather than leaving them to expire on the server
+atexit.register(SessionPool.close_all)
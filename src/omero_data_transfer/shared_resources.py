@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import threading
+from omero_data_transfer.registry import Registry
+
+
+class SharedResourcesCache(object):
+    """
+    Cache of the SharedResources proxy of each OMERO session, and of the id
+    of the repository that new OMERO.tables are created in, so creating a
+    table costs a single newTable call rather than first fetching the proxy
+    and the full list of repository descriptions. Ice proxies can be used by
+    several threads at once, so tables can be created concurrently through
+    one cached handle. The tables repository belongs to the server, so
+    for_server() returns a single cache per server, whose proxies are still
+    kept per session.
+    """
+
+    _server_caches = Registry()
+
+    @classmethod
+    def for_server(cls, host, port):
+        return cls._server_caches.get((host, port), cls)
+
+    def __init__(self):
+        self._resources = {}
+        self._repository_id = None
+        self._lock = threading.Lock()
+
+    def get(self, omero_session):
+        """
+        Returns the SharedResources proxy of 'omero_session' and the id of
+        the repository to create tables in.
+        """
+        with self._lock:
+            resources = self._resources.get(omero_session)
+            if resources is None:
+                resources = omero_session.sharedResources()
+                self._resources[omero_session] = resources
+
+            if self._repository_id is None:
+                self._repository_id = resources.repositories().descriptions[0].getId().getValue()
+
+            return resources, self._repository_id
+
+    def forget(self, omero_session):
+        """
+        Drops the cached proxy of a session that has been closed.
+        """
+        with self._lock:
+            self._resources.pop(omero_session, None)
+
+    def clear(self):
+        with self._lock:
+            self._resources = {}
+            self._repository_id = None
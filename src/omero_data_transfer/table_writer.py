@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from omero import grid
+
+# name, OMERO.tables column kind ('long', 'double', 'bool' or 'string') and,
+# for string columns, maximum size in bytes of a DataFrame column
+ColumnSpec = namedtuple('ColumnSpec', 'name kind size')
+
+COLUMN_CLASSES = {'long': 'LongColumn', 'double': 'DoubleColumn', 'bool': 'BoolColumn',
+                  'string': 'StringColumn'}
+COLUMN_KINDS = dict((column_class, kind) for kind, column_class in COLUMN_CLASSES.items())
+
+
+def numeric_strings(series):
+    """
+    Returns the numeric version of a column of strings (or other objects)
+    whose values all parse as numbers, e.g. the values parsed from
+    acquisition files, or None if any value is not numeric or looks like an
+    identifier with leading zeros.
+    """
+    values = series.dropna()
+    if len(values) == 0:
+        return None
+
+    text = values.astype(str).str.strip()
+    if text.str.match(r'^[+-]?0\d').any():
+        return None
+
+    try:
+        return pd.to_numeric(series.where(series.notna(), np.nan).astype(object))
+    except (ValueError, TypeError):
+        return None
+
+
+def typed_column(series):
+    """
+    Returns the OMERO.tables column kind for a DataFrame column, with the
+    column converted for that kind. Integer columns with missing values are
+    stored as doubles (NaN); string columns whose values are all numbers
+    are stored as numbers; anything else is stored as strings.
+    """
+    dtype = series.dtype
+
+    if pd.api.types.is_bool_dtype(dtype) and not series.isna().any():
+        return 'bool', series
+    elif pd.api.types.is_integer_dtype(dtype):
+        return ('double' if series.isna().any() else 'long'), series
+    elif pd.api.types.is_float_dtype(dtype):
+        return 'double', series
+
+    numeric = numeric_strings(series)
+    if numeric is not None and pd.api.types.is_numeric_dtype(numeric.dtype) \
+            and not pd.api.types.is_bool_dtype(numeric.dtype):
+        return typed_column(numeric)
+
+    return 'string', series
+
+
+def string_values(series):
+    # missing values become empty strings rather than 'nan'
+    return series.astype(object).where(series.notna(), '').astype(str)
+
+
+def typed_dataframe(dataframe):
+    """
+    Returns the ColumnSpecs of the table for 'dataframe', and a DataFrame
+    with its columns converted to match them.
+    """
+    specs = []
+    columns = []
+
+    for i in range(dataframe.shape[1]):
+        kind, series = typed_column(dataframe.iloc[:, i])
+        size = 0
+
+        if kind == 'string':
+            # StringColumn sizes are in bytes of the UTF-8 encoding
+            lengths = string_values(series).str.encode('utf-8').str.len()
+            size = max(int(lengths.max()) if len(lengths) > 0 else 0, 1)
+
+        specs.append(ColumnSpec(str(dataframe.columns[i]), kind, size))
+        columns.append(series.reset_index(drop=True))
+
+    typed = pd.concat(columns, axis=1, ignore_index=True) if len(columns) > 0 else pd.DataFrame()
+    return specs, typed
+
+
+def column_values(series, kind):
+    """
+    Converts a DataFrame column (or a slice of it) to the list of Python
+    values of an OMERO.tables column of the given kind in one vectorised
+    step.
+    """
+    if kind == 'long':
+        return series.to_numpy(dtype=np.int64).tolist()
+    elif kind == 'double':
+        return series.to_numpy(dtype=np.float64, na_value=np.nan).tolist()
+    elif kind == 'bool':
+        return series.to_numpy(dtype=bool).tolist()
+
+    return string_values(series).tolist()
+
+
+class TableWriter(object):
+    """
+    Writes pandas DataFrames to OMERO.tables, keeping the type of each
+    column: integer, floating point and boolean columns are stored as
+    Long, Double and Bool columns rather than strings, so tables are smaller
+    and can be queried by value on the server. Rows are sent in chunks of
+    'chunk_rows', so large tables are not marshalled in one message.
+    """
+
+    def __init__(self, chunk_rows=10000):
+        if chunk_rows < 1:
+            raise ValueError('chunk_rows must be at least 1')
+
+        self.chunk_rows = chunk_rows
+
+    def new_column(self, spec, values):
+        if spec.kind == 'string':
+            return grid.StringColumn(spec.name, '', spec.size, values)
+
+        return getattr(grid, COLUMN_CLASSES[spec.kind])(spec.name, '', values)
+
+    def initialize(self, table, dataframe):
+        """
+        Initialises a new table with the columns of 'dataframe' and writes
+        its rows.
+        """
+        specs, typed = typed_dataframe(dataframe)
+        table.initialize([self.new_column(spec, []) for spec in specs])
+        self.write_rows(table, typed, specs)
+
+    def append(self, table, dataframe):
+        """
+        Appends the rows of 'dataframe' to an existing table. The columns
+        must have the same names as the table's, and are converted to the
+        table's column kinds. String columns keep the size they were created
+        with, so longer values are rejected.
+        """
+        specs = []
+        for header in table.getHeaders():
+            kind = COLUMN_KINDS.get(type(header).__name__.rstrip('I'))
+            if kind is None:
+                raise ValueError("Cannot append to column '%s' of type %s" % (header.name, type(header).__name__))
+            specs.append(ColumnSpec(header.name, kind, getattr(header, 'size', 0)))
+
+        names = [str(name) for name in dataframe.columns]
+        if names != [spec.name for spec in specs]:
+            raise ValueError("Columns %s do not match the table's columns %s" % (names, [spec.name for spec in specs]))
+
+        columns = []
+        for i, spec in enumerate(specs):
+            series = dataframe.iloc[:, i].reset_index(drop=True)
+
+            if spec.kind == 'string':
+                size = string_values(series).str.encode('utf-8').str.len().max()
+                if len(series) > 0 and size > spec.size:
+                    raise ValueError("Values of column '%s' are longer than its size %d" % (spec.name, spec.size))
+            elif not pd.api.types.is_numeric_dtype(series.dtype):
+                series = pd.to_numeric(series)
+
+            columns.append(series)
+
+        if len(columns) > 0:
+            self.write_rows(table, pd.concat(columns, axis=1, ignore_index=True), specs)
+
+    def write_rows(self, table, dataframe, specs):
+        for start in range(0, len(dataframe), self.chunk_rows):
+            chunk = dataframe.iloc[start:start + self.chunk_rows]
+            table.addData([self.new_column(spec, column_values(chunk.iloc[:, i], spec.kind))
+                           for i, spec in enumerate(specs)])
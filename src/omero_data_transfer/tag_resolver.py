@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import logging
+import threading
+from omero import model
+from omero import rtypes
+from omero import sys
+from omero_data_transfer.annotation_batch import ANNOTATION_LINK_TYPES, new_annotation_link
+from omero_data_transfer.registry import Registry
+
+TAG_LOG = logging.getLogger(__name__)
+
+
+class TagResolver(object):
+    """
+    Resolves tag text values to the ids of the user's TagAnnotations, so a
+    tag is created once and then reused rather than duplicated on every
+    upload. All the values of a call are looked up with a single query,
+    only the missing tags are created, with one saveAndReturnArray, and the
+    ids are cached per text value. Where the server already holds several
+    tags with the same text, the oldest is used. Tags are owned by the user,
+    so for_user() returns a resolver per server and user, and a tag created
+    through one broker is reused by the others.
+    """
+    # one row per text value, however many duplicate tags share it
+    TAGS_BY_TEXT_QUERY = "select min(t.id), t.textValue from TagAnnotation t " \
+                         "where t.textValue in (:values) and t.details.owner.id=:uid group by t.textValue"
+    LINKED_ANNOS_QUERY = "select l.child.id from {link} l where l.parent.id=:pid and l.child.id in (:ids)"
+
+    _user_resolvers = Registry()
+
+    @classmethod
+    def for_user(cls, host, port, username):
+        return cls._user_resolvers.get((host, port, username), cls)
+
+    def __init__(self):
+        self._tag_ids = {}
+        self._user_id = None
+        self._lock = threading.Lock()
+
+    def resolve(self, omero_session, tag_values):
+        """
+        Returns a dict mapping each of 'tag_values' to the id of a tag with
+        that text, creating the tags that do not exist yet.
+        """
+        with self._lock:
+            missing = [v for v in set(tag_values) if v not in self._tag_ids]
+
+            if len(missing) > 0:
+                self.lookup_tags(omero_session, missing)
+                missing = [v for v in missing if v not in self._tag_ids]
+
+            if len(missing) > 0:
+                new_tags = [self.new_tag(value) for value in sorted(missing)]
+                saved_tags = omero_session.getUpdateService().saveAndReturnArray(new_tags)
+
+                for tag in saved_tags:
+                    self._tag_ids[tag.getTextValue().getValue()] = tag.getId().getValue()
+
+                TAG_LOG.info("Created %d tags" % len(saved_tags))
+
+            return dict((value, self._tag_ids[value]) for value in tag_values)
+
+    def lookup_tags(self, omero_session, tag_values):
+        if self._user_id is None:
+            self._user_id = omero_session.getAdminService().getEventContext().userId
+
+        params = sys.Parameters()
+        params.map = {"values": rtypes.rlist([rtypes.rstring(value) for value in tag_values]),
+                      "uid": rtypes.rlong(self._user_id)}
+
+        rows = omero_session.getQueryService().projection(self.TAGS_BY_TEXT_QUERY, params)
+        for row in rows:
+            # the oldest of duplicate tags is the one with the lowest id
+            self._tag_ids[row[1].getValue()] = row[0].getValue()
+
+    def link_tags(self, omero_session, object_type, object_id, tag_values):
+        """
+        Links tags with the text values 'tag_values' to the Project, Dataset
+        or Image 'object_id', skipping tags that are linked already, with a
+        single saveArray. Returns the ids of the tags.
+        """
+        if len(tag_values) == 0:
+            return []
+
+        try:
+            return self.save_tag_links(omero_session, object_type, object_id, tag_values)
+        except Exception:
+            # cached tags may have been deleted on the server since
+            TAG_LOG.exception("Failed to link cached tags, retrying with fresh lookups")
+            self.clear()
+            return self.save_tag_links(omero_session, object_type, object_id, tag_values)
+
+    def save_tag_links(self, omero_session, object_type, object_id, tag_values):
+        tag_ids = self.resolve(omero_session, tag_values)
+
+        links = self.new_tag_links(omero_session, object_type, object_id, set(tag_ids.values()))
+        if len(links) > 0:
+            omero_session.getUpdateService().saveArray(links)
+
+        return [tag_ids[value] for value in tag_values]
+
+    def new_tag_links(self, omero_session, object_type, object_id, tag_ids):
+        """
+        Returns new, unsaved links from the object to those of the tags
+        'tag_ids' that are not linked to it yet.
+        """
+        unique_ids = sorted(set(tag_ids))
+        if len(unique_ids) == 0:
+            return []
+
+        params = sys.Parameters()
+        params.map = {"pid": rtypes.rlong(object_id),
+                      "ids": rtypes.rlist([rtypes.rlong(tag_id) for tag_id in unique_ids])}
+
+        query = self.LINKED_ANNOS_QUERY.format(link=ANNOTATION_LINK_TYPES[object_type][2])
+        rows = omero_session.getQueryService().projection(query, params)
+        linked_ids = set(row[0].getValue() for row in rows)
+
+        return [self.new_link(object_type, object_id, tag_id) for tag_id in unique_ids if tag_id not in linked_ids]
+
+    def new_tag(self, tag_value):
+        tag = model.TagAnnotationI()
+        tag.setTextValue(rtypes.rstring(tag_value))
+        return tag
+
+    def new_link(self, object_type, object_id, tag_id):
+        return new_annotation_link(object_type, object_id, model.TagAnnotationI(tag_id, False))
+
+    def clear(self):
+        with self._lock:
+            self._tag_ids = {}
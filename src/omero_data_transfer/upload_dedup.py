@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import os
+import sqlite3
+import threading
+import hashlib
+from collections import namedtuple
+from datetime import datetime as dt
+from multiprocessing.pool import ThreadPool
+from omero_data_transfer.filename_parser import position_files
+
+
+# SHA-1 hex digest and size in bytes of a file or position directory
+ContentHash = namedtuple('ContentHash', 'digest size')
+
+# outcome of the deduplication of one upload
+DedupReport = namedtuple('DedupReport', 'uploads skipped linked bytes_avoided')
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.pyomero_upload', 'content_index.sqlite')
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_sha1(path, block_size=HASH_BLOCK_SIZE):
+    """
+    Streams the file at 'path' through SHA-1, the default hasher of OMERO
+    original files, and returns its ContentHash.
+    """
+    digest = hashlib.sha1()
+    size = 0
+
+    with open(path, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            digest.update(block)
+            size += len(block)
+            block = f.read(block_size)
+
+    return ContentHash(digest.hexdigest(), size)
+
+
+class UploadDeduplicator(object):
+    """
+    Hashes the files of an upload and keeps a local index of the content
+    hashes of the images uploaded to each server, so files (or hypercube
+    positions) uploaded before can be linked or skipped rather than sent
+    again. hashlib releases the GIL on large blocks, so the files are hashed
+    in parallel by a pool of 'hash_workers' threads.
+    """
+
+    def __init__(self, index_path=None, hash_workers=4, block_size=HASH_BLOCK_SIZE):
+        if index_path is None:
+            index_path = DEFAULT_INDEX_PATH
+            if not os.path.isdir(os.path.dirname(index_path)):
+                os.makedirs(os.path.dirname(index_path))
+
+        self.index_path = index_path
+        self.hash_workers = hash_workers
+        self.block_size = block_size
+
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(index_path, check_same_thread=False)
+
+        with self._lock, self.connection:
+            self.connection.execute(
+                "create table if not exists content_hashes ("
+                "server text, digest text, image_id integer, size integer, updated text, "
+                "primary key (server, digest))")
+
+    def hash_files(self, paths):
+        """
+        Returns a dict mapping the normalised path of each file to its
+        ContentHash.
+        """
+        paths = [os.path.normpath(path) for path in paths]
+        read_hash = lambda path: file_sha1(path, self.block_size)
+
+        if self.hash_workers > 1 and len(paths) > 1:
+            pool = ThreadPool(processes=min(self.hash_workers, len(paths)))
+            try:
+                content_hashes = pool.map(read_hash, paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            content_hashes = [read_hash(path) for path in paths]
+
+        return dict(zip(paths, content_hashes))
+
+    def hash_positions(self, paths):
+        """
+        Returns a dict mapping each position directory of the hypercube upload
+        list 'paths' (files, position directories or both) to a ContentHash
+        combining the names and hashes of its files, as uploaded together as
+        one hypercube.
+        """
+        positions = position_files(paths)
+        file_hashes = self.hash_files([path for files in positions.values() for path in files])
+
+        position_hashes = {}
+        for position, files in positions.items():
+            digest = hashlib.sha1()
+            for path in files:
+                digest.update(os.path.basename(path).encode('utf-8'))
+                digest.update(file_hashes[path].digest.encode('ascii'))
+
+            position_hashes[position] = ContentHash(digest.hexdigest(),
+                                                    sum(file_hashes[path].size for path in files))
+
+        return position_hashes
+
+    def lookup(self, server, digests):
+        """
+        Returns a dict mapping those of 'digests' uploaded to 'server' before
+        to the id of the image they were uploaded as.
+        """
+        digests = list(set(digests))
+        found = {}
+
+        with self._lock:
+            # stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(digests), 500):
+                batch = digests[i:i + 500]
+                rows = self.connection.execute(
+                    "select digest, image_id from content_hashes where server = ? and digest in (%s)"
+                    % ','.join('?' * len(batch)), [server] + batch).fetchall()
+                found.update(rows)
+
+        return found
+
+    def record(self, server, content_hash, image_id):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "insert or replace into content_hashes (server, digest, image_id, size, updated) "
+                "values (?, ?, ?, ?, ?)",
+                (server, content_hash.digest, int(image_id), content_hash.size, dt.now().isoformat()))
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from omero_data_transfer.plane_source import PILPlaneSource
+
+
+def decode_image_file(image_path):
+    """
+    Decodes the plane of an image file in a decoder process. Returns an
+    (image_path, plane) pair, where plane is None if the file could not be
+    decoded, so the uploader can check and read it itself.
+    """
+    try:
+        return image_path, PILPlaneSource().read_plane(image_path)
+    except Exception:
+        return image_path, None
+
+
+class UploadExecutor(object):
+    """
+    Runs upload tasks on a pool of 'workers' threads, streaming the results
+    back as tasks complete rather than in submission order. At most
+    'queue_depth' tasks are queued, running or waiting for the consumer at
+    any time, so a lazily scanned directory is only read ahead as fast as
+    the uploads progress. CPU-bound decoding can be moved off the upload
+    threads onto a pool of 'decode_processes' processes, which feeds the
+    decoded planes to the upload threads. The pools are created on first
+    use and reused for later uploads until close() is called.
+
+    @param workers           number of upload threads
+    @param queue_depth       maximum number of tasks in flight; defaults to
+                             twice the number of workers
+    @param decode_processes  number of decoder processes; 0 decodes on the
+                             upload threads
+    """
+
+    def __init__(self, workers=10, queue_depth=None, decode_processes=0):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        if decode_processes < 0:
+            raise ValueError('decode_processes must not be negative')
+        if queue_depth is None:
+            queue_depth = 2 * workers
+        if queue_depth < 1:
+            raise ValueError('queue_depth must be at least 1')
+
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.decode_processes = decode_processes
+
+        self._thread_pool = None
+        self._process_pool = None
+        self._lock = threading.Lock()
+
+    def get_thread_pool(self):
+        with self._lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPool(processes=self.workers)
+
+            return self._thread_pool
+
+    def get_process_pool(self):
+        with self._lock:
+            if self._process_pool is None:
+                # the upload threads and Ice are running by now, and forking
+                # a threaded process can deadlock the child, so the decoders
+                # are started afresh
+                self._process_pool = multiprocessing.get_context('spawn').Pool(processes=self.decode_processes)
+
+            return self._process_pool
+
+    def imap_unordered(self, func, items, decode=None):
+        """
+        Applies 'func' to every item of 'items' on the upload threads and
+        yields the results as they complete. If 'decode' (a picklable,
+        module-level function) is given and decoder processes are enabled,
+        each item is first passed through 'decode' in a decoder process and
+        'func' receives its result instead; otherwise 'func' receives the
+        item itself.
+        """
+        # every item takes a slot until its result is consumed, so pool.imap
+        # cannot drain 'items' into its unbounded task queue
+        slots = threading.BoundedSemaphore(self.queue_depth)
+        stopped = threading.Event()
+
+        def throttled(items):
+            for item in items:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                yield item
+
+        tasks = throttled(items)
+
+        if decode is not None and self.decode_processes > 0:
+            tasks = self.get_process_pool().imap_unordered(decode, tasks)
+
+        try:
+            for result in self.get_thread_pool().imap_unordered(func, tasks):
+                slots.release()
+                yield result
+        finally:
+            # stop feeding the pools if a task failed or the consumer
+            # abandoned the results, waking the feeder if it is waiting
+            stopped.set()
+            try:
+                slots.release()
+            except ValueError:
+                pass
+
+    def close(self):
+        with self._lock:
+            pools = [pool for pool in (self._thread_pool, self._process_pool) if pool is not None]
+            self._thread_pool, self._process_pool = None, None
+
+        for pool in pools:
+            pool.close()
+            pool.join()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import os
+import sqlite3
+import threading
+import hashlib
+from datetime import datetime as dt
+
+
+def file_fingerprint(stat_result):
+    """
+    Cheap fingerprint of a file's contents from its size and modification
+    time, used to detect files that changed since they were uploaded.
+    """
+    return "-".join([str(stat_result.st_size), str(stat_result.st_mtime_ns)])
+
+
+def position_fingerprint(dir_path):
+    """
+    Fingerprint of a position directory, combining the names and file
+    fingerprints of the files it contains.
+    """
+    digest = hashlib.sha1()
+
+    entries = sorted((entry.name, entry.stat()) for entry in os.scandir(dir_path) if entry.is_file())
+    for name, stat_result in entries:
+        digest.update(name.encode('utf-8'))
+        digest.update(file_fingerprint(stat_result).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+class UploadJournal(object):
+    """
+    SQLite journal recording the progress of uploads from a data directory:
+    the dataset created for each dataset name and server, whether its
+    metadata was uploaded, and the image id and fingerprint of every file
+    or position directory uploaded to it. An interrupted upload can then be
+    resumed, skipping the work already completed. The journal is safe to
+    update from several upload threads.
+    """
+    JOURNAL_FILE = '.pyomero_upload_journal.sqlite'
+
+    FILE = 'file'
+    POSITION = 'position'
+    COMPLETED = 'completed'
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(journal_path, check_same_thread=False)
+
+        with self._lock, self.connection:
+            self.connection.execute(
+                "create table if not exists datasets ("
+                "server text, dataset_name text, dataset_id integer, metadata_done integer default 0, "
+                "created text, primary key (server, dataset_name))")
+            self.connection.execute(
+                "create table if not exists entries ("
+                "dataset_id integer, path text, kind text, status text, image_id integer, "
+                "fingerprint text, updated text, primary key (dataset_id, path))")
+
+    @classmethod
+    def for_data_dir(cls, dir_path):
+        return cls(os.path.join(dir_path, cls.JOURNAL_FILE))
+
+    def find_dataset(self, server, dataset_name):
+        """
+        Returns the id of the dataset last created for 'dataset_name' on
+        'server', or None if there is none.
+        """
+        with self._lock:
+            row = self.connection.execute(
+                "select dataset_id from datasets where server = ? and dataset_name = ?",
+                (server, dataset_name)).fetchone()
+
+        return None if row is None else row[0]
+
+    def start_dataset(self, server, dataset_name, dataset_id):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "insert or replace into datasets (server, dataset_name, dataset_id, metadata_done, created) "
+                "values (?, ?, ?, 0, ?)", (server, dataset_name, int(dataset_id), dt.now().isoformat()))
+
+    def forget_dataset(self, dataset_id):
+        """
+        Removes the progress recorded for 'dataset_id', e.g. after the
+        dataset was deleted on the server.
+        """
+        with self._lock, self.connection:
+            self.connection.execute("delete from entries where dataset_id = ?", (int(dataset_id),))
+            self.connection.execute("delete from datasets where dataset_id = ?", (int(dataset_id),))
+
+    def is_metadata_done(self, dataset_id):
+        with self._lock:
+            row = self.connection.execute(
+                "select metadata_done from datasets where dataset_id = ?", (int(dataset_id),)).fetchone()
+
+        return row is not None and row[0] == 1
+
+    def mark_metadata_done(self, dataset_id):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "update datasets set metadata_done = 1 where dataset_id = ?", (int(dataset_id),))
+
+    def record(self, dataset_id, path, kind, image_id, fingerprint, status=COMPLETED):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "insert or replace into entries (dataset_id, path, kind, status, image_id, fingerprint, updated) "
+                "values (?, ?, ?, ?, ?, ?, ?)",
+                (int(dataset_id), path, kind, status, image_id, fingerprint, dt.now().isoformat()))
+
+    def completed(self, dataset_id, kind):
+        """
+        Returns a dict mapping the paths of the completed entries of 'kind'
+        for 'dataset_id' to their fingerprints.
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                "select path, fingerprint from entries where dataset_id = ? and kind = ? and status = ?",
+                (int(dataset_id), kind, self.COMPLETED)).fetchall()
+
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
@@ -11,20 +11,27 @@ from omero_data_transfer.data_transfer_manager import DataTransferManager
 from omero_data_transfer.omero_data_broker import OMERODataBroker
 from omero_metadata_parser.aggregate_metadata import MetadataAggregator
 from omero_data_transfer.default_image_processor import DefaultImageProcessor
+from omero_data_transfer.query_context import QueryContext
 
 
 class PyOmeroUploader:
 
-    def __init__(self, username, password, server, port=4064):
+    def __init__(self, username, password, server, port=4064, search_ttl=QueryContext.DEFAULT_TTL):
         self.USERNAME = username
         self.PASSWORD = password
         self.SERVER = server
         self.PORT = port
 
+        # searches share a warm session, and identical searches within
+        # 'search_ttl' seconds are answered from memory (0 disables this)
+        self.SEARCH_TTL = search_ttl
+        self.QUERY_CONTEXT = None
+
     # initialise broker and manager with the given parameters and start the upload process 
     def launch_upload(self, dataset_name, data_path, hypercube=False,
                       parser_class=MetadataAggregator, image_processor_impl=DefaultImageProcessor,
-                      include_provenance_kvps=True, ignore_metadata=False):
+                      include_provenance_kvps=True, ignore_metadata=False, resume=False, deduplicate=False,
+                      upload_workers=10, queue_depth=None, decode_processes=0):
 
         # override `parser_class` for custom metadata extractor implementations
         if parser_class is None:
@@ -35,14 +42,23 @@ class PyOmeroUploader:
             from omero_data_transfer.default_image_processor import DefaultImageProcessor as image_processor_impl
 
         # conn_settings = config['omero_conn']
+        # 'upload_workers' threads upload images, with at most 'queue_depth'
+        # files in flight; 'decode_processes' > 0 decodes them in processes
         broker = OMERODataBroker(username=self.USERNAME, password=self.PASSWORD, server=self.SERVER, port=self.PORT,
-                                 image_processor=image_processor_impl())
+                                 image_processor=image_processor_impl(), upload_workers=upload_workers,
+                                 upload_queue_depth=queue_depth, decode_processes=decode_processes)
         # broker.open_omero_session()
 
         data_transfer_manager = DataTransferManager(parser_class=parser_class)
-        results = data_transfer_manager.upload_data_dir(broker, dataset_name, data_path, hypercube=hypercube,
-                                                        include_provenance_kvps=include_provenance_kvps,
-                                                        ignore_metadata=ignore_metadata)
+        try:
+            results = data_transfer_manager.upload_data_dir(broker, dataset_name, data_path, hypercube=hypercube,
+                                                            include_provenance_kvps=include_provenance_kvps,
+                                                            ignore_metadata=ignore_metadata, resume=resume,
+                                                            deduplicate=deduplicate)
+        finally:
+            # stop the upload threads and decoder processes even if the
+            # upload failed
+            broker.UPLOAD_EXECUTOR.close()
 
         # upload_metadata(broker, dir_path)
         # broker.close_omero_session()
@@ -76,22 +92,46 @@ class PyOmeroUploader:
         broker.open_omero_session()
         return broker
 
-    def search_by_query(self, query, params):
+    def query_context(self, ttl=None):
+        """
+        Returns a new QueryContext with its own broker, which keeps a session
+        open for its searches until closed; use it in a 'with' statement.
+        """
+        if ttl is None:
+            ttl = self.SEARCH_TTL
+
         broker = OMERODataBroker(username=self.USERNAME, password=self.PASSWORD, server=self.SERVER, port=self.PORT,
                                  image_processor=DefaultImageProcessor())
+        return QueryContext(broker, ttl)
 
-        broker.open_omero_session()
-        objects = broker.find_objects_by_query(query, params)
-        broker.close_omero_session()
+    def get_query_context(self):
+        # the context shared by the search methods is created on first use
+        if self.QUERY_CONTEXT is None:
+            self.QUERY_CONTEXT = self.query_context()
 
-        return objects
+        return self.QUERY_CONTEXT
 
-    def search_by_type_field(self, type, field, value, case_sensitive=False):
-        broker = OMERODataBroker(username=self.USERNAME, password=self.PASSWORD, server=self.SERVER, port=self.PORT,
-                                 image_processor=DefaultImageProcessor())
+    # with a 'page_size', returns a generator of the results, fetched
+    # 'page_size' at a time and not memoised
+    def search_by_query(self, query, params, page_size=None, prefetch=False):
+        if page_size is not None:
+            return self.get_query_context().iter_by_query(query, params, page_size, prefetch)
 
-        broker.open_omero_session()
-        objects = broker.find_objects_by_type_field_value(type, field, value, case_sensitive)
-        broker.close_omero_session()
+        return self.get_query_context().search_by_query(query, params)
+
+    def search_by_type_field(self, type, field, value, case_sensitive=False, page_size=None, prefetch=False):
+        if page_size is not None:
+            return self.get_query_context().iter_by_type_field(type, field, value, case_sensitive, page_size,
+                                                               prefetch)
+
+        return self.get_query_context().search_by_type_field(type, field, value, case_sensitive)
+
+    # drops memoised search results, e.g. after changing objects on the server
+    def invalidate_searches(self, query=None):
+        if self.QUERY_CONTEXT is not None:
+            self.QUERY_CONTEXT.invalidate(query)
 
-        return objects
+    def close(self):
+        if self.QUERY_CONTEXT is not None:
+            self.QUERY_CONTEXT.close()
+            self.QUERY_CONTEXT = None
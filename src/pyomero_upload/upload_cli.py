@@ -72,6 +72,30 @@ parser.add_argument('-x', '--ignore-metadata', action='store_true',
                     dest='ignore_metadata', required=False, default=False,
                     help="instructs the uploader to ignore metadata parsing and only upload images")
 
+parser.add_argument('-r', '--resume', action='store_true',
+                    dest='resume', required=False, default=False,
+                    help="resumes an interrupted upload of the data directory to the same dataset, skipping the "
+                         "files already uploaded")
+
+parser.add_argument('-e', '--deduplicate', action='store_true',
+                    dest='deduplicate', required=False, default=False,
+                    help="skips files whose content was uploaded before, linking the existing images to the "
+                         "dataset instead of sending them again")
+
+parser.add_argument('-w', '--workers', dest='upload_workers',
+                    type=int, required=False, default=10, metavar='workers',
+                    help="specifies the number of images uploaded in parallel (default is 10)")
+
+parser.add_argument('-q', '--queue-depth', dest='queue_depth',
+                    type=int, required=False, default=None, metavar='queue-depth',
+                    help="specifies the maximum number of files read ahead of the uploads (default is twice the "
+                         "number of workers)")
+
+parser.add_argument('-j', '--decode-processes', dest='decode_processes',
+                    type=int, required=False, default=0, metavar='decode-processes',
+                    help="specifies the number of processes decoding images for upload (default is 0, decoding "
+                         "in the upload threads)")
+
 args = parser.parse_args()
 data_path = args.data_path
 dataset_name = args.dataset_name
@@ -177,4 +201,6 @@ if data_path is not None and dataset_name is not None:
     # start upload process
     uploader.launch_upload(dataset_name=dataset_name, data_path=data_path, hypercube=hypercube,
                            parser_class=parser_class, image_processor_impl=image_processor_impl,
-                           include_provenance_kvps=include_provenance_kvps, ignore_metadata=ignore_metadata)
+                           include_provenance_kvps=include_provenance_kvps, ignore_metadata=ignore_metadata,
+                           resume=args.resume, deduplicate=args.deduplicate, upload_workers=args.upload_workers,
+                           queue_depth=args.queue_depth, decode_processes=args.decode_processes)
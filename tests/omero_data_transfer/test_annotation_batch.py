@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import threading
+import time
+import pytest
+from omero_data_transfer.annotation_batch import AnnotationBatch
+
+
+class FakeDataset(object):
+    def setDescription(self, description):
+        self.description = description
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.saves = []
+        self.fail = False
+        self.found = []
+        self.dataset = FakeDataset()
+
+    def getQueryService(self):
+        return self
+
+    def getUpdateService(self):
+        return self
+
+    def find(self, object_type, object_id):
+        self.found.append((object_type, object_id))
+        return self.dataset
+
+    def saveArray(self, objects):
+        if self.fail:
+            raise IOError('connection lost')
+        self.saves.append(list(objects))
+
+
+class FakeTagResolver(object):
+    def __init__(self):
+        self.resolved = []
+
+    def resolve(self, omero_session, tag_values):
+        self.resolved.append(list(tag_values))
+        return dict((value, i) for i, value in enumerate(sorted(set(tag_values))))
+
+    def new_tag_links(self, omero_session, object_type, object_id, tag_ids):
+        return [('tag link', tag_id) for tag_id in sorted(tag_ids)]
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.SESSION = FakeSession()
+        self.TAG_RESOLVER = FakeTagResolver()
+        self.lock = threading.Lock()
+        self.writing = 0
+        self.max_writing = 0
+        self.invalidated = []
+        self.deleted = []
+
+    def load_object(self, object_type, object_id):
+        return self.SESSION.getQueryService().find(object_type, object_id)
+
+    def invalidate_object(self, object_type, object_id):
+        self.invalidated.append((object_type, object_id))
+
+    def write_table(self, dataframe, table_name, omero_session=None):
+        assert omero_session is self.SESSION
+        with self.lock:
+            self.writing += 1
+            self.max_writing = max(self.max_writing, self.writing)
+        time.sleep(0.05)
+        with self.lock:
+            self.writing -= 1
+        if table_name == 'bad table':
+            raise ValueError('unsupported column type')
+        return dataframe
+
+    def delete_table(self, table_file_id, omero_session=None):
+        assert omero_session is self.SESSION
+        self.deleted.append(table_file_id)
+
+
+def test_batch_saves_everything_at_once():
+    broker = FakeBroker()
+    batch = AnnotationBatch(broker, 'Dataset', '51')
+
+    batch.set_description('Batgirl experiment')
+    batch.add_tags(['Batgirl, Htb2', ' ', 'Myo1'])
+    batch.add_kvps([['Strain', 'Htb2'], ['Uploaded With', 'pyOmeroUpload']])
+    for i in range(4):
+        batch.add_table(100 + i, 'table%d' % i)
+
+    assert batch.commit() == [100, 101, 102, 103]
+
+    # the tables are written in parallel
+    assert broker.max_writing > 1
+    assert broker.TAG_RESOLVER.resolved == [['Batgirl', 'Htb2', 'Myo1']]
+    assert broker.SESSION.found == [('Dataset', 51)]
+    assert broker.invalidated == [('Dataset', 51)]
+    assert hasattr(broker.SESSION.dataset, 'description')
+
+    # description, 3 tag links, 1 map annotation link and 4 table links
+    assert len(broker.SESSION.saves) == 1
+    saved = broker.SESSION.saves[0]
+    assert len(saved) == 1 + 3 + 1 + 4
+    assert saved[0] is broker.SESSION.dataset
+    assert saved[1:4] == [('tag link', 0), ('tag link', 1), ('tag link', 2)]
+
+
+def test_empty_batch_saves_nothing():
+    broker = FakeBroker()
+    assert AnnotationBatch(broker, 'Dataset', 51).commit() == []
+    assert broker.SESSION.saves == []
+
+
+def test_failed_save_deletes_the_tables():
+    broker = FakeBroker()
+    broker.SESSION.fail = True
+    batch = AnnotationBatch(broker, 'Dataset', 51)
+    batch.add_kvps([['Strain', 'Htb2']])
+    for i in range(3):
+        batch.add_table(100 + i, 'table%d' % i)
+
+    with pytest.raises(IOError):
+        batch.commit()
+    assert sorted(broker.deleted) == [100, 101, 102]
+
+    # nor are the other tables kept if one of them fails
+    broker = FakeBroker()
+    batch = AnnotationBatch(broker, 'Dataset', 51)
+    batch.add_table(100, 'table0')
+    batch.add_table(101, 'bad table')
+    batch.add_table(102, 'table2')
+
+    with pytest.raises(ValueError):
+        batch.commit()
+    assert sorted(broker.deleted) == [100, 102]
+    assert broker.SESSION.saves == []
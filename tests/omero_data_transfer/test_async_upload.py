@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import asyncio
+import threading
+import time
+import pytest
+from omero_data_transfer.async_upload import upload_images_async
+
+
+class FakeSessionPool(object):
+    max_size = 5
+
+
+class FakeBroker(object):
+    SESSION_POOL = FakeSessionPool()
+
+    def __init__(self, delay=0.02, fail_on=None):
+        self.delay = delay
+        self.fail_on = fail_on
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.uploaded = []
+
+    def get_dataset(self, dataset_id):
+        return 'dataset %s' % dataset_id
+
+    def upload_image(self, file_to_upload, dataset, import_original=True):
+        assert dataset == 'dataset 1' and import_original == False
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        time.sleep(self.delay)
+
+        with self.lock:
+            self.running -= 1
+            self.uploaded.append(file_to_upload)
+
+        if file_to_upload == self.fail_on:
+            raise IOError('upload failed')
+        if file_to_upload.endswith('.txt'):
+            return None
+        return int(file_to_upload[4:7])
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+def test_uploads_are_capped_and_ordered():
+    broker = FakeBroker()
+    files = ['img_%03d.png' % i for i in range(40)] + ['notes.txt']
+    reported = []
+
+    start = time.time()
+    image_ids = run(upload_images_async(broker, iter(files), 1, max_in_flight=8,
+                                        on_uploaded=lambda path, image_id: reported.append(image_id)))
+    elapsed = time.time() - start
+
+    assert image_ids == list(range(40)) + [None]
+    assert sorted(reported) == list(range(40))
+    assert broker.max_running <= 8
+    # 41 uploads of 20ms, 8 at a time
+    assert elapsed < 41 * 0.02 / 2
+
+
+def test_failed_upload_stops_the_rest():
+    broker = FakeBroker(fail_on='img_002.png')
+    files = ['img_%03d.png' % i for i in range(200)]
+
+    with pytest.raises(IOError):
+        run(upload_images_async(broker, files, 1, max_in_flight=4))
+
+    time.sleep(0.1)
+    assert len(broker.uploaded) < 20
+
+
+def test_cancellation_starts_no_further_uploads():
+    broker = FakeBroker(delay=0.05)
+    files = ['img_%03d.png' % i for i in range(200)]
+
+    async def cancel_soon():
+        upload = asyncio.ensure_future(upload_images_async(broker, files, 1, max_in_flight=4))
+        await asyncio.sleep(0.12)
+        upload.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await upload
+
+    run(cancel_soon())
+    time.sleep(0.1)
+    uploaded = len(broker.uploaded)
+    assert uploaded < 20
+
+    time.sleep(0.1)
+    assert len(broker.uploaded) == uploaded
+
+
+def test_default_cap_and_reading_off_the_loop():
+    broker = FakeBroker()
+    loop_thread = []
+    reading_threads = set()
+
+    def scan():
+        for i in range(20):
+            reading_threads.add(threading.current_thread())
+            yield 'img_%03d.png' % i
+
+    async def upload():
+        loop_thread.append(threading.current_thread())
+        return await upload_images_async(broker, scan(), 1)
+
+    assert run(upload()) == list(range(20))
+    # one upload per pooled session, apart from the caller's
+    assert broker.max_running == 4
+    assert loop_thread[0] not in reading_threads
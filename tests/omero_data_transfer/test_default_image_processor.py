@@ -14,6 +14,7 @@ import pytest
 import os
 import yaml
 import glob
+import time
 import omero.util.script_utils as script_utils
 from omero_data_transfer.omero_data_broker import OMERODataBroker
 from omero_data_transfer.default_image_processor import DefaultImageProcessor as image_processor_impl
@@ -76,4 +77,348 @@ def test_get_pixels_type():
 
                 plane = script_utils.getPlaneFromImage(fullpath)
 
-                pixelsType = image_processor.get_pixels_type(plane, query_service, convert_to_uint16)
\ No newline at end of file
+                pixelsType = image_processor.get_pixels_type(plane, query_service, convert_to_uint16)
+
+class FakePixelsService(object):
+    def __init__(self, delay=0.05):
+        self.delay = delay
+
+    def createImage(self, path):
+        time.sleep(self.delay)
+        if path.endswith('pos003'):
+            raise IOError('corrupt position')
+        return int(path[-3:])
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.pixels_service = FakePixelsService()
+
+    def getQueryService(self):
+        return object()
+
+    def getUpdateService(self):
+        return object()
+
+    def getPixelsService(self):
+        return self.pixels_service
+
+
+class FakePositionProcessor(image_processor_impl):
+    def upload_dir_as_images(self, omero_session, query_service, update_service,
+                             pixels_service, path, dataset=None, convert_to_uint16=False):
+        return pixels_service.createImage(path)
+
+
+def test_process_images_concurrent_positions(tmp_path):
+    file_paths = []
+    for pos in range(8, 0, -1):
+        pos_dir = tmp_path / ('pos%03d' % pos)
+        pos_dir.mkdir()
+        file_paths.append(str(pos_dir / 'img_000001_GFP_001.png'))
+
+    serial_processor = FakePositionProcessor(position_workers=1)
+    start = time.time()
+    serial_ids = serial_processor.process_images(FakeSession(), file_paths)
+    serial_time = time.time() - start
+
+    parallel_processor = FakePositionProcessor(position_workers=8)
+    start = time.time()
+    parallel_ids = parallel_processor.process_images(FakeSession(), file_paths)
+    parallel_time = time.time() - start
+
+    # results come back in position order and the failing position is skipped
+    assert serial_ids == [1, 2, 4, 5, 6, 7, 8]
+    assert parallel_ids == serial_ids
+    assert parallel_time < serial_time / 2
+
+
+def test_process_images_only_listed_positions(tmp_path):
+    file_paths = []
+    for pos in range(1, 6):
+        pos_dir = tmp_path / ('pos%03d' % pos)
+        pos_dir.mkdir()
+        if pos in (2, 3, 5):
+            file_paths.append(str(pos_dir / 'img_000001_GFP_001.png'))
+
+    uploaded = []
+    processor = FakePositionProcessor(position_workers=4)
+    image_ids = processor.process_images(FakeSession(), file_paths,
+                                         on_uploaded=lambda path, image_id: uploaded.append(path))
+
+    # positions without files (e.g. already uploaded) are not processed, and
+    # the failing position is not reported as uploaded
+    assert image_ids == [2, 5]
+    assert sorted(uploaded) == [str(tmp_path / 'pos002'), str(tmp_path / 'pos005')]
+    assert processor.process_images(FakeSession(), []) == []
+
+    # position directories can be listed instead of their files
+    dir_paths = [os.path.dirname(path) for path in file_paths]
+    assert processor.process_images(FakeSession(), dir_paths) == [2, 5]
+    assert processor.process_images(FakeSession(), dir_paths[:1] + file_paths[2:]) == [2, 5]
+
+
+def test_process_images_positions_by_number(tmp_path):
+    file_paths = []
+    for pos in ('pos010', 'pos001', 'pos0002'):
+        pos_dir = tmp_path / pos
+        pos_dir.mkdir()
+        file_paths.append(str(pos_dir / 'img_000001_GFP_001.png'))
+
+    processor = FakePositionProcessor(position_workers=2)
+    # positions are ordered by number, whatever the digit count
+    assert processor.process_images(FakeSession(), file_paths) == [1, 2, 10]
+
+    # a resumed upload with a single position left
+    uploaded = []
+    assert processor.process_images(FakeSession(), file_paths[:1],
+                                    on_uploaded=lambda path, image_id: uploaded.append(path)) == [10]
+    assert uploaded == [str(tmp_path / 'pos010')]
+
+
+class FakeRawPixelsStore(object):
+    def __init__(self):
+        self.planes, self.tiles = [], []
+
+    def setPixelsId(self, pixels_id, bypass):
+        self.pixels_id = pixels_id
+
+    def close(self):
+        pass
+
+    def setPlane(self, buf, z, c, t):
+        self.planes.append((buf, z, c, t))
+
+    def setTile(self, buf, z, c, t, x, y, w, h):
+        self.tiles.append((buf, z, c, t, x, y, w, h))
+
+
+def test_upload_plane_in_row_chunks():
+    import numpy as np
+    plane = np.arange(50, dtype=np.uint16).reshape(5, 10)
+
+    store = FakeRawPixelsStore()
+    image_processor_impl(chunk_rows=2).upload_plane(store, plane, 1, 2, 3)
+
+    assert store.planes == []
+    assert [tile[1:] for tile in store.tiles] == [(1, 2, 3, 0, 0, 10, 2), (1, 2, 3, 0, 2, 10, 2),
+                                                  (1, 2, 3, 0, 4, 10, 1)]
+    assert b''.join(tile[0] for tile in store.tiles) == plane.astype('>u2').tobytes()
+
+    store = FakeRawPixelsStore()
+    image_processor_impl().upload_plane(store, plane, 1, 2, 3)
+    assert store.tiles == [] and len(store.planes) == 1
+
+
+class FakeRenderingEngine(object):
+    def __init__(self, calls):
+        self.calls = calls
+        self.rendering_defs = set()
+
+    def lookupPixels(self, pixels_id):
+        self.pixels_id = pixels_id
+
+    def lookupRenderingDef(self, pixels_id):
+        return pixels_id in self.rendering_defs
+
+    def resetDefaults(self):
+        self.rendering_defs.add(self.pixels_id)
+
+    def load(self):
+        pass
+
+    def setChannelWindow(self, c, start, end):
+        self.calls.append(('window', self.pixels_id, c, start, end))
+
+    def setRGBA(self, c, red, green, blue, alpha):
+        self.calls.append(('rgba', self.pixels_id, c))
+
+    def saveCurrentSettings(self):
+        self.calls.append(('save', self.pixels_id))
+
+    def close(self):
+        self.calls.append(('close',))
+
+
+class FakeRenderingSession(object):
+    def __init__(self):
+        self.calls = []
+
+    def createRenderingEngine(self):
+        self.calls.append(('create',))
+        return FakeRenderingEngine(self.calls)
+
+
+def test_deferred_rendering_settings_use_one_engine():
+    session = FakeRenderingSession()
+    image_processor = image_processor_impl(defer_rendering=True)
+    image_processor.pending_rendering = [(1, [(0, 10), (5, 20)], {1: (0, 255, 0, 255)}),
+                                         (2, [(0, 30)], {})]
+
+    assert image_processor.flush_rendering_settings(session) == 2
+    assert session.calls == [('create',),
+                             ('window', 1, 0, 0.0, 10.0), ('rgba', 1, 0),
+                             ('window', 1, 1, 5.0, 20.0), ('rgba', 1, 1), ('save', 1),
+                             ('window', 2, 0, 0.0, 30.0), ('rgba', 2, 0), ('save', 2),
+                             ('close',)]
+    assert image_processor.flush_rendering_settings(session) == 0
+
+
+class FakeRLong(object):
+    def __init__(self, val):
+        self.val = val
+
+
+class FakeUploadServices(FakeRenderingSession):
+    def __init__(self):
+        FakeRenderingSession.__init__(self)
+        self.store = FakeRawPixelsStore()
+        self.min_max = {}
+
+    def createRawPixelsStore(self):
+        return self.store
+
+    def projection(self, query, params):
+        return [[FakeRLong(7)]]
+
+    def setChannelGlobalMinMax(self, pixels_id, c, min_value, max_value):
+        self.min_max[c] = (min_value, max_value)
+
+
+def test_upload_image_pixels_sparse(tmp_path):
+    import numpy as np
+    from PIL import Image
+
+    image_map = {}
+    for t in (1, 2, 3):
+        image_path = str(tmp_path / ('exp_%06d_GFP_001.png' % t))
+        Image.fromarray(np.full((3, 4), t * 10, dtype=np.uint8)).save(image_path)
+        image_map[(1, 'GFP', t)] = image_path
+    # the DIC channel was only acquired at the first timepoint
+    image_map[(1, 'DIC', 1)] = image_map[(1, 'GFP', 1)]
+
+    services = FakeUploadServices()
+    image_processor = image_processor_impl(sparse_planes=True)
+    pixels_id = image_processor.upload_image_pixels(
+        1, services, services, services, False, image_map, 2, 1, 3, 4, 3,
+        ['GFP', 'DIC'], {}, False, np.dtype(np.uint8))
+
+    # the last plane is written even though it is blank
+    assert image_processor.skipped_planes[pixels_id] == [(0, 1, 1)]
+    assert sorted(plane[1:] for plane in services.store.planes) == \
+        [(0, 0, 0), (0, 0, 1), (0, 0, 2), (0, 1, 0), (0, 1, 2)]
+    assert services.min_max == {0: (0.0, 30.0), 1: (0.0, 10.0)}
+
+
+class FakePlaneSource(object):
+    def __init__(self, planes):
+        self.planes = planes
+
+    def read_plane(self, image_path, channel=None):
+        return self.planes[image_path]
+
+
+def test_upload_image_pixels_min_max_of_converted_planes():
+    import numpy as np
+
+    # 32-bit planes, as decoded from 16-bit PNGs, with values that wrap
+    # when converted to uint16
+    planes = {'t1': np.array([[5, 65536 + 3, 60000]], dtype=np.int32),
+              't2': np.array([[65536 + 1, 100, 200]], dtype=np.int32)}
+    image_map = {(1, 'GFP', 1): 't1', (1, 'GFP', 2): 't2'}
+
+    services = FakeUploadServices()
+    image_processor = image_processor_impl(plane_source=FakePlaneSource(planes))
+    image_processor.upload_image_pixels(
+        1, services, services, services, False, image_map, 1, 1, 2, 3, 1,
+        ['GFP'], {}, True, np.dtype(np.int32))
+
+    uploaded = [np.frombuffer(plane[0], dtype='>u2') for plane in sorted(services.store.planes,
+                                                                         key=lambda plane: plane[3])]
+    assert [list(plane) for plane in uploaded] == [[5, 3, 60000], [1, 100, 200]]
+    assert services.min_max == {0: (0.0, 60000.0)}
+
+
+class FakeLogicalChannel(object):
+    def setName(self, name):
+        self.name = name
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.logical_channel = FakeLogicalChannel()
+
+    def getLogicalChannel(self):
+        return self.logical_channel
+
+
+class FakePixels(object):
+    def __init__(self, size_c):
+        self.channels = [FakeChannel() for c in range(size_c)]
+
+    def iterateChannels(self):
+        return iter(self.channels)
+
+
+class FakeImageId(FakeRLong):
+    def getValue(self):
+        return self.val
+
+
+class FakeHypercubeServices(FakeUploadServices):
+    def __init__(self):
+        FakeUploadServices.__init__(self)
+        self.images = []
+        self.saves = []
+
+    def createImage(self, size_x, size_y, size_z, size_t, channel_list, pixels_type, name, description):
+        self.images.append((size_x, size_y, size_z, size_t, len(channel_list), pixels_type, name))
+        return FakeImageId(5)
+
+    def retrievePixDescription(self, pixels_id):
+        # as many channels as the image was created with
+        self.pixels = FakePixels(self.images[-1][4])
+        return self.pixels
+
+    def saveArray(self, objects):
+        self.saves.append(list(objects))
+
+
+class FakePixelsTypeCache(object):
+    def get(self, query_service, value):
+        return value
+
+
+class FakeDataset(object):
+    def __init__(self, dataset_id):
+        self.id = FakeRLong(dataset_id)
+
+
+def test_upload_dir_as_images_saves_channels_and_link_at_once(tmp_path):
+    import numpy as np
+    from PIL import Image
+
+    pos_dir = tmp_path / 'pos001'
+    pos_dir.mkdir()
+    for channel in ('GFP', 'DIC'):
+        for t in (1, 2):
+            image_path = str(pos_dir / ('exp_%06d_%s_001.png' % (t, channel)))
+            Image.fromarray(np.full((3, 4), t, dtype=np.uint8)).save(image_path)
+
+    services = FakeHypercubeServices()
+    image_processor = image_processor_impl(decode_workers=0)
+    image_processor.pixels_type_cache = FakePixelsTypeCache()
+    image_id = image_processor.upload_dir_as_images(services, services, services, services, str(pos_dir),
+                                                    dataset=FakeDataset(51))
+
+    assert image_id.getValue() == 5
+    assert services.images == [(4, 3, 1, 2, 2, 'uint8', 'pos001')]
+    assert len(services.store.planes) == 4
+
+    # the logical channel names and the dataset link are saved in one call
+    assert len(services.saves) == 1
+    saved = services.saves[0]
+    logical_channels = [channel.getLogicalChannel() for channel in services.pixels.channels]
+    assert saved[:2] == logical_channels
+    assert all(hasattr(channel, 'name') for channel in logical_channels)
+    assert len(saved) == 3 and saved[2] not in logical_channels
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import os
+from omero_data_transfer.filename_parser import FilenameParser, PlaneName
+
+
+def test_parse():
+    parser = FilenameParser()
+
+    plane_name = parser.parse('Batgirl_Htb2_000012_GFP_003.png')
+    assert plane_name == PlaneName(3, 'GFP', 12, 'Batgirl_Htb2_000012_GFP_003')
+
+    assert parser.parse('brightfield.tiff') == PlaneName(0, '0', 0, 'brightfield')
+
+
+def test_parse_listing():
+    parser = FilenameParser()
+    files = ['exp_000001_DIC_001.png', 'exp_000002_GFP_005.png']
+
+    assert parser.parse_listing(files) == [
+        ('exp_000001_DIC_001.png', PlaneName(1, 'DIC', 1, 'exp_000001_DIC_001')),
+        ('exp_000002_GFP_005.png', PlaneName(5, 'GFP', 2, 'exp_000002_GFP_005'))]
+
+
+def test_parse_position():
+    parser = FilenameParser()
+    dir_path = os.path.join('data', 'pos0123_experiment', 'pos007')
+
+    assert parser.parse_position(dir_path) == 'pos007'
+    assert parser.parse_position(os.path.join(dir_path, '')) == 'pos007'
+    assert parser.parse_position(os.path.join('data', 'images')) is None
+
+    full_path = os.path.join(dir_path, 'exp_000001_DIC_001.png')
+    search_res = parser.search(full_path, 'exp_000001_DIC_001.png')
+    assert search_res['posSearch'].group('pos') == 'pos007'
+    assert search_res['cSearch'].group('C') == 'DIC'
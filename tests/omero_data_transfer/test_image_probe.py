@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import numpy as np
+from PIL import Image
+from omero_data_transfer.image_probe import ImageHeader, ImageProbeCache, probe_image
+
+
+def test_probe_image(tmp_path):
+    plane = np.arange(12, dtype=np.uint16).reshape(3, 4)
+
+    for ext, mime in (('png', 'image/png'), ('tiff', 'image/tiff')):
+        image_path = str(tmp_path / ('plane.%s' % ext))
+        Image.fromarray(plane).save(image_path)
+        assert probe_image(image_path) == ImageHeader(mime, 4, 3, np.dtype(np.uint16), 1)
+
+    rgb_path = str(tmp_path / 'rgb.tiff')
+    Image.fromarray(np.zeros((5, 6, 3), dtype=np.uint8)).save(rgb_path)
+    assert probe_image(rgb_path) == ImageHeader('image/tiff', 6, 5, np.dtype(np.uint8), 3)
+
+    float_path = str(tmp_path / 'float.tiff')
+    Image.fromarray(np.zeros((2, 2), dtype=np.float32)).save(float_path)
+    assert probe_image(float_path).dtype == np.float32
+
+    jpeg_path = str(tmp_path / 'plane.jpg')
+    Image.fromarray(np.zeros((2, 2), dtype=np.uint8)).save(jpeg_path)
+    assert probe_image(jpeg_path) is None
+
+
+def test_probe_cache_reads_one_header_per_directory(tmp_path):
+    for t in range(3):
+        Image.fromarray(np.zeros((2, 2), dtype=np.uint8)).save(str(tmp_path / ('img_%d.png' % t)))
+
+    cache = ImageProbeCache()
+    mime, header = cache.probe(str(tmp_path / 'img_0.png'))
+    assert mime == 'image/png'
+
+    # later files of the directory are not opened again
+    (tmp_path / 'img_1.png').unlink()
+    assert cache.probe(str(tmp_path / 'img_1.png')) == (mime, header)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import pytest
+from omero_data_transfer.object_cache import ObjectCache
+from omero_data_transfer.omero_data_broker import OMERODataBroker
+
+
+class FakeDataset(object):
+    def __init__(self, version):
+        self.version = version
+
+    def setDescription(self, description):
+        self.description = description
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.found = []
+        self.saved = []
+        self.stale = False
+
+    def getQueryService(self):
+        return self
+
+    def getUpdateService(self):
+        return self
+
+    def find(self, object_type, object_id):
+        self.found.append((object_type, object_id))
+        return FakeDataset(len(self.saved))
+
+    def saveAndReturnObject(self, om_object):
+        if om_object.version != len(self.saved):
+            raise Exception('optimistic lock')
+        self.saved.append(om_object.description)
+        return FakeDataset(len(self.saved))
+
+
+class FakeSessionPool(object):
+    def checkout(self):
+        return self
+
+    def checkin(self):
+        pass
+
+    def getSession(self):
+        return self.session
+
+
+def test_least_recently_used_objects_are_dropped():
+    cache = ObjectCache(max_size=2)
+    cache.put('Dataset', 1, 'one')
+    cache.put('Dataset', '2', 'two')
+    assert cache.get('Dataset', '1') == 'one'
+
+    cache.put('Project', 1, 'project')
+    assert len(cache) == 2
+    assert cache.get('Dataset', 2) is None
+    assert cache.get('Dataset', 1) == 'one'
+
+    cache.invalidate('Dataset', 1)
+    assert cache.get('Dataset', 1) is None
+
+    with pytest.raises(ValueError):
+        ObjectCache(max_size=0)
+
+
+def test_add_description_reuses_saved_object():
+    pool = FakeSessionPool()
+    pool.session = FakeSession()
+    broker = OMERODataBroker('user', 'password', 'omero.example.org', session_pool=pool)
+    broker.open_omero_session()
+
+    broker.add_description('first', 'Dataset', '51')
+    broker.add_description('second', 'Dataset', 51)
+    assert pool.session.found == [('Dataset', 51)]
+    assert len(pool.session.saved) == 2
+
+    # a stale cached version is reloaded and saved again
+    broker.OBJECT_CACHE.put('Dataset', 51, FakeDataset(0))
+    broker.add_description('third', 'Dataset', 51)
+    assert pool.session.found == [('Dataset', 51), ('Dataset', 51)]
+    assert len(pool.session.saved) == 3
+
+    broker.close_omero_session()
+    assert len(broker.OBJECT_CACHE) == 0
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import threading
+import pytest
+from omero_data_transfer import paged_query
+from omero_data_transfer.paged_query import iter_pages, paged_parameters
+
+
+class FakeQuery(object):
+    def __init__(self, count):
+        self.results = list(range(count))
+        self.pages = []
+        self.threads = set()
+
+    def fetch_page(self, offset, limit):
+        self.pages.append((offset, limit))
+        self.threads.add(threading.current_thread().name)
+        return self.results[offset:offset + limit]
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_results_are_fetched_a_page_at_a_time(prefetch):
+    query = FakeQuery(25)
+    results = iter_pages(query.fetch_page, page_size=10, prefetch=prefetch)
+
+    # nothing is fetched until the results are consumed
+    assert query.pages == []
+
+    assert [next(results) for i in range(5)] == [0, 1, 2, 3, 4]
+    assert query.pages[0] == (0, 10)
+
+    assert list(results) == list(range(5, 25))
+    assert query.pages == [(0, 10), (10, 10), (20, 10)]
+    assert (len(query.threads) > 1) == prefetch
+
+    # a full last page is followed by a request for an empty one
+    query = FakeQuery(20)
+    assert list(iter_pages(query.fetch_page, page_size=10, prefetch=prefetch)) == list(range(20))
+    assert query.pages == [(0, 10), (10, 10), (20, 10)]
+
+
+def test_closing_stops_fetching():
+    query = FakeQuery(100)
+    results = iter_pages(query.fetch_page, page_size=10, prefetch=True)
+
+    assert next(results) == 0
+    results.close()
+    # at most the prefetched page was fetched
+    assert query.pages == [(0, 10), (10, 10)]
+
+    with pytest.raises(ValueError):
+        list(iter_pages(query.fetch_page, page_size=0))
+
+
+class Image(object):
+    def __init__(self, image_id):
+        self.image_id = image_id
+
+    def getId(self):
+        return self.image_id
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_unpaged_call_is_not_repeated(prefetch):
+    pages = []
+
+    def fetch_page(offset, limit):
+        # ignores the offset and limit, as a call without paging does
+        pages.append((offset, limit))
+        return [Image(image_id) for image_id in range(25)]
+
+    results = list(iter_pages(fetch_page, page_size=10, prefetch=prefetch))
+    assert [image.getId() for image in results] == list(range(25))
+    assert pages == [(0, 10), (25, 10)]
+
+
+class Filter(object):
+    def __init__(self, owner_id=None):
+        self.ownerId = owner_id
+        self.offset = None
+        self.limit = None
+
+
+class ParametersI(object):
+    # as omero.sys.ParametersI, without rtypes
+    def __init__(self):
+        self.map = {}
+        self.theFilter = None
+        self.theOptions = None
+
+    def page(self, offset, limit):
+        if self.theFilter is None:
+            self.theFilter = Filter()
+        self.theFilter.offset = offset
+        self.theFilter.limit = limit
+        return self
+
+
+def test_paged_parameters_keep_the_filter(monkeypatch):
+    monkeypatch.setattr(paged_query.sys, 'ParametersI', ParametersI)
+
+    params = ParametersI()
+    params.map = {'did': 51}
+    params.theFilter = Filter(owner_id=2)
+    params.theOptions = 'options'
+
+    paged = paged_parameters(params, 20, 10)
+    assert paged.map == {'did': 51} and paged.theOptions == 'options'
+    assert (paged.theFilter.ownerId, paged.theFilter.offset, paged.theFilter.limit) == (2, 20, 10)
+    # the caller's parameters are not paged
+    assert params.theFilter.offset is None
+
+    paged = paged_parameters(None, 0, 10)
+    assert (paged.theFilter.ownerId, paged.theFilter.offset, paged.theFilter.limit) == (None, 0, 10)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+from multiprocessing.pool import ThreadPool
+from omero_data_transfer.pixels_type_cache import PixelsTypeCache
+
+
+class FakeRString(object):
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class FakePixelsType(object):
+    def __init__(self, value):
+        self.value = FakeRString(value)
+
+    def getValue(self):
+        return self.value
+
+
+class FakeQueryService(object):
+    def __init__(self):
+        self.queries = []
+
+    def findAllByQuery(self, query, params):
+        self.queries.append(query)
+        return [FakePixelsType(value) for value in ('uint8', 'uint16', 'float')]
+
+
+def test_pixels_types_loaded_once():
+    query_service = FakeQueryService()
+    cache = PixelsTypeCache()
+
+    pool = ThreadPool(processes=8)
+    pixels_types = pool.map(lambda value: cache.get(query_service, value), ['uint16'] * 32)
+    pool.close()
+    pool.join()
+
+    assert query_service.queries == [PixelsTypeCache.PIXELS_TYPES_QUERY]
+    assert len(set(id(p) for p in pixels_types)) == 1
+    assert cache.get(query_service, 'float').getValue().getValue() == 'float'
+    assert cache.get(query_service, 'bit') is None
+
+
+def test_cache_shared_per_server():
+    assert PixelsTypeCache.for_server('omero.example.org', 4064) is \
+        PixelsTypeCache.for_server('omero.example.org', 4064)
+    assert PixelsTypeCache.for_server('omero.example.org', 4064) is not \
+        PixelsTypeCache.for_server('localhost', 4064)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import threading
+import time
+import numpy as np
+import pytest
+from omero_data_transfer.plane_pipeline import PlanePipeline, PlaneConverter, ChannelStatistics, \
+    plane_statistics, iter_row_chunks
+
+
+def test_iterate_preserves_task_order():
+    pipeline = PlanePipeline(decode_workers=4, queue_depth=3)
+
+    def decode(task):
+        # later tasks finish first
+        time.sleep(0.001 * (10 - task))
+        return task * 2
+
+    assert list(pipeline.iterate(decode, range(10))) == [x * 2 for x in range(10)]
+
+
+def test_iterate_bounds_planes_in_flight():
+    queue_depth = 2
+    pipeline = PlanePipeline(decode_workers=4, queue_depth=queue_depth)
+    lock = threading.Lock()
+    state = {'submitted': 0, 'consumed': 0, 'max_ahead': 0}
+
+    def tasks():
+        for i in range(20):
+            with lock:
+                state['submitted'] += 1
+                state['max_ahead'] = max(state['max_ahead'],
+                                         state['submitted'] - state['consumed'])
+            yield i
+
+    for _ in pipeline.iterate(lambda task: task, tasks()):
+        with lock:
+            state['consumed'] += 1
+
+    assert state['consumed'] == 20
+    assert state['max_ahead'] <= queue_depth + 1
+
+
+def test_iterate_inline_and_errors():
+    assert list(PlanePipeline(decode_workers=0).iterate(str, [1, 2])) == ['1', '2']
+
+    def decode(task):
+        if task == 3:
+            raise IOError('corrupt plane')
+        return task
+
+    results = PlanePipeline(decode_workers=2, queue_depth=2).iterate(decode, range(5))
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(IOError):
+        next(results)
+
+    with pytest.raises(ValueError):
+        PlanePipeline(queue_depth=0)
+
+
+def test_plane_statistics():
+    plane = np.array([[3, 7], [7, 65000]], dtype=np.uint16)
+
+    stats = plane_statistics(plane, histogram=True)
+    assert (stats.min, stats.max) == (3, 65000)
+    assert stats.histogram[7] == 2
+    assert stats.histogram.sum() == plane.size
+
+    stats = plane_statistics(plane.astype(np.float32), histogram=True)
+    assert (stats.min, stats.max) == (3, 65000)
+    assert stats.histogram is None
+
+    # min and max are reduced a block of rows at a time
+    plane = np.random.RandomState(0).uniform(-1000, 1000, (700, 300))
+    plane[650, 7], plane[3, 299] = -5000, 5000
+    stats = plane_statistics(plane)
+    assert (stats.min, stats.max) == (-5000, 5000)
+    assert plane_statistics(plane[:1]) == (plane[0].min(), plane[0].max(), None)
+
+
+def test_channel_statistics():
+    channel_stats = ChannelStatistics(2)
+    plane = np.arange(1, 101, dtype=np.uint8).reshape(10, 10)
+
+    channel_stats.add(0, plane_statistics(plane, histogram=True))
+    channel_stats.add(0, plane_statistics(plane.astype(np.uint16) * 2, histogram=True))
+    channel_stats.add(1, plane_statistics(np.full((2, 2), 300.7).astype(np.uint16)))
+
+    assert (channel_stats.min_values[0], channel_stats.max_values[0]) == (0, 200)
+    assert channel_stats.histograms[0].sum() == 200
+    assert channel_stats.window(0) == (0, 200)
+    assert channel_stats.window(0, (0, 50)) == (1, 67)
+    assert channel_stats.window(1, (1, 99)) == (0, 300)
+
+
+def test_plane_converter():
+    converter = PlaneConverter(np.uint16, (2, 3))
+
+    plane = np.ones((2, 3), dtype=np.uint16)
+    assert converter.convert(plane) is plane
+
+    first = converter.convert(np.full((2, 3), 4.0))
+    second = converter.convert(np.full((2, 3), 9, dtype=np.uint8))
+    assert first is second
+    assert second.dtype == np.uint16 and (second == 9).all()
+
+    blank = converter.blank()
+    assert blank is converter.blank()
+    assert blank.dtype == np.uint16 and not blank.any()
+    assert not blank.flags.writeable
+
+
+def test_iter_row_chunks():
+    plane = np.arange(70).reshape(7, 10)
+
+    chunks = list(iter_row_chunks(plane, 3))
+    assert [y for y, rows in chunks] == [0, 3, 6]
+    assert [rows.shape for y, rows in chunks] == [(3, 10), (3, 10), (1, 10)]
+    assert all(np.shares_memory(rows, plane) for y, rows in chunks)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import numpy as np
+from PIL import Image
+from omero_data_transfer.plane_source import MmapTiffPlaneSource, PILPlaneSource
+
+
+def test_mmap_uncompressed_tiff(tmp_path):
+    # large enough for PIL to write several strips
+    plane = (np.arange(300 * 400) % 65536).astype(np.uint16).reshape(300, 400)
+    image_path = str(tmp_path / 'plane.tiff')
+    Image.fromarray(plane).save(image_path)
+
+    plane_source = MmapTiffPlaneSource()
+    mapped = plane_source.map_plane(image_path)
+
+    assert isinstance(mapped, np.memmap)
+    assert mapped.dtype == np.uint16
+    np.testing.assert_array_equal(mapped, plane)
+    np.testing.assert_array_equal(plane_source.read_plane(image_path),
+                                  PILPlaneSource().read_plane(image_path))
+
+
+def test_mmap_rgb_tiff(tmp_path):
+    rgb = np.random.randint(0, 255, (6, 5, 3)).astype(np.uint8)
+    image_path = str(tmp_path / 'rgb.tiff')
+    Image.fromarray(rgb).save(image_path)
+
+    np.testing.assert_array_equal(MmapTiffPlaneSource().read_plane(image_path, 1), rgb[:, :, 1])
+
+
+def test_fallback_for_compressed_and_other_formats(tmp_path):
+    plane = np.arange(64, dtype=np.uint8).reshape(8, 8)
+    compressed_path = str(tmp_path / 'compressed.tiff')
+    png_path = str(tmp_path / 'plane.png')
+    Image.fromarray(plane).save(compressed_path, compression='tiff_deflate')
+    Image.fromarray(plane).save(png_path)
+
+    plane_source = MmapTiffPlaneSource()
+    assert plane_source.map_plane(compressed_path) is None
+
+    for image_path in (compressed_path, png_path):
+        read = plane_source.read_plane(image_path)
+        assert not isinstance(read, np.memmap)
+        np.testing.assert_array_equal(read, plane)
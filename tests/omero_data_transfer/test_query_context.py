@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import time
+import pytest
+from omero import SessionTimeoutException
+from omero_data_transfer.query_context import QueryContext, parameters_key
+from omero_data_transfer.session_pool import SessionPool
+from omero_data_transfer.omero_data_broker import OMERODataBroker
+
+
+class RType(object):
+    def __init__(self, val):
+        self.val = val
+
+
+class Filter(object):
+    def __init__(self, owner_id=None, group_id=None, offset=None, limit=None):
+        self.ownerId = RType(owner_id)
+        self.groupId = RType(group_id)
+        self.offset = RType(offset)
+        self.limit = RType(limit)
+
+
+class Options(object):
+    def __init__(self, leaves=None):
+        self.leaves = RType(leaves)
+
+
+class Parameters(object):
+    def __init__(self, param_map, the_filter=None, the_options=None):
+        self.map = param_map
+        self.theFilter = the_filter
+        self.theOptions = the_options
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.SESSION = None
+        self.CLIENT = None
+        self.opened = 0
+        self.closed = 0
+        self.destroyed = 0
+        self.queries = []
+        self.fail = 0
+
+    def open_omero_session(self):
+        self.opened += 1
+        self.SESSION = 'session %d' % self.opened
+
+    def close_omero_session(self):
+        self.closed += 1
+        self.SESSION = None
+
+    def destroy_omero_session(self):
+        self.destroyed += 1
+        self.SESSION = None
+
+    def find_objects_by_query(self, query, params):
+        self.queries.append((self.SESSION, query))
+        if self.fail > 0:
+            self.fail -= 1
+            raise SessionTimeoutException()
+        if query == 'bad query':
+            raise ValueError('unexpected token')
+        return [query, params.map['pid'].val]
+
+    def find_objects_by_type_field_value(self, type, field, value, case_sensitive=False):
+        self.queries.append((self.SESSION, type))
+        return [type, field, value]
+
+
+def test_parameters_key():
+    key = parameters_key(Parameters({'pid': RType(51), 'ids': RType([RType(1), RType(2)])}))
+    assert key == parameters_key(Parameters({'ids': RType([RType(1), RType(2)]), 'pid': RType(51)}))
+    assert key != parameters_key(Parameters({'pid': RType(52), 'ids': RType([RType(1), RType(2)])}))
+    assert hash(key) is not None
+
+    # searches filtered by another owner or group, or with other options,
+    # don't share memoised results
+    owned = parameters_key(Parameters({'pid': RType(51)}, Filter(owner_id=2)))
+    assert owned == parameters_key(Parameters({'pid': RType(51)}, Filter(owner_id=2)))
+    assert owned != parameters_key(Parameters({'pid': RType(51)}, Filter(owner_id=3)))
+    assert owned != parameters_key(Parameters({'pid': RType(51)}, Filter(owner_id=2, group_id=5)))
+    assert owned != parameters_key(Parameters({'pid': RType(51)}, Filter(owner_id=2, offset=0, limit=10)))
+    assert owned != parameters_key(Parameters({'pid': RType(51)}, Filter(owner_id=2), Options(leaves=True)))
+    assert parameters_key(None) is None
+
+
+def test_searches_share_a_session_and_are_memoised():
+    broker = FakeBroker()
+    query = 'select p from Project p where p.id = :pid'
+
+    with QueryContext(broker, ttl=60) as context:
+        assert context.search_by_query(query, Parameters({'pid': RType(1)})) == [query, 1]
+        assert context.search_by_query(query, Parameters({'pid': RType(1)})) == [query, 1]
+        assert context.search_by_query(query, Parameters({'pid': RType(2)})) == [query, 2]
+        assert context.search_by_type_field('Project', 'name', 'Batgirl') == ['Project', 'name', 'Batgirl']
+        assert context.search_by_type_field('Project', 'name', 'Batgirl') == ['Project', 'name', 'Batgirl']
+        assert len(broker.queries) == 3
+
+        context.invalidate(query)
+        context.search_by_query(query, Parameters({'pid': RType(1)}))
+        context.search_by_type_field('Project', 'name', 'Batgirl')
+        assert len(broker.queries) == 4
+
+        context.invalidate()
+        context.search_by_type_field('Project', 'name', 'Batgirl')
+        assert len(broker.queries) == 5
+
+    assert broker.opened == 1 and broker.closed == 1
+
+
+def test_memoised_results_expire():
+    broker = FakeBroker()
+    context = QueryContext(broker, ttl=0.05, max_entries=1)
+    params = Parameters({'pid': RType(1)})
+
+    context.search_by_query('query', params)
+    context.search_by_query('query', params)
+    assert len(broker.queries) == 1
+
+    time.sleep(0.1)
+    context.search_by_query('query', params)
+    assert len(broker.queries) == 2
+
+    # only the most recent result is kept
+    context.search_by_query('other query', params)
+    context.search_by_query('query', params)
+    assert len(broker.queries) == 4
+
+    # with no ttl nothing is memoised
+    context.ttl = 0
+    context.invalidate()
+    context.search_by_query('query', params)
+    context.search_by_query('query', params)
+    assert len(broker.queries) == 6
+
+
+def test_failed_search_is_retried_on_a_new_session():
+    broker = FakeBroker()
+    broker.fail = 1
+    context = QueryContext(broker)
+
+    assert context.search_by_query('query', Parameters({'pid': RType(1)})) == ['query', 1]
+    assert broker.queries == [('session 1', 'query'), ('session 2', 'query')]
+    assert broker.destroyed == 1
+
+    # other errors, e.g. of the query itself, are not retried
+    with pytest.raises(ValueError):
+        context.search_by_query('bad query', Parameters({'pid': RType(1)}))
+    assert len(broker.queries) == 3 and broker.destroyed == 1
+
+
+class ExpiringSession(object):
+    def __init__(self, client):
+        self.client = client
+
+    def getQueryService(self):
+        return self
+
+    def findAllByQuery(self, query, params):
+        if self.client.expired:
+            raise SessionTimeoutException()
+        return [self.client.name]
+
+
+class ExpiringClient(object):
+    def __init__(self, name):
+        self.name = name
+        self.expired = False
+
+    def getSession(self):
+        return ExpiringSession(self)
+
+    def getSessionId(self):
+        return self.name
+
+    def destroySession(self, session_id):
+        if self.expired:
+            raise SessionTimeoutException()
+
+    def closeSession(self):
+        pass
+
+
+def test_expired_session_is_replaced_in_the_pool():
+    clients = []
+
+    def client_factory():
+        clients.append(ExpiringClient('client %d' % len(clients)))
+        return clients[-1]
+
+    pool = SessionPool(client_factory, max_size=2)
+    broker = OMERODataBroker('user', 'password', 'omero.example.org', session_pool=pool)
+
+    with QueryContext(broker, ttl=0) as context:
+        assert context.search_by_query('query', None) == ['client 0']
+        clients[0].expired = True
+        assert context.search_by_query('query', None) == ['client 1']
+
+    # the dead client's checkout was dropped along with it
+    with pool.client() as client:
+        assert client is clients[1]
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+from multiprocessing.pool import ThreadPool
+from omero_data_transfer.registry import Registry
+
+
+def test_one_instance_per_key():
+    registry = Registry()
+    created = []
+
+    def create():
+        created.append(object())
+        return created[-1]
+
+    pool = ThreadPool(processes=8)
+    try:
+        instances = pool.map(lambda i: registry.get(('localhost', 4064), create), range(32))
+    finally:
+        pool.close()
+        pool.join()
+
+    assert len(created) == 1
+    assert all(instance is created[0] for instance in instances)
+    assert registry.get(('localhost', 4063), create) is created[1]
+
+
+def test_update_existing_instance():
+    registry = Registry()
+    updated = []
+
+    instance = registry.get('key', list, updated.append)
+    assert updated == []
+    assert registry.get('key', list, updated.append) is instance
+    assert updated == [instance]
+
+    assert registry.pop_all() == [instance]
+    assert registry.get('key', list) is not instance
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import threading
+import time
+import pytest
+from multiprocessing.pool import ThreadPool
+from omero_data_transfer.session_pool import SessionPool
+
+
+class FakeSession(object):
+    def __init__(self, client):
+        self.client = client
+
+    def ice_ping(self):
+        if self.client.expired:
+            raise RuntimeError('session expired')
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.expired = False
+        self.closed = False
+
+    def getSession(self):
+        return FakeSession(self)
+
+    def closeSession(self):
+        self.closed = True
+
+
+class FakeClientFactory(object):
+    def __init__(self):
+        self.clients = []
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        client = FakeClient()
+        with self.lock:
+            self.clients.append(client)
+        return client
+
+
+def test_checkout_is_per_thread_and_reused():
+    factory = FakeClientFactory()
+    pool = SessionPool(factory, max_size=4)
+
+    client = pool.checkout()
+    # nested checkouts on the same thread share the client
+    assert pool.checkout() is client
+    pool.checkin()
+    pool.checkin()
+
+    # the next phase reuses the logged-in client
+    with pool.client() as next_client:
+        assert next_client is client
+    assert len(factory.clients) == 1
+
+    in_use = []
+    active = []
+    lock = threading.Lock()
+
+    def use_session(i):
+        with pool.client() as client:
+            with lock:
+                active.append(client)
+                in_use.append(len(set(map(id, active))))
+            time.sleep(0.02)
+            with lock:
+                active.remove(client)
+
+    workers = ThreadPool(processes=8)
+    try:
+        workers.map(use_session, range(32))
+    finally:
+        workers.close()
+        workers.join()
+
+    # threads get distinct clients, bounded by the pool size
+    assert len(factory.clients) == 4
+    assert max(in_use) == 4
+    pool.close()
+    assert all(client.closed for client in factory.clients)
+
+
+def test_expired_sessions_are_replaced():
+    factory = FakeClientFactory()
+    pool = SessionPool(factory, max_size=2, health_check_interval=0)
+
+    with pool.client() as client:
+        pass
+    client.expired = True
+
+    with pool.client() as new_client:
+        assert new_client is not client
+    assert client.closed == True
+    assert len(factory.clients) == 2
+
+    with pool.client() as same_client:
+        assert same_client is new_client
+
+
+def test_invalidate_and_close():
+    factory = FakeClientFactory()
+    pool = SessionPool(factory, max_size=2)
+
+    client = pool.checkout()
+    pool.invalidate()
+    assert client.closed == True
+    assert pool.checkout() is not client
+    pool.close()
+
+    # clients still checked out are closed when returned
+    held = factory.clients[-1]
+    assert held.closed == False
+    pool.checkin()
+    assert held.closed == True
+
+    with pytest.raises(ValueError):
+        pool.checkout()
+
+    with pytest.raises(ValueError):
+        SessionPool(factory, max_size=1)
+
+
+def test_invalidate_with_nested_checkouts():
+    factory = FakeClientFactory()
+    pool = SessionPool(factory, max_size=2)
+
+    # e.g. a searcher broker and an upload broker on the same thread
+    client = pool.checkout()
+    assert pool.checkout() is client
+    pool.invalidate()
+
+    # the other holder keeps the client until it checks in, but the next
+    # checkout from the thread gets a new one
+    assert client.closed == False
+    new_client = pool.checkout()
+    assert new_client is not client and client.closed == True
+    pool.checkin()
+    pool.checkin()
+
+    with pool.client() as same_client:
+        assert same_client is new_client
+    assert len(factory.clients) == 2
+
+    # a client invalidated by its only holder is closed and its slot freed
+    client = pool.checkout()
+    pool.invalidate()
+    assert client.closed == True
+    with pool.client() as other_client:
+        assert other_client is not client
+
+
+def test_checkin_from_another_thread():
+    pool = SessionPool(FakeClientFactory(), max_size=2)
+    pool.checkout()
+
+    errors = []
+
+    def checkin():
+        try:
+            pool.checkin()
+        except ValueError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=checkin)
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
+
+    pool.checkin()
+    with pytest.raises(ValueError):
+        pool.checkin()
+
+
+def test_for_server_shares_pools():
+    factory = FakeClientFactory()
+    pool = SessionPool.for_server('localhost', 4064, 'user', 'password', factory)
+    assert SessionPool.for_server('localhost', 4064, 'user', 'password', FakeClientFactory()) is pool
+    assert SessionPool.for_server('localhost', 4064, 'other', 'password', factory) is not pool
+    # a broker with another password doesn't get the pool's sessions
+    assert SessionPool.for_server('localhost', 4064, 'user', 'wrong', factory) is not pool
+
+    # the pool grows to the largest size requested
+    assert pool.max_size == SessionPool.DEFAULT_MAX_SIZE
+    assert SessionPool.for_server('localhost', 4064, 'user', 'password', factory, 20) is pool
+    assert pool.max_size == 20
+    SessionPool.for_server('localhost', 4064, 'user', 'password', factory, 4)
+    assert pool.max_size == 20
+
+    SessionPool.close_all()
+    assert SessionPool.for_server('localhost', 4064, 'user', 'password', factory) is not pool
+    SessionPool.close_all()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+from multiprocessing.pool import ThreadPool
+from omero_data_transfer.shared_resources import SharedResourcesCache
+
+
+class FakeId(object):
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class FakeDescription(object):
+    def __init__(self, repository_id):
+        self.repository_id = repository_id
+
+    def getId(self):
+        return FakeId(self.repository_id)
+
+
+class FakeRepositories(object):
+    descriptions = [FakeDescription(7), FakeDescription(8)]
+
+
+class FakeResources(object):
+    def __init__(self):
+        self.repository_calls = 0
+
+    def repositories(self):
+        self.repository_calls += 1
+        return FakeRepositories()
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.resources_calls = 0
+
+    def sharedResources(self):
+        self.resources_calls += 1
+        return FakeResources()
+
+
+def test_resources_are_fetched_once_per_session():
+    cache = SharedResourcesCache()
+    session = FakeSession()
+
+    pool = ThreadPool(processes=8)
+    results = pool.map(lambda i: cache.get(session), range(32))
+    pool.close()
+    pool.join()
+
+    resources = results[0][0]
+    assert all(result == (resources, 7) for result in results)
+    assert session.resources_calls == 1
+    assert resources.repository_calls == 1
+
+    # the repository id is shared by every session of the server
+    other_session = FakeSession()
+    other_resources, repository_id = cache.get(other_session)
+    assert other_resources is not resources and repository_id == 7
+    assert other_resources.repository_calls == 0
+
+    cache.forget(session)
+    assert cache.get(session)[0] is not resources
+    assert session.resources_calls == 2
+
+
+def test_for_server():
+    cache = SharedResourcesCache.for_server('omero.example.org', 4064)
+    assert SharedResourcesCache.for_server('omero.example.org', 4064) is cache
+    assert SharedResourcesCache.for_server('omero.example.org', 4063) is not cache
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import numpy as np
+import pandas as pd
+import pytest
+from omero_data_transfer.table_writer import TableWriter, ColumnSpec, typed_dataframe
+
+
+class FakeColumn(object):
+    def __init__(self, spec, values):
+        self.name = spec.name
+        self.size = spec.size
+        self.kind = spec.kind
+        self.values = values
+
+
+class LongColumn(FakeColumn):
+    pass
+
+
+class StringColumn(FakeColumn):
+    pass
+
+
+class FakeTable(object):
+    def __init__(self, headers=None):
+        self.headers = headers
+        self.chunks = []
+
+    def initialize(self, columns):
+        self.headers = columns
+
+    def getHeaders(self):
+        return self.headers
+
+    def addData(self, columns):
+        self.chunks.append(columns)
+
+
+class FakeTableWriter(TableWriter):
+    def new_column(self, spec, values):
+        return FakeColumn(spec, values)
+
+
+def acq_points_table():
+    # as built by the acq parser: object columns of parsed strings
+    points = pd.DataFrame(columns=['name', 'xpos', 'zpos', 'group', 'well'])
+    points.loc[len(points)] = ['pos001', '-12.5', '3', '1', '007']
+    points.loc[len(points)] = [u'posé002', '10', '4', '2', '008']
+    return points
+
+
+def test_column_types():
+    frame = pd.DataFrame({'count': np.array([1, 2, 3], dtype=np.int32),
+                          'exposure': [0.5, np.nan, 2.0],
+                          'skip': [True, False, True],
+                          'channel': ['GFP', None, 'Brightfield']})
+    specs, typed = typed_dataframe(frame)
+
+    assert specs == [ColumnSpec('count', 'long', 0), ColumnSpec('exposure', 'double', 0),
+                     ColumnSpec('skip', 'bool', 0), ColumnSpec('channel', 'string', 11)]
+
+    specs, typed = typed_dataframe(acq_points_table())
+    # numeric strings become numbers; names and zero-padded ids stay strings
+    assert [spec.kind for spec in specs] == ['string', 'double', 'long', 'long', 'string']
+    assert specs[0].size == len(u'posé002'.encode('utf-8'))
+
+
+def test_rows_are_written_in_typed_chunks():
+    frame = pd.DataFrame({'z': np.arange(25), 'name': ['slice%d' % i for i in range(25)],
+                          'spacing': np.linspace(0, 1, 25)})
+    table = FakeTable()
+    FakeTableWriter(chunk_rows=10).initialize(table, frame)
+
+    assert [column.kind for column in table.headers] == ['long', 'string', 'double']
+    assert [len(chunk[0].values) for chunk in table.chunks] == [10, 10, 5]
+    assert table.chunks[2][0].values == [20, 21, 22, 23, 24]
+    assert isinstance(table.chunks[0][0].values[0], int)
+    assert table.chunks[0][1].values[:2] == ['slice0', 'slice1']
+    assert table.chunks[1][2].values[0] == pytest.approx(10 / 24.0)
+
+    empty = FakeTable()
+    FakeTableWriter().initialize(empty, frame.iloc[:0])
+    assert len(empty.headers) == 3 and empty.chunks == []
+
+
+def test_append_to_existing_table():
+    table = FakeTable([LongColumn(ColumnSpec('z', 'long', 0), []),
+                       StringColumn(ColumnSpec('name', 'string', 8), [])])
+    writer = TableWriter()
+
+    appended = []
+    writer.new_column = lambda spec, values: appended.append((spec, values))
+    writer.append(table, pd.DataFrame({'z': ['1', '2'], 'name': ['pos001', 'pos002']}))
+
+    assert appended == [(ColumnSpec('z', 'long', 0), [1, 2]), (ColumnSpec('name', 'string', 8), ['pos001', 'pos002'])]
+
+    with pytest.raises(ValueError):
+        writer.append(table, pd.DataFrame({'name': ['pos001'], 'z': [1]}))
+
+    with pytest.raises(ValueError):
+        writer.append(table, pd.DataFrame({'z': [1], 'name': ['position001']}))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+from omero_data_transfer.tag_resolver import TagResolver
+
+
+class FakeRType(object):
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class FakeTag(object):
+    def __init__(self, text, tag_id=None):
+        self.text = text
+        self.id = tag_id
+
+    def getTextValue(self):
+        return FakeRType(self.text)
+
+    def getId(self):
+        return FakeRType(self.id)
+
+
+class FakeServer(object):
+    def __init__(self, tags):
+        # (id, text) of the user's existing tags, in id order
+        self.tags = list(tags)
+        self.links = set()
+        self.queries = []
+        self.saves = []
+
+    def getAdminService(self):
+        return self
+
+    def getEventContext(self):
+        return self
+
+    userId = 2
+
+    def getQueryService(self):
+        return self
+
+    def getUpdateService(self):
+        return self
+
+    def projection(self, query, params):
+        self.queries.append(query)
+        if 'TagAnnotation t' in query:
+            # grouped by text value, with the lowest id of each
+            assert 'min(t.id)' in query and 'group by t.textValue' in query
+            oldest = {}
+            for tag_id, text in self.tags:
+                oldest[text] = min(oldest.get(text, tag_id), tag_id)
+            return [[FakeRType(tag_id), FakeRType(text)] for text, tag_id in oldest.items()]
+        return [[FakeRType(tag_id)] for parent_id, tag_id in self.links]
+
+    def saveAndReturnArray(self, objects):
+        self.saves.append(objects)
+        saved = []
+        for tag in objects:
+            tag_id = max([tag_id for tag_id, text in self.tags] + [0]) + 1
+            self.tags.append((tag_id, tag.text))
+            saved.append(FakeTag(tag.text, tag_id))
+        return saved
+
+    def saveArray(self, objects):
+        self.saves.append(objects)
+        self.links.update(objects)
+
+
+class FakeTagResolver(TagResolver):
+    def new_tag(self, tag_value):
+        return FakeTag(tag_value)
+
+    def new_link(self, object_type, object_id, tag_id):
+        return (int(object_id), tag_id)
+
+
+def test_existing_tags_are_reused():
+    server = FakeServer([(10, 'Batgirl'), (11, 'Batgirl'), (12, 'Htb2')])
+    resolver = FakeTagResolver()
+
+    tag_ids = resolver.link_tags(server, 'Dataset', '51', ['Batgirl', 'Htb2', 'Myo1', 'Batgirl'])
+
+    # the oldest duplicate is used and only the missing tag is created
+    assert tag_ids == [10, 12, 13, 10]
+    assert [tag.text for tag in server.saves[0]] == ['Myo1']
+    assert server.links == {(51, 10), (51, 12), (51, 13)}
+    assert len(server.saves) == 2
+
+    # cached values need no lookup, and existing links are not repeated
+    queries = len(server.queries)
+    assert resolver.link_tags(server, 'Dataset', 51, ['Myo1', 'Batgirl']) == [13, 10]
+    assert len(server.queries) == queries + 1
+    assert len(server.saves) == 2
+
+    assert resolver.resolve(server, ['Htb2']) == {'Htb2': 12}
+
+
+def test_for_user_shares_resolvers():
+    resolver = TagResolver.for_user('localhost', 4064, 'user')
+    assert TagResolver.for_user('localhost', 4064, 'user') is resolver
+    assert TagResolver.for_user('localhost', 4064, 'other') is not resolver
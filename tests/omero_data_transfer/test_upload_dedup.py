@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import os
+import hashlib
+from omero_data_transfer.upload_dedup import UploadDeduplicator, ContentHash, file_sha1
+from omero_data_transfer.omero_data_broker import OMERODataBroker
+
+
+def test_file_sha1_streams_blocks(tmpdir):
+    image = tmpdir.join('img_000001_GFP_001.png')
+    content = os.urandom(10000)
+    image.write_binary(content)
+
+    expected = ContentHash(hashlib.sha1(content).hexdigest(), 10000)
+    assert file_sha1(str(image), block_size=1000) == expected
+    assert file_sha1(str(image)) == expected
+
+
+def test_hash_files_and_positions(tmpdir):
+    deduplicator = UploadDeduplicator(str(tmpdir.join('index.sqlite')), hash_workers=4)
+
+    paths = []
+    for pos in ('pos001', 'pos002'):
+        pos_dir = tmpdir.mkdir(pos)
+        for z in range(3):
+            image = pos_dir.join('img_000001_GFP_%03d.png' % z)
+            image.write_binary(b'plane %d' % z)
+            paths.append(str(image))
+
+    file_hashes = deduplicator.hash_files(paths)
+    assert sorted(file_hashes) == sorted(os.path.normpath(p) for p in paths)
+    assert file_hashes[paths[0]] == file_sha1(paths[0])
+
+    # positions with the same file names and content hash the same
+    position_hashes = deduplicator.hash_positions(reversed(paths))
+    pos001, pos002 = str(tmpdir.join('pos001')), str(tmpdir.join('pos002'))
+    assert sorted(position_hashes) == [pos001, pos002]
+    assert position_hashes[pos001] == position_hashes[pos002]
+    assert position_hashes[pos001].size == sum(len(b'plane %d' % z) for z in range(3))
+
+    tmpdir.join('pos002', 'img_000001_GFP_002.png').write_binary(b'changed')
+    assert deduplicator.hash_positions(paths)[pos002] != position_hashes[pos001]
+    deduplicator.close()
+
+
+def test_index_lookup_per_server(tmpdir):
+    index_path = str(tmpdir.join('index.sqlite'))
+    deduplicator = UploadDeduplicator(index_path)
+    deduplicator.record('localhost', ContentHash('aaa', 10), 5)
+    deduplicator.record('otherhost', ContentHash('bbb', 10), 6)
+    deduplicator.close()
+
+    deduplicator = UploadDeduplicator(index_path)
+    assert deduplicator.lookup('localhost', ['aaa', 'bbb', 'ccc']) == {'aaa': 5}
+    assert deduplicator.lookup('otherhost', ['bbb']) == {'bbb': 6}
+
+    digests = ['%040x' % i for i in range(1200)]
+    for i, digest in enumerate(digests):
+        deduplicator.record('localhost', ContentHash(digest, 1), i)
+    assert len(deduplicator.lookup('localhost', digests)) == 1200
+    deduplicator.close()
+
+
+class FakeRLong(object):
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class FakeDedupSession(object):
+    def __init__(self, existing_ids):
+        self.existing_ids = existing_ids
+        self.saved = []
+
+    def getQueryService(self):
+        return self
+
+    def getUpdateService(self):
+        return self
+
+    def projection(self, query, params):
+        if query == OMERODataBroker.IMAGE_IDS_QUERY:
+            return [[FakeRLong(image_id)] for image_id in self.existing_ids]
+        return []
+
+    def saveArray(self, objects):
+        self.saved.append(objects)
+
+
+def test_deduplicate_hypercube_with_position_directories(tmpdir):
+    deduplicator = UploadDeduplicator(str(tmpdir.join('index.sqlite')))
+
+    paths = []
+    for pos in ('pos001', 'pos002'):
+        pos_dir = tmpdir.mkdir(pos)
+        for z in range(2):
+            pos_dir.join('img_000001_GFP_%03d.png' % z).write_binary(b'%s plane %d' % (pos.encode(), z))
+        paths.append(str(pos_dir))
+
+    # pos001 was uploaded to another dataset before
+    pos001 = str(tmpdir.join('pos001'))
+    deduplicator.record('omero.example.org', deduplicator.hash_positions([pos001])[pos001], 7)
+
+    broker = OMERODataBroker('user', 'password', 'omero.example.org', deduplicator=deduplicator)
+    broker.SESSION = FakeDedupSession(existing_ids=[7])
+
+    # the first position is listed as a directory, the second as its files
+    files_to_upload = [paths[0]] + [str(f) for f in tmpdir.join('pos002').listdir()]
+    remaining, linked_ids, content_hashes = broker.deduplicate_uploads(files_to_upload, 51, hypercube=True)
+
+    assert sorted(remaining) == sorted(files_to_upload[1:])
+    assert linked_ids == [7] and len(broker.SESSION.saved) == 1
+    assert sorted(content_hashes) == [pos001, str(tmpdir.join('pos002'))]
+    assert broker.LAST_DEDUP_REPORT.linked == 1
+    deduplicator.close()
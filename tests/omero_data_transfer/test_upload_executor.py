@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import threading
+import time
+import numpy as np
+import pytest
+from PIL import Image
+from omero_data_transfer.upload_executor import UploadExecutor, decode_image_file
+
+
+def test_results_stream_with_bounded_read_ahead():
+    executor = UploadExecutor(workers=4, queue_depth=6)
+    produced = []
+    lock = threading.Lock()
+
+    def items():
+        for i in range(40):
+            with lock:
+                produced.append(i)
+            yield i
+
+    consumed = 0
+    max_ahead = 0
+    for result in executor.imap_unordered(lambda i: (time.sleep(0.005), i)[1], items()):
+        consumed += 1
+        with lock:
+            max_ahead = max(max_ahead, len(produced) - consumed)
+
+    # the scan never runs more than 'queue_depth' items ahead of the consumer
+    assert consumed == 40
+    assert max_ahead <= 6
+
+    # the pool is reused for the next upload
+    pool = executor.get_thread_pool()
+    assert sorted(executor.imap_unordered(lambda i: i * 2, range(10))) == list(range(0, 20, 2))
+    assert executor.get_thread_pool() is pool
+    executor.close()
+
+
+def test_failed_task_stops_feeding():
+    executor = UploadExecutor(workers=2, queue_depth=2)
+    produced = []
+
+    def items():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    def upload(i):
+        if i == 3:
+            raise IOError('upload failed')
+        return i
+
+    with pytest.raises(IOError):
+        list(executor.imap_unordered(upload, items()))
+
+    time.sleep(0.05)
+    assert len(produced) < 20
+    executor.close()
+
+
+def test_decode_in_processes(tmpdir):
+    paths = []
+    for i in range(4):
+        path = str(tmpdir.join('img_%03d.png' % i))
+        Image.fromarray(np.full((8, 8), i, dtype=np.uint8)).save(path)
+        paths.append(path)
+
+    bad_path = str(tmpdir.join('img_bad.png'))
+    tmpdir.join('img_bad.png').write('not an image')
+
+    executor = UploadExecutor(workers=2, decode_processes=2)
+    results = list(executor.imap_unordered(lambda decoded: decoded, paths + [bad_path], decode=decode_image_file))
+    executor.close()
+
+    planes = dict(results)
+    assert sorted(planes) == sorted(paths + [bad_path])
+    assert planes[bad_path] is None
+    for i, path in enumerate(paths):
+        assert planes[path].shape == (8, 8)
+        assert (planes[path] == i).all()
+
+
+def test_invalid_settings():
+    with pytest.raises(ValueError):
+        UploadExecutor(workers=0)
+    with pytest.raises(ValueError):
+        UploadExecutor(queue_depth=0)
+    with pytest.raises(ValueError):
+        UploadExecutor(decode_processes=-1)
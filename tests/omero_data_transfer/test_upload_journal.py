@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import os
+from multiprocessing.pool import ThreadPool
+from omero_data_transfer.upload_journal import UploadJournal, file_fingerprint, position_fingerprint
+
+
+def test_journal_persists_progress(tmpdir):
+    journal = UploadJournal.for_data_dir(str(tmpdir))
+    assert journal.find_dataset('localhost', 'test_dataset') is None
+
+    journal.start_dataset('localhost', 'test_dataset', '51')
+    assert journal.is_metadata_done(51) == False
+    journal.mark_metadata_done(51)
+
+    journal.record(51, '/data/pos001/img_000001_GFP_001.png', UploadJournal.FILE, 7, '10-1')
+    journal.record(51, '/data/pos001', UploadJournal.POSITION, 8, 'abc')
+    journal.close()
+
+    # reopened, e.g. by a new process resuming the upload
+    journal = UploadJournal.for_data_dir(str(tmpdir))
+    assert journal.find_dataset('localhost', 'test_dataset') == 51
+    assert journal.find_dataset('otherhost', 'test_dataset') is None
+    assert journal.is_metadata_done(51) == True
+    assert journal.completed(51, UploadJournal.FILE) == {'/data/pos001/img_000001_GFP_001.png': '10-1'}
+    assert journal.completed(51, UploadJournal.POSITION) == {'/data/pos001': 'abc'}
+    assert journal.completed(52, UploadJournal.FILE) == {}
+
+    # a new upload of the same dataset name starts over
+    journal.start_dataset('localhost', 'test_dataset', 60)
+    assert journal.find_dataset('localhost', 'test_dataset') == 60
+    assert journal.is_metadata_done(60) == False
+
+    journal.record(60, '/data/pos001', UploadJournal.POSITION, 9, 'abc')
+    journal.forget_dataset(60)
+    assert journal.find_dataset('localhost', 'test_dataset') is None
+    assert journal.completed(60, UploadJournal.POSITION) == {}
+    journal.close()
+
+
+def test_journal_records_from_threads(tmpdir):
+    journal = UploadJournal(str(tmpdir.join('journal.sqlite')))
+    paths = ['/data/img_%03d.png' % i for i in range(50)]
+
+    pool = ThreadPool(processes=8)
+    try:
+        pool.map(lambda path: journal.record(1, path, UploadJournal.FILE, 1, 'x'), paths)
+    finally:
+        pool.close()
+        pool.join()
+
+    assert sorted(journal.completed(1, UploadJournal.FILE)) == paths
+    journal.close()
+
+
+def test_fingerprints_detect_changes(tmpdir):
+    pos_dir = tmpdir.mkdir('pos001')
+    image = pos_dir.join('img_000001_GFP_001.png')
+    image.write('abc')
+
+    fingerprint = file_fingerprint(os.stat(str(image)))
+    pos_fingerprint = position_fingerprint(str(pos_dir))
+    assert file_fingerprint(os.stat(str(image))) == fingerprint
+    assert position_fingerprint(str(pos_dir)) == pos_fingerprint
+
+    image.write('abcd')
+    assert file_fingerprint(os.stat(str(image))) != fingerprint
+    assert position_fingerprint(str(pos_dir)) != pos_fingerprint
+
+    pos_fingerprint = position_fingerprint(str(pos_dir))
+    pos_dir.join('img_000001_GFP_002.png').write('abcd')
+    assert position_fingerprint(str(pos_dir)) != pos_fingerprint
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+__author__ = "Johnny Hay"
+__copyright__ = "BioRDM"
+__license__ = "mit"
+
+import os
+from omero_data_transfer.data_transfer_manager import DataTransferManager, scan_data_dir
+
+
+def test_scan_data_dir(tmp_path):
+    (tmp_path / 'Experiment_Acq.txt').write_text(u'acq')
+    for pos in ('pos001', 'pos002'):
+        (tmp_path / pos).mkdir()
+        (tmp_path / pos / 'exp_000001_GFP_001.png').write_bytes(b'png')
+    (tmp_path / 'pos002' / 'nested').mkdir()
+    (tmp_path / 'pos002' / 'nested' / 'exp_000002_GFP_001.png').write_bytes(b'nested png')
+
+    scanner = scan_data_dir(str(tmp_path))
+    assert iter(scanner) is scanner
+
+    entries = dict((os.path.relpath(entry.path, str(tmp_path)), entry) for entry in scanner)
+
+    assert sorted(entries) == [os.path.join('pos001', 'exp_000001_GFP_001.png'),
+                               os.path.join('pos002', 'exp_000001_GFP_001.png'),
+                               os.path.join('pos002', 'nested', 'exp_000002_GFP_001.png')]
+    assert entries[os.path.join('pos002', 'nested', 'exp_000002_GFP_001.png')].stat().st_size == 10
+
+
+class FakeId(object):
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class FakeDataset(object):
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+
+    def getId(self):
+        return FakeId(self.dataset_id)
+
+
+class FakeBroker(object):
+    HOST = 'omero.example.org'
+
+    def __init__(self, existing_ids):
+        self.existing_ids = existing_ids
+        self.next_id = max(existing_ids) + 1
+        self.uploads = []
+
+    def open_omero_session(self):
+        pass
+
+    def close_omero_session(self):
+        pass
+
+    def get_dataset(self, dataset_id):
+        return FakeDataset(dataset_id) if int(dataset_id) in self.existing_ids else None
+
+    def create_dataset(self, dataset_name):
+        dataset_id = self.next_id
+        self.next_id += 1
+        self.existing_ids.add(dataset_id)
+        return FakeDataset(dataset_id)
+
+    def upload_images(self, files_to_upload, dataset_id, hypercube, on_uploaded=None, deduplicate=False):
+        files = list(files_to_upload)
+        self.uploads.append((dataset_id, files))
+        for path in files:
+            on_uploaded(path, 1)
+        return [1] * len(files)
+
+
+def test_resume_to_deleted_dataset(tmp_path):
+    (tmp_path / 'pos001').mkdir()
+    (tmp_path / 'pos001' / 'exp_000001_GFP_001.png').write_bytes(b'png')
+    broker = FakeBroker(set([51]))
+    manager = DataTransferManager()
+
+    results = manager.upload_data_dir(broker, 'test_dataset', str(tmp_path), ignore_metadata=True, resume=True)
+    assert results['dataset_id'] == '52'
+
+    # resumed while the dataset still exists: the uploaded file is skipped
+    results = manager.upload_data_dir(broker, 'test_dataset', str(tmp_path), ignore_metadata=True, resume=True)
+    assert results['dataset_id'] == '52'
+    assert broker.uploads[-1] == ('52', [])
+
+    # deleted on the server: a new dataset is created and every file uploaded
+    broker.existing_ids.remove(52)
+    results = manager.upload_data_dir(broker, 'test_dataset', str(tmp_path), ignore_metadata=True, resume=True)
+    assert results['dataset_id'] == '53'
+    assert len(broker.uploads[-1][1]) == 1